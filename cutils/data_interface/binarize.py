@@ -0,0 +1,216 @@
+"""
+On-disk cache for integerized datasets.
+
+The token stream and sentence offsets of a dataset are written to .npy
+files next to the dataset, its vocabulary to a .npz archive written by
+`Dict.save`. The file names contain a hash of the
+source files and of the options used to create them, so a cache entry is
+never reused for different data. Later runs memory-map these files instead
+of reading and integerizing the text again.
+"""
+from __future__ import print_function
+
+import os
+import hashlib
+
+import numpy
+
+from cutils.data_interface.parallel import ParallelCorpus
+from cutils.data_interface.ragged import RaggedCorpus
+
+
+def source_digest(paths, **options):
+    """
+    Hashes the contents of some source files and a set of options
+
+    :type paths: list(string)
+    :param paths: The source files. Their order matters
+
+    :returns: A hex string
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        # Don't let the contents of consecutive files run into each other
+        sha.update(b'\0')
+    sha.update(repr(sorted(options.items())).encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def stat_digest(paths, **options):
+    """
+    Hashes the paths, sizes and modification times of some source files
+    and a set of options. Unlike `source_digest`, the files are not read,
+    which matters for datasets made of many small files. An edit that
+    keeps the size and modification time of a file goes unnoticed
+
+    :type paths: list(string)
+    :param paths: The source files. Their order matters
+
+    :returns: A hex string
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        entry = '%s\0%d\0%r\0' % (os.path.abspath(path), stat.st_size,
+                                  stat.st_mtime)
+        if not isinstance(entry, bytes):
+            entry = entry.encode('utf-8')
+        sha.update(entry)
+    sha.update(repr(sorted(options.items())).encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def cache_prefix(dataset_dir, name, digest):
+    """
+    Returns the path prefix used for a cache entry in dataset_dir
+    """
+    return os.path.join(dataset_dir, '%s.%s' % (name, digest))
+
+
+def _save_array(path, array):
+    """
+    Writes to a temporary file first so that an interrupted run never
+    leaves a truncated cache entry behind
+    """
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        numpy.save(f, array)
+    os.rename(tmp_path, path)
+
+
+def save_corpus(prefix, corpus):
+    """
+    Stores a RaggedCorpus as prefix.tokens.npy and prefix.offsets.npy
+    """
+    # The offsets are written last, they mark the entry as complete
+    _save_array(prefix + '.tokens.npy', corpus.tokens)
+    _save_array(prefix + '.offsets.npy', corpus.offsets)
+
+
+def load_corpus(prefix, mmap_mode='r'):
+    """
+    Loads a RaggedCorpus stored with `save_corpus`
+
+    :type mmap_mode: string
+    :param mmap_mode: Passed to numpy.load. The default memory-maps the
+        files read-only
+
+    :returns: A RaggedCorpus, or None if the entry does not exist
+    """
+    if not os.path.isfile(prefix + '.offsets.npy'):
+        return None
+    return RaggedCorpus(numpy.load(prefix + '.tokens.npy', mmap_mode=mmap_mode),
+                        numpy.load(prefix + '.offsets.npy',
+                                   mmap_mode=mmap_mode))
+
+
+def save_parallel_corpus(prefix, corpus):
+    """
+    Stores a ParallelCorpus as two corpora, prefix.src and prefix.tgt
+    """
+    # The target offsets are written last, they mark the entry as complete
+    save_corpus(prefix + '.src', corpus.source)
+    save_corpus(prefix + '.tgt', corpus.target)
+
+
+def load_parallel_corpus(prefix, mmap_mode='r'):
+    """
+    Loads a ParallelCorpus stored with `save_parallel_corpus`
+
+    :returns: A ParallelCorpus, or None if the entry does not exist
+    """
+    if not os.path.isfile(prefix + '.tgt.offsets.npy'):
+        return None
+    return ParallelCorpus(load_corpus(prefix + '.src', mmap_mode),
+                          load_corpus(prefix + '.tgt', mmap_mode))
+
+
+def save_vocab(prefix, dictionary):
+    """
+    Stores the vocabulary of a Dict as prefix.vocab.npz
+    """
+    tmp_path = '%s.vocab.npz.tmp%d' % (prefix, os.getpid())
+    dictionary.save(tmp_path, include_embedding=False)
+    os.rename(tmp_path, prefix + '.vocab.npz')
+
+
+def load_vocab(prefix, emb_dim):
+    """
+    Creates a Dict from a vocabulary stored with `save_vocab`
+
+    :returns: A Dict, or None if the entry does not exist
+    """
+    if not os.path.isfile(prefix + '.vocab.npz'):
+        return None
+    # cutils.dict needs theano, the corpus cache does not
+    from cutils.dict import Dict
+    return Dict.load(prefix + '.vocab.npz', emb_dim)
+
+
+def vocab_digest(dictionary):
+    """
+    Hashes the vocabulary of a Dict, for use as an option in
+    `source_digest`
+    """
+    sha = hashlib.sha1()
+    for word in dictionary.vocab():
+        if not isinstance(word, bytes):
+            word = word.encode('utf-8')
+        sha.update(word + b'\n')
+    return sha.hexdigest()[:16]
+
+
+def cached_corpus(prefix, build, mmap_mode='r'):
+    """
+    Loads a corpus from the cache, creating the entry with build() first
+    if it does not exist
+
+    :type build: function
+    :param build: Returns the RaggedCorpus to be cached
+
+    :returns: A RaggedCorpus
+    """
+    corpus = load_corpus(prefix, mmap_mode)
+    if corpus is None:
+        save_corpus(prefix, build())
+        corpus = load_corpus(prefix, mmap_mode)
+    else:
+        print('... Loaded %s from the cache' % prefix)
+    return corpus
+
+
+def cached_parallel_corpus(prefix, build, mmap_mode='r'):
+    """
+    Like `cached_corpus`, for a ParallelCorpus
+
+    :returns: A ParallelCorpus
+    """
+    corpus = load_parallel_corpus(prefix, mmap_mode)
+    if corpus is None:
+        save_parallel_corpus(prefix, build())
+        corpus = load_parallel_corpus(prefix, mmap_mode)
+    else:
+        print('... Loaded %s from the cache' % prefix)
+    return corpus
+
+
+def cached_vocab(prefix, build, emb_dim):
+    """
+    Loads a Dict from the cache, creating the entry with build() first
+    if it does not exist
+
+    :type build: function
+    :param build: Returns the Dict to be cached
+
+    :returns: A Dict
+    """
+    dictionary = load_vocab(prefix, emb_dim)
+    if dictionary is None:
+        dictionary = build()
+        save_vocab(prefix, dictionary)
+    else:
+        print('... Loaded %s from the cache' % prefix)
+    return dictionary
@@ -0,0 +1,110 @@
+"""
+Fixed-size (context, target) windows over a flat token stream, as used to
+train n-gram language models
+"""
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+class NgramWindows(object):
+    """
+    All the windows of context_size + 1 consecutive tokens in a stream.
+    Window i has the context stream[i:i + context_size] and the target
+    stream[i + context_size].
+
+    The contexts are a strided view of the stream, so no window is ever
+    stored on its own: the whole dataset takes the memory of the stream.
+    A range of windows (see `split`) shares the same stream.
+    """
+
+    def __init__(self, stream, context_size, start=0, stop=None):
+        """
+        :type stream: numpy.ndarray
+        :param stream: The flat (int32) token stream. It should start with
+            context_size BOS tokens so that the first word has a context
+
+        :type context_size: int
+        :param context_size: The number of tokens in a context
+
+        :type start: int
+        :param start: The first window of the range
+
+        :type stop: int
+        :param stop: One past the last window of the range. Defaults to the
+            last window of the stream
+        """
+        self.stream = stream
+        self.context_size = context_size
+        n_windows = max(0, stream.shape[0] - context_size)
+        self.start = start
+        self.stop = n_windows if stop is None else stop
+
+    @classmethod
+    def from_corpus(cls, corpus, context_size, bos):
+        """
+        Creates the windows over the sentences of a corpus, one after the
+        other. The stream is padded once with BOS, at the start
+
+        :type corpus: cutils.data_interface.ragged.RaggedCorpus
+        :param corpus: The sentences, typically each ending with EOS
+
+        :type bos: int
+        :param bos: The id of the BOS token
+
+        :returns: A NgramWindows
+        """
+        tokens = corpus.tokens[corpus.offsets[0]:corpus.offsets[-1]]
+        stream = numpy.empty((context_size + tokens.shape[0],),
+                             dtype=tokens.dtype)
+        stream[:context_size] = bos
+        stream[context_size:] = tokens
+        return cls(stream, context_size)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def contexts(self):
+        """
+        Returns a read-only (N x context_size) strided view of the contexts
+        of the windows in the range
+        """
+        step = self.stream.strides[0]
+        return as_strided(self.stream[self.start:],
+                          shape=(len(self), self.context_size),
+                          strides=(step, step), writeable=False)
+
+    def targets(self):
+        """
+        Returns a view of the targets of the windows in the range
+        """
+        return self.stream[self.start + self.context_size:
+                           self.stop + self.context_size]
+
+    def get_batch(self, idx):
+        """
+        Gathers some windows of the range
+
+        :type idx: numpy.ndarray
+        :param idx: The indices of the windows, relative to the range
+
+        :returns: (x, y), a (batch x context_size) int matrix of contexts and
+            the vector of targets
+        """
+        idx = numpy.asarray(idx, dtype='int64')
+        return self.contexts()[idx], self.targets()[idx]
+
+    def split(self, valid_portion):
+        """
+        Splits the windows into two consecutive ranges sharing the stream
+
+        :type valid_portion: float
+        :param valid_portion: The proportion of windows in the second range
+
+        :returns: Two NgramWindows, eg. the train and valid sets
+        """
+        n_large = self.start + int(numpy.round(len(self) *
+                                               (1 - valid_portion)))
+        return (NgramWindows(self.stream, self.context_size, self.start,
+                             n_large),
+                NgramWindows(self.stream, self.context_size, n_large,
+                             self.stop))
@@ -0,0 +1,162 @@
+"""
+Storage and streaming readers for parallel corpora (eg. bitext for
+translation), made of aligned source and target sequences
+"""
+import numpy
+from six.moves import zip_longest
+
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.utils import iter_chunks
+
+
+class ParallelCorpus(object):
+    """
+    Pairs of integer sequences, stored as two RaggedCorpus of the same
+    length: one for the sources and one for the targets. Pair i is
+    (source[i], target[i]).
+    """
+
+    def __init__(self, source, target):
+        """
+        :type source: cutils.data_interface.ragged.RaggedCorpus
+        :param source: The source sequences
+
+        :type target: cutils.data_interface.ragged.RaggedCorpus
+        :param target: The target sequences, aligned with source
+        """
+        if len(source) != len(target):
+            raise ValueError('The source and target corpora have different '
+                             'lengths (%d and %d)' % (len(source),
+                                                      len(target)))
+        self.source = source
+        self.target = target
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, idx):
+        """
+        An integer returns one (source, target) pair. Anything else (a
+        slice or an array of indices) returns a ParallelCorpus
+        """
+        if isinstance(idx, (int, numpy.integer)):
+            return self.source[idx], self.target[idx]
+        return ParallelCorpus(self.source[idx], self.target[idx])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, idx):
+        """
+        Gathers a subset of the pairs (in the given order) into new,
+        contiguous storage
+
+        :returns: A ParallelCorpus
+        """
+        return ParallelCorpus(self.source.take(idx), self.target.take(idx))
+
+    def num_tokens(self):
+        """
+        Returns the total number of (source, target) tokens in the corpus
+        """
+        return self.source.num_tokens(), self.target.num_tokens()
+
+    def pad_and_mask(self, idx=None, maxlen=None):
+        """
+        Creates the padded (T x N) batches and masks for some pairs
+
+        :type idx: numpy.ndarray
+        :param idx: The indices of the pairs in the batch. Uses every pair
+            in the corpus if None
+
+        :returns: (x, x_mask, y, y_mask)
+        """
+        x, x_mask, _ = self.source.pad_and_mask(idx, maxlen=maxlen)
+        y, y_mask, _ = self.target.pad_and_mask(idx, maxlen=maxlen)
+        return x, x_mask, y, y_mask
+
+
+def iter_pairs(src_lines, tgt_lines):
+    """
+    Reads two streams of lines in lockstep
+
+    :raises ValueError: If one stream ends before the other
+    """
+    missing = object()
+    for src, tgt in zip_longest(src_lines, tgt_lines, fillvalue=missing):
+        if src is missing or tgt is missing:
+            raise ValueError('The source and target have different numbers '
+                             'of lines')
+        yield src, tgt
+
+
+def _encode_side(worddict, sentences):
+    # cutils.dict needs theano, the corpora themselves do not
+    from cutils.dict import encode_words
+    words = []
+    lengths = numpy.zeros((len(sentences),), dtype='int64')
+    for i, sentence in enumerate(sentences):
+        words.extend(sentence)
+        lengths[i] = len(sentence)
+    return encode_words(worddict, words), lengths
+
+
+def _join(parts):
+    """
+    Builds a RaggedCorpus from a list of (tokens, lengths) chunks
+    """
+    if not parts:
+        return RaggedCorpus.from_sequences([])
+    tokens = numpy.concatenate([tokens for tokens, _ in parts])
+    lengths = numpy.concatenate([lengths for _, lengths in parts])
+    offsets = numpy.zeros((lengths.shape[0] + 1,), dtype='int64')
+    numpy.cumsum(lengths, out=offsets[1:])
+    return RaggedCorpus(tokens, offsets)
+
+
+def read_parallel(src_lines, tgt_lines, src_dictionary, tgt_dictionary,
+                  maxlen=None, chunk_size=10000):
+    """
+    Integerizes a parallel corpus while streaming over it. The source and
+    target are read in lockstep, a chunk of lines at a time, and pairs
+    that are too long are dropped before they are encoded. Only the
+    integer ids are kept, so the text of the corpus is never held in
+    memory as a whole
+
+    :type src_lines: iterable(strings)
+    :param src_lines: The (tokenized) source sentences, eg. an open file
+
+    :type tgt_lines: iterable(strings)
+    :param tgt_lines: The target sentences, aligned with src_lines
+
+    :type src_dictionary: cutils.dict.Dict
+    :param src_dictionary: The source vocabulary
+
+    :type tgt_dictionary: cutils.dict.Dict
+    :param tgt_dictionary: The target vocabulary
+
+    :type maxlen: int
+    :param maxlen: If set, only the pairs whose source and target both
+        have fewer than maxlen words are kept
+
+    :type chunk_size: int
+    :param chunk_size: The number of pairs encoded at a time
+
+    :returns: A ParallelCorpus
+    """
+    src_parts, tgt_parts = [], []
+    for chunk in iter_chunks(iter_pairs(src_lines, tgt_lines), chunk_size):
+        src = []
+        tgt = []
+        for src_line, tgt_line in chunk:
+            src_words = src_line.split()
+            tgt_words = tgt_line.split()
+            if maxlen is not None and (len(src_words) >= maxlen
+                                       or len(tgt_words) >= maxlen):
+                continue
+            src.append(src_words)
+            tgt.append(tgt_words)
+        src_parts.append(_encode_side(src_dictionary.worddict, src))
+        tgt_parts.append(_encode_side(tgt_dictionary.worddict, tgt))
+    return ParallelCorpus(_join(src_parts), _join(tgt_parts))
@@ -0,0 +1,145 @@
+"""
+Compact storage for integerized datasets made of variable length sequences
+"""
+import numpy
+
+from cutils.data_interface.utils import pad_and_mask_ragged
+
+
+class RaggedCorpus(object):
+    """
+    A list of integer sequences stored CSR-style: one contiguous int32
+    token array and an int64 array of N + 1 offsets. Sequence i is
+    tokens[offsets[i]:offsets[i + 1]].
+
+    Compared to a list of lists of Python ints, this takes a fraction of
+    the memory and lets batches be gathered without Python loops.
+    """
+
+    def __init__(self, tokens, offsets):
+        """
+        :type tokens: numpy.ndarray
+        :param tokens: The flat token array
+
+        :type offsets: numpy.ndarray
+        :param offsets: The N + 1 sequence boundaries in tokens
+        """
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_sequences(cls, seqs, dtype='int32'):
+        """
+        Builds a corpus from an iterable of integer sequences
+
+        :type seqs: list(list(int))
+        :param seqs: The integerized sequences
+
+        :returns: A RaggedCorpus
+        """
+        seqs = [numpy.asarray(s, dtype=dtype) for s in seqs]
+        lengths = numpy.asarray([s.shape[0] for s in seqs], dtype='int64')
+        offsets = numpy.zeros((len(seqs) + 1,), dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+        if len(seqs) > 0:
+            tokens = numpy.concatenate(seqs)
+        else:
+            tokens = numpy.zeros((0,), dtype=dtype)
+        return cls(tokens, offsets)
+
+    @classmethod
+    def concatenate(cls, corpora):
+        """
+        Joins several corpora, one after the other
+
+        :type corpora: list(RaggedCorpus)
+        :param corpora: The corpora to be joined
+
+        :returns: A RaggedCorpus
+        """
+        tokens = numpy.concatenate([c.tokens[c.offsets[0]:c.offsets[-1]]
+                                    for c in corpora])
+        lengths = numpy.concatenate([c.lengths() for c in corpora])
+        offsets = numpy.zeros((lengths.shape[0] + 1,), dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+        return cls(tokens, offsets)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        """
+        An integer returns a view of one sequence. A slice returns a
+        corpus sharing the token storage. Anything else is treated as an
+        array of indices and gathered with `take`
+        """
+        if isinstance(idx, (int, numpy.integer)):
+            if idx < 0:
+                idx += len(self)
+            return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return RaggedCorpus(self.tokens,
+                                    self.offsets[start:max(start, stop) + 1])
+            idx = numpy.arange(start, stop, step)
+        return self.take(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """
+        Returns the lengths of all sequences as an int64 array
+        """
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def num_tokens(self):
+        """
+        Returns the total number of tokens in the corpus
+        """
+        return int(self.offsets[-1] - self.offsets[0])
+
+    def take(self, idx):
+        """
+        Gathers a subset of the sequences (in the given order) into new,
+        contiguous storage
+
+        :type idx: numpy.ndarray
+        :param idx: The indices of the sequences to keep
+
+        :returns: A RaggedCorpus
+        """
+        idx = numpy.asarray(idx, dtype='int64').reshape((-1,))
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx + 1] - starts
+        offsets = numpy.zeros((idx.shape[0] + 1,), dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+        src = (numpy.repeat(starts - offsets[:-1], lengths)
+               + numpy.arange(offsets[-1]))
+        return RaggedCorpus(self.tokens[src], offsets)
+
+    def pad_and_mask(self, idx=None, labels=None, maxlen=None, buf=None):
+        """
+        Creates the padded (T x N) batch and mask for some sequences
+
+        :type idx: numpy.ndarray
+        :param idx: The indices of the sequences in the batch. Uses every
+            sequence in the corpus if None
+
+        :type buf: cutils.data_interface.utils.PaddingBuffer
+        :param buf: Reusable output storage
+
+        :returns: (x, x_mask, labels), as with `pad_and_mask`
+        """
+        batch = self if idx is None else self.take(idx)
+        return pad_and_mask_ragged(batch.tokens, batch.offsets,
+                                   labels=labels, maxlen=maxlen, buf=buf,
+                                   dtype=self.tokens.dtype)
+
+    def to_list(self):
+        """
+        Returns the corpus as a list of lists of ints
+        """
+        return [s.tolist() for s in self]
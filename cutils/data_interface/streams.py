@@ -0,0 +1,90 @@
+"""
+Parallel token streams for training stateful recurrent language models
+with truncated backprop through time
+"""
+import numpy
+
+from cutils.data_interface.utils import mask_dtype
+
+
+class TokenStreams(object):
+    """
+    A flat token stream cut into n_streams contiguous parts, laid side by
+    side in a (n_steps x n_streams) matrix. Consecutive windows of rows
+    continue each other, so the recurrent state at the end of a window is
+    the right initial state for the next one.
+
+    Window i holds the rows i * maxlen to (i + 1) * maxlen: maxlen inputs
+    plus the row with the target of the last input. It overlaps the next
+    window by that row, which is masked out: every window predicts maxlen
+    tokens of each stream and there is no padding.
+    """
+
+    def __init__(self, stream, n_streams, maxlen):
+        """
+        :type stream: numpy.ndarray
+        :param stream: The flat (int32) token stream. The few tokens that
+            do not fill a row are dropped
+
+        :type n_streams: int
+        :param n_streams: The number of parallel streams (the batch size)
+
+        :type maxlen: int
+        :param maxlen: The number of steps backpropagated through in a
+            window
+        """
+        n_steps = stream.shape[0] // n_streams
+        self.n_streams = n_streams
+        self.maxlen = maxlen
+        # Column j is the j-th part of the stream
+        self.data = numpy.ascontiguousarray(
+            stream[:n_steps * n_streams].reshape((n_streams, n_steps)).T)
+        self.mask = numpy.ones((maxlen + 1, n_streams),
+                               dtype=mask_dtype())
+        self.mask[-1] = 0.
+
+    @classmethod
+    def from_corpus(cls, corpus, n_streams, maxlen):
+        """
+        Creates the streams over the sentences of a corpus, one after the
+        other
+
+        :type corpus: cutils.data_interface.ragged.RaggedCorpus
+        :param corpus: The sentences, typically each ending with EOS
+
+        :returns: A TokenStreams
+        """
+        tokens = corpus.tokens[corpus.offsets[0]:corpus.offsets[-1]]
+        return cls(numpy.asarray(tokens), n_streams, maxlen)
+
+    def __len__(self):
+        n_steps = self.data.shape[0]
+        if n_steps < 2:
+            return 0
+        return -(-(n_steps - 1) // self.maxlen)
+
+    def __getitem__(self, idx):
+        """
+        Returns window idx as an (x, mask, None) triple, like
+        `pad_and_mask`. x is a view of the streams and mask is shared by
+        all windows, neither should be modified. The last window can be
+        shorter
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('window index out of range')
+        start = idx * self.maxlen
+        x = self.data[start:start + self.maxlen + 1]
+        # The last row of every window only holds targets
+        return x, self.mask[self.mask.shape[0] - x.shape[0]:], None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def num_targets(self):
+        """
+        Returns the number of tokens predicted over all windows
+        """
+        return max(0, self.data.shape[0] - 1) * self.n_streams
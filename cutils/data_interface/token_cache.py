@@ -0,0 +1,162 @@
+"""
+Cache for the tokenized text of raw-text datasets.
+
+Tokenizing is by far the slowest step of loading datasets such as IMDB,
+and the same files are often tokenized more than once per run (eg. to
+build the vocabulary and again to integerize them). Entries are keyed by
+the contents of the source files and the tokenization options, kept in
+memory for the rest of the run and stored compressed on disk. The least
+recently used entries are removed when the cache directory grows beyond
+its size limit.
+"""
+from __future__ import print_function
+
+import os
+import zlib
+
+from cutils.data_interface import binarize
+import cutils.data_interface.utils as du
+
+
+# Bump this with every change to the tokenizer output. It is part of the
+# cache key of everything built from tokenized text, so old entries are
+# never reused
+TOKENIZER_VERSION = 2
+
+
+class TokenizationCache(object):
+    """
+    Tokenizes the lines read from a set of files, reusing earlier results
+    for identical files
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=2 ** 30, lang='en',
+                 lowercase=False, workers=1, stat_keys=False):
+        """
+        :type cache_dir: string
+        :param cache_dir: The directory holding the cache entries. If None,
+            results are only kept in memory
+
+        :type max_bytes: int
+        :param max_bytes: The size limit for the cache directory
+
+        :type lang: string
+        :param lang: Passed to the tokenizer
+
+        :type lowercase: bool
+        :param lowercase: Lowercase the tokenized text
+
+        :type workers: int
+        :param workers: The number of processes used for tokenization
+
+        :type stat_keys: bool
+        :param stat_keys: Identify the source files by their size and
+            modification time instead of their contents (see
+            `binarize.stat_digest`), for datasets of many small files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lang = lang
+        self.lowercase = lowercase
+        self.workers = workers
+        self.stat_keys = stat_keys
+        self.memo = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def tokenize(self, paths, read_lines):
+        """
+        Returns the tokenized lines of some files
+
+        :type paths: list(string)
+        :param paths: The source files. Their contents (and order) identify
+            the cache entry, or their size and modification time with
+            stat_keys
+
+        :type read_lines: function
+        :param read_lines: Returns the lines of text to be tokenized. Only
+            called when there is no cache entry for the files
+
+        :returns: A list of strings
+        """
+        if self.stat_keys:
+            digest_fn = binarize.stat_digest
+        else:
+            digest_fn = binarize.source_digest
+        digest = digest_fn(paths, lang=self.lang, lowercase=self.lowercase,
+                           version=TOKENIZER_VERSION)
+        if digest in self.memo:
+            return self.memo[digest]
+        lines = self.load(digest)
+        if lines is None:
+            lines = du.tokenize(read_lines(), self.lang, self.workers)
+            if self.lowercase:
+                lines = du.lowercase(lines)
+            self.save(digest, lines)
+        else:
+            print('... Loaded tokenized text from the cache')
+        self.memo[digest] = lines
+        return lines
+
+    def entry_path(self, digest):
+        return os.path.join(self.cache_dir, '%s.tok.z' % digest)
+
+    def load(self, digest):
+        """
+        Reads a cache entry and marks it as recently used
+
+        :returns: A list of strings, or None if the entry does not exist
+        """
+        if self.cache_dir is None:
+            return None
+        path = self.entry_path(digest)
+        try:
+            with open(path, 'rb') as f:
+                text = zlib.decompress(f.read())
+        except (IOError, OSError):
+            return None
+        os.utime(path, None)
+        if not isinstance(text, str):
+            text = text.decode('utf-8')
+        # Every line is terminated by a newline
+        return text.split('\n')[:-1]
+
+    def save(self, digest, lines):
+        """
+        Writes a cache entry and evicts old entries if the cache is full
+        """
+        if self.cache_dir is None:
+            return
+        text = ''.join(line + '\n' for line in lines)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        path = self.entry_path(digest)
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(text))
+        os.rename(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache directory
+        fits in max_bytes
+
+        :type keep: string
+        :param keep: An entry that is never removed
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.tok.z'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
@@ -0,0 +1,344 @@
+"""
+A Python port of the Moses tokenizer (scripts/tokenizer/tokenizer.perl)
+
+The rules are those of the current `tokenizer.perl -l en -q`, including
+the escaping of XML and Moses special characters. The non-breaking prefixes are read
+from the files bundled in cutils/share/nonbreaking_prefixes, so nothing
+is downloaded.
+"""
+import collections
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import unicodedata
+
+import six
+
+from cutils.data_interface.utils import iter_chunks
+
+
+PREFIX_DIR = os.path.join(os.path.dirname(__file__), '..', 'share',
+                          'nonbreaking_prefixes')
+
+
+def _compile(pattern):
+    return re.compile(pattern, re.UNICODE)
+
+
+def _category_runs():
+    """
+    Splits the Unicode code points into runs of equal general category.
+    No run crosses the end of the BMP
+
+    :returns: A list of (category, first, last) tuples
+    """
+    runs = []
+    key = lambda code: (unicodedata.category(six.unichr(code)),
+                        code >= 0x10000)
+    for (cat, _), group in itertools.groupby(range(sys.maxunicode + 1), key):
+        group = list(group)
+        runs.append((cat, group[0], group[-1]))
+    return runs
+
+
+def _char_class(runs, categories, negate=False):
+    """
+    Returns a regex matching one character from some Unicode general
+    categories, given the runs from `_category_runs`. Python's re module has no equivalent of Perl's \\p{...}
+    classes.
+
+    re looks up BMP characters in a bitmap but goes through a list of
+    ranges for the others, so the latter are only tried after a cheap
+    test for a non-BMP character
+    """
+    bmp, astral = [], []
+    for cat, first, last in runs:
+        if cat in categories:
+            ranges = bmp if last < 0x10000 else astral
+            ranges.append(u'%s-%s' % (re.escape(six.unichr(first)),
+                                      re.escape(six.unichr(last))))
+    alternatives = [u'[%s]' % u''.join(bmp)]
+    if astral:
+        alternatives.append(u'(?=[%s-%s])[%s]' % (
+            re.escape(six.unichr(0x10000)),
+            re.escape(six.unichr(sys.maxunicode)), u''.join(astral)))
+    positive = u'(?:%s)' % u'|'.join(alternatives)
+    if negate:
+        return u'(?:(?!%s)[\\s\\S])' % positive
+    return positive
+
+
+# Unlike Perl's, Python's \s includes the \x1c-\x1f separators
+_WHITESPACE = r'[^\S\x1c-\x1f]'
+
+_BLANK = _compile(r'^%s*$' % _WHITESPACE)
+_SPACES = _compile(r'%s+' % _WHITESPACE)
+_ASCII_JUNK = _compile(r'[\x00-\x1f]')
+_MULTI_DOTS = _compile(r'\.(\.+)')
+_DOTMULTI_NEXT = _compile(r'DOTMULTI\.([^.])')
+_WORD_SPLIT = _compile(_WHITESPACE)
+_ENDS_WITH_DOT = _compile(r'^(\S+)\.$')
+_STARTS_WITH_DIGIT = _compile(r'^[0-9]')
+_EXTRA_SPACES = _compile(r' +')
+_NON_ASCII = _compile(r'[^\x00-\x7f]')
+_ESCAPES = [
+    ('&', '&amp;'),
+    ('|', '&#124;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ("'", '&apos;'),
+    ('"', '&quot;'),
+    ('[', '&#91;'),
+    (']', '&#93;'),
+]
+
+
+class _Rules(object):
+    """
+    The substitutions that depend on Perl's \\p{IsAlpha}, \\p{IsAlnum}
+    and \\p{IsN} character classes. Each argument is a regex matching a
+    single character
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, alpha, not_alpha, number, not_number,
+                 not_alpha_or_number, not_alnum):
+        self.special = _compile(u"((?![\\s.'`,\\-])%s)" % not_alnum)
+        # Separate out "," except if within numbers (5,300)
+        self.commas = [
+            (_compile(u'(%s),' % not_number), r'\1 , '),
+            (_compile(u',(%s)' % not_number), r' , \1'),
+            # Separate a "," after a number at the end of the sentence
+            (_compile(u'(%s),$' % number), r'\1 ,'),
+        ]
+        # Split contractions right
+        self.apostrophes = [
+            (_compile(u"(%s)'(%s)" % (not_alpha, not_alpha)), r"\1 ' \2"),
+            (_compile(u"(%s)'(%s)" % (not_alpha_or_number, alpha)),
+             r"\1 ' \2"),
+            (_compile(u"(%s)'(%s)" % (alpha, not_alpha)), r"\1 ' \2"),
+            (_compile(u"(%s)'(%s)" % (alpha, alpha)), r"\1 '\2"),
+            # Special case for "1990's"
+            (_compile(u"(%s)'(s)" % number), r"\1 '\2"),
+        ]
+        self.has_alpha = _compile(alpha)
+
+
+# For lines without any non-ASCII character, the classes reduce to
+# small ranges that re matches much faster
+_ASCII_RULES = _Rules(alpha=r'[A-Za-z]', not_alpha=r'[^A-Za-z]',
+                      number=r'[0-9]', not_number=r'[^0-9]',
+                      not_alpha_or_number=r'[^A-Za-z0-9]',
+                      not_alnum=r'[^A-Za-z0-9]')
+# Built on the first non-ASCII line, this takes a moment
+_UNICODE_RULES = []
+
+
+def _unicode_rules():
+    if not _UNICODE_RULES:
+        runs = _category_runs()
+        alpha = ('Lu', 'Ll', 'Lt', 'Lm', 'Lo', 'Nl')
+        number = ('Nd', 'Nl', 'No')
+        _UNICODE_RULES.append(_Rules(
+            alpha=_char_class(runs, alpha),
+            not_alpha=_char_class(runs, alpha, negate=True),
+            number=_char_class(runs, number),
+            not_number=_char_class(runs, number, negate=True),
+            not_alpha_or_number=_char_class(runs, alpha + number,
+                                            negate=True),
+            not_alnum=_char_class(runs, alpha + ('Nd',), negate=True)))
+    return _UNICODE_RULES[0]
+
+
+def load_prefixes(lang):
+    """
+    Reads the non-breaking prefixes for a language. Like the Perl script,
+    this falls back to the English prefixes for unknown languages
+
+    :returns: A dict mapping each prefix to 1, or to 2 for prefixes that
+        only apply before numbers
+    """
+    path = os.path.join(PREFIX_DIR, 'nonbreaking_prefix.' + lang)
+    if not os.path.isfile(path):
+        path = os.path.join(PREFIX_DIR, 'nonbreaking_prefix.en')
+    prefixes = {}
+    with open(path, 'rb') as f:
+        for item in f:
+            item = item.decode('utf-8').rstrip('\n')
+            if not item or item.startswith('#'):
+                continue
+            numeric_only = re.match(r'(.*)\s+#NUMERIC_ONLY#', item,
+                                    re.UNICODE)
+            if numeric_only:
+                prefixes[numeric_only.group(1)] = 2
+            else:
+                prefixes[item] = 1
+    return prefixes
+
+
+class MosesTokenizer(object):
+    """
+    Tokenizes sentences exactly like `tokenizer.perl -l en -q`
+    """
+
+    def __init__(self, lang='en', escape=True):
+        """
+        :type lang: string
+        :param lang: Selects the non-breaking prefixes. The English rules
+            are applied to every language, as with the `-l en` flag
+
+        :type escape: bool
+        :param escape: Escape the XML and Moses special characters
+        """
+        self.lang = lang
+        self.escape = escape
+        self.prefixes = load_prefixes(lang)
+
+    def tokenize(self, line):
+        """
+        Tokenizes a single line of text
+
+        :type line: string
+        :param line: The line to be tokenized. A trailing newline is
+            ignored. Byte strings are decoded as utf-8
+
+        :returns: The tokenized line, of the same type as the input
+        """
+        if isinstance(line, bytes):
+            return self.tokenize(line.decode('utf-8')).encode('utf-8')
+        if line.endswith('\n'):
+            line = line[:-1]
+        # Blank lines are passed through untouched
+        if _BLANK.match(line):
+            return line
+
+        text = _SPACES.sub(' ', ' %s ' % line)
+        text = _ASCII_JUNK.sub('', text)
+        text = self.strip_spaces(text)
+        if _NON_ASCII.search(text):
+            rules = _unicode_rules()
+        else:
+            rules = _ASCII_RULES
+        text = rules.special.sub(r' \1 ', text)
+
+        # Multi-dots stay together
+        if '..' in text:
+            text = _MULTI_DOTS.sub(r' DOTMULTI\1', text)
+            while 'DOTMULTI.' in text:
+                text = _DOTMULTI_NEXT.sub(r'DOTDOTMULTI \1', text)
+                text = text.replace('DOTMULTI.', 'DOTDOTMULTI')
+
+        # The substitutions are skipped when they cannot match anyway
+        if ',' in text:
+            for regexp, substitution in rules.commas:
+                text = regexp.sub(substitution, text)
+        if "'" in text:
+            for regexp, substitution in rules.apostrophes:
+                text = regexp.sub(substitution, text)
+
+        text = self.split_periods(text, rules)
+
+        text = self.strip_spaces(text)
+
+        # Restore multi-dots
+        while 'DOTDOTMULTI' in text:
+            text = text.replace('DOTDOTMULTI', 'DOTMULTI.')
+        text = text.replace('DOTMULTI', '.')
+
+        if self.escape:
+            for char, escaped in _ESCAPES:
+                text = text.replace(char, escaped)
+        return text
+
+    @staticmethod
+    def strip_spaces(text):
+        """
+        Collapses runs of spaces and removes one leading and one trailing
+        space
+        """
+        text = _EXTRA_SPACES.sub(' ', text)
+        if text.startswith(' '):
+            text = text[1:]
+        if text.endswith(' '):
+            text = text[:-1]
+        return text
+
+    def split_periods(self, text, rules):
+        """
+        Separates the final period of every word, unless the word is a
+        non-breaking prefix (eg. Mr.) or an abbreviation
+        """
+        words = _WORD_SPLIT.split(text)
+        # Like Perl's split, drop the trailing empty fields
+        while words and not words[-1]:
+            words.pop()
+        for i, word in enumerate(words):
+            if not word.endswith('.'):
+                continue
+            match = _ENDS_WITH_DOT.match(word)
+            if match is None:
+                continue
+            pre = match.group(1)
+            following = words[i + 1] if i + 1 < len(words) else ''
+            if (('.' in pre and rules.has_alpha.search(pre))
+                  or self.prefixes.get(pre) == 1
+                  or following[:1].islower()):
+                pass
+            elif (self.prefixes.get(pre) == 2
+                  and _STARTS_WITH_DIGIT.match(following)):
+                pass
+            else:
+                words[i] = pre + ' .'
+        return ' '.join(words) + ' '
+
+
+# The tokenizer used by the worker processes of `tokenize_lines`
+_WORKER_TOKENIZER = None
+
+
+def _init_worker(lang, escape):
+    global _WORKER_TOKENIZER
+    _WORKER_TOKENIZER = MosesTokenizer(lang, escape)
+
+
+def _tokenize_chunk(lines):
+    return [_WORKER_TOKENIZER.tokenize(line) for line in lines]
+
+
+def tokenize_lines(lines, lang='en', escape=True, workers=1,
+                   chunk_size=1000):
+    """
+    Tokenizes a stream of lines, yielding the tokenized lines in order.
+    Only a bounded number of lines is held in memory at a time
+
+    :type lines: iterable(strings)
+    :param lines: The lines to be tokenized, eg. an open file
+
+    :type workers: int
+    :param workers: The number of processes used for tokenization
+
+    :type chunk_size: int
+    :param chunk_size: The number of lines sent to a worker at a time
+    """
+    if workers <= 1:
+        tokenizer = MosesTokenizer(lang, escape)
+        for line in lines:
+            yield tokenizer.tokenize(line)
+        return
+    pool = multiprocessing.Pool(workers, _init_worker, (lang, escape))
+    pending = collections.deque()
+    try:
+        for chunk in iter_chunks(lines, chunk_size):
+            pending.append(pool.apply_async(_tokenize_chunk, (chunk,)))
+            if len(pending) > 2 * workers:
+                for line in pending.popleft().get():
+                    yield line
+        while pending:
+            for line in pending.popleft().get():
+                yield line
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
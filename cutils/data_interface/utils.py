@@ -1,8 +1,25 @@
+import collections
+import glob
+import itertools
+from multiprocessing.pool import ThreadPool
 import os
 import numpy
-import theano
-from subprocess import Popen, PIPE
-from six.moves import urllib
+try:
+    import theano
+except ImportError:
+    # Theano only sets the dtype of the masks, the data pipeline works
+    # without it
+    theano = None
+
+
+def mask_dtype():
+    """
+    Returns the dtype of the masks: theano's floatX, or its default,
+    float64, when theano is not installed
+    """
+    if theano is None:
+        return 'float64'
+    return theano.config.floatX
 
 
 def pad_and_mask(seqs, labels=None, maxlen=None):
@@ -16,6 +33,9 @@ def pad_and_mask(seqs, labels=None, maxlen=None):
 
     this swaps the axis!
     """
+    if hasattr(seqs, 'pad_and_mask'):
+        # A RaggedCorpus or a view of one
+        return seqs.pad_and_mask(labels=labels, maxlen=maxlen)
     # x: a list of sentences
     lengths = [len(s) for s in seqs]
     if maxlen is not None:
@@ -28,7 +48,7 @@ def pad_and_mask(seqs, labels=None, maxlen=None):
     n_samples = len(seqs)
 
     x = numpy.zeros((maxlen, n_samples)).astype('int64')
-    x_mask = numpy.zeros((maxlen, n_samples)).astype(theano.config.floatX)
+    x_mask = numpy.zeros((maxlen, n_samples)).astype(mask_dtype())
     y = labels
     #TODO : Handle the case where labels are a matrix (many to many)
     for idx, s in enumerate(seqs):
@@ -39,6 +59,92 @@ def pad_and_mask(seqs, labels=None, maxlen=None):
     return x, x_mask, y
 
 
+class PaddingBuffer(object):
+    """
+    Preallocated output storage for `pad_and_mask_ragged`.
+
+    The buffer grows to the largest batch seen so far and is reused for
+    every subsequent batch. The arrays handed out by a buffer are
+    overwritten by the next call that uses it, so keep one buffer per
+    batch that has to stay alive at the same time.
+    """
+
+    def __init__(self, dtype='int32'):
+        self.dtype = dtype
+        self.x = numpy.zeros((0,), dtype=dtype)
+        self.x_mask = numpy.zeros((0,), dtype=mask_dtype())
+
+    def get(self, n_steps, n_samples):
+        """
+        Returns zeroed, C-contiguous (n_steps x n_samples) views of the
+        buffer for x and the mask
+        """
+        size = n_steps * n_samples
+        if size > self.x.shape[0]:
+            self.x = numpy.zeros((size,), dtype=self.dtype)
+            self.x_mask = numpy.zeros((size,), dtype=mask_dtype())
+        x = self.x[:size].reshape((n_steps, n_samples))
+        x_mask = self.x_mask[:size].reshape((n_steps, n_samples))
+        x.fill(0)
+        x_mask.fill(0.)
+        return x, x_mask
+
+
+def pad_and_mask_ragged(tokens, offsets, labels=None, maxlen=None,
+                        buf=None, dtype='int32'):
+    """
+    Vectorized version of `pad_and_mask` for a ragged batch.
+
+    Sequence i of the batch is tokens[offsets[i]:offsets[i + 1]]. The
+    padded matrix and the mask are filled with a single fancy-index
+    scatter instead of a Python loop over the batch.
+
+    :type tokens: numpy.ndarray
+    :param tokens: The flat (int32) token buffer
+
+    :type offsets: numpy.ndarray
+    :param offsets: The N + 1 sequence boundaries in tokens
+
+    :type labels: list
+    :param labels: Passed through untouched
+
+    :type maxlen: int
+    :param maxlen: Sequences are truncated to this length
+
+    :type buf: PaddingBuffer
+    :param buf: Reusable output storage. New arrays are allocated if None
+
+    :type dtype: string
+    :param dtype: The integer type of x, when no buffer is given
+
+    :returns: (x, x_mask, labels). x and x_mask are T x N (this swaps
+        the axis!)
+    """
+    offsets = numpy.asarray(offsets)
+    lengths = offsets[1:] - offsets[:-1]
+    if maxlen is not None:
+        lengths = numpy.minimum(lengths, maxlen)
+    n_samples = lengths.shape[0]
+    n_steps = lengths.max() if n_samples > 0 else 0
+
+    if buf is None:
+        x = numpy.zeros((n_steps, n_samples), dtype=dtype)
+        x_mask = numpy.zeros((n_steps, n_samples),
+                             dtype=mask_dtype())
+    else:
+        x, x_mask = buf.get(n_steps, n_samples)
+
+    # Position of every retained token inside the padded matrix
+    cols = numpy.repeat(numpy.arange(n_samples), lengths)
+    starts = numpy.cumsum(lengths) - lengths
+    rows = numpy.arange(cols.shape[0]) - numpy.repeat(starts, lengths)
+    src = numpy.repeat(offsets[:-1], lengths) + rows
+    x[rows, cols] = tokens[src]
+    x_mask[rows, cols] = 1.
+
+    return x, x_mask, labels
+
+
 def scale_to_unit_interval(ndar, eps=1e-8):
     """ scales all values in the ndarray ndar to be between 0 and 1 """
     ndar = ndar.copy()
@@ -47,55 +153,103 @@ def scale_to_unit_interval(ndar, eps=1e-8):
     return ndar
 
 
-def tokenize(sentences, lang="en"):
-    # download the tokenizer if it does not exist
-    cdir = os.path.dirname(__file__)
-    tok_origin = "https://raw.githubusercontent.com/moses-smt/mosesdecoder/" \
-        "master/scripts/tokenizer/tokenizer.perl"
-    tok_dest = os.path.join(cdir, "../../scripts/tokenizer")
-    prefix_origin = "https://raw.githubusercontent.com/moses-smt/mosesdecoder" \
-        "/master/scripts/share/nonbreaking_prefixes"
-    prefix_dest = os.path.join(cdir, "../share/nonbreaking_prefixes")
-    if not os.path.isfile(tok_dest):
-        print('downloading the tokenizer script')
-        urllib.request.urlretrieve(tok_origin, tok_dest)
-        os.chmod(tok_dest, 0775)
-    # check if the non-breaking prefix exists for this lang
-    if not os.path.isfile(prefix_dest + '/nonbreaking_prefix.' + lang):
-        # attempt to download it
-        try:
-            os.makedirs(prefix_dest)
-        except:
-            # directory exists
-            pass
-        try:
-            print('downloading the non-breaking prefix file')
-            urllib.request.urlretrieve(
-                prefix_origin + "/nonbreaking_prefix." + lang,
-                prefix_dest + "/nonbreaking_prefix." + lang
-            )
-        except urllib.error.urlerror, e:
-            # TODO: this exception does not get triggered
-            # an empty file is created instead which contains the
-            # phrase "not found"
-            if e.code == 404:
-                print('the prefix file for the lang %s could not be downloaded'
-                      % lang)
-            else:
-                print('an unknown error occured while trying to download the prefix \
-                       file for the lang %s' % lang)
-
-    tokenizer_cmd = [tok_dest, '-l', 'en', '-q', '-']
+def tokenize(sentences, lang="en", workers=1):
+    """
+    Tokenizes sentences with the Moses rules (see
+    `cutils.data_interface.tokenizer`)
+
+    :type sentences: iterable(strings)
+    :param sentences: The sentences to be tokenized
+
+    :type workers: int
+    :param workers: The number of processes used for tokenization
+
+    :returns: A list of tokenized sentences
+    """
+    from cutils.data_interface.tokenizer import tokenize_lines
     print('tokenizing...')
-    text = '\n'.join(sentences)
-    tokenizer = Popen(tokenizer_cmd, stdin=PIPE, stdout=PIPE)
-    tok_text, _ = tokenizer.communicate(text)
-    toks = tok_text.split('\n')[:-1]
+    toks = list(tokenize_lines(sentences, lang, workers=workers))
     print('done tokenizing')
 
     return toks
 
 
+def iter_chunks(iterable, chunk_size):
+    """
+    Splits an iterable into lists of (at most) chunk_size items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def list_directory(dirpath, pattern='*.txt'):
+    """
+    Returns the sorted absolute paths of the files in a directory that
+    match a glob pattern
+    """
+    return sorted(glob.glob(os.path.join(os.path.abspath(dirpath), pattern)))
+
+
+def read_file(path):
+    """
+    Returns the whole contents of a text file
+    """
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_files(paths, read=read_file, workers=8, max_in_flight=None):
+    """
+    Reads many (small) files concurrently with a pool of threads. The
+    results are yielded in the order of paths, no matter in which order
+    the reads complete
+
+    :type paths: list(string)
+    :param paths: The files to be read
+
+    :type read: function
+    :param read: Called with the path of each file, returns the result for
+        that file. Runs in the worker threads
+
+    :type workers: int
+    :param workers: The number of reader threads
+
+    :type max_in_flight: int
+    :param max_in_flight: The maximum number of files being read (or read
+        but not consumed yet) at a time. Defaults to 4 * workers
+    """
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for path in paths:
+            pending.append(pool.apply_async(read, (path,)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_directory(dirpath, pattern='*.txt', read=read_file, workers=8,
+                   max_in_flight=None):
+    """
+    Reads the files of a directory that match a glob pattern, in sorted
+    order, with `read_files`. No os.chdir is involved, so this is safe to
+    use from several threads
+    """
+    return read_files(list_directory(dirpath, pattern), read, workers,
+                      max_in_flight)
+
+
 def lowercase(sentences):
     return [s.lower() for s in sentences]
 
@@ -104,8 +258,58 @@ def remove_unk(x, n_words):
     return [[1 if w >= n_words else w for w in sen] for sen in x]
 
 
-def len_argsort(seq):
-    return sorted(range(len(seq)), key=lambda x: len(seq[x]))
+def sequence_lengths(seqs):
+    """
+    Returns the lengths of some sequences as an int64 array. RaggedCorpus
+    and IndexView already store them, other sequences are measured once
+    """
+    if hasattr(seqs, 'lengths'):
+        return numpy.asarray(seqs.lengths(), dtype='int64')
+    return numpy.fromiter((len(s) for s in seqs), dtype='int64',
+                          count=len(seqs))
+
+
+def len_argsort(seq, *others):
+    """
+    Returns the indices that sort some sequences by length. The sort is
+    stable, so sequences of equal length keep their order
+
+    :type seq: list, RaggedCorpus or IndexView
+    :param seq: The sequences to be sorted
+
+    :type others: list, RaggedCorpus or IndexView
+    :param others: Parallel sequences (eg. the targets of a translation
+        corpus) whose lengths break the ties, in order
+
+    :returns: An int64 array of indices
+    """
+    if not others:
+        # mergesort is numpy's stable sort
+        return numpy.argsort(sequence_lengths(seq), kind='mergesort')
+    # lexsort sorts on the last key first
+    keys = [sequence_lengths(s) for s in (seq,) + others]
+    return numpy.lexsort(keys[::-1])
+
+
+def sort_by_len(whole, n_keys=1):
+    """
+    Reorders a dataset by the lengths of its sequences. Each part is
+    gathered in one go, eg. a RaggedCorpus with a single `take`
+
+    :type whole: tuple
+    :param whole: Parallel sequences with one item per sample, eg. (x, y)
+
+    :type n_keys: int
+    :param n_keys: The number of leading parts of whole whose lengths make
+        the sort key, eg. 2 to sort (src, tgt) pairs on (src_len, tgt_len)
+
+    :returns: A tuple with the reordered parts, in the type of their
+        original storage
+    """
+    from cutils.data_interface.views import IndexView
+    sorted_index = len_argsort(*whole[:n_keys])
+    return tuple(IndexView(data, sorted_index).materialize()
+                 for data in whole)
 
 
 def download_dataset(dataset_path, origin):
@@ -117,17 +321,24 @@ def download_dataset(dataset_path, origin):
         raise Exception("could not download the dataset from %s" % origin)
 
 
-def create_subset(whole, small_portion, shuffle=True):
-    whole_x, whole_y = whole
-    n_samples = len(whole_x)
-    if shuffle:
-        # todo: seed required here
-        sidx = numpy.random.permutation(n_samples)
-    else:
-        sidx = numpy.arange(n_samples)
-    n_large = int(numpy.round(n_samples * (1 - small_portion)))
-    small_x = [whole_x[s] for s in sidx[n_large:]]
-    small_y = [whole_y[s] for s in sidx[n_large:]]
-    large_x = [whole_x[s] for s in sidx[:n_large]]
-    large_y = [whole_y[s] for s in sidx[:n_large]]
-    return (large_x, large_y), (small_x, small_y)
+def create_subset(whole, small_portion, shuffle=True, seed=None):
+    """
+    Splits a dataset in two, eg. to hold out a validation set. The parts
+    are `IndexView`s of the original data, nothing is copied
+
+    :type whole: tuple
+    :param whole: The (x, y) sequences of the dataset
+
+    :type small_portion: float
+    :param small_portion: The proportion of the samples in the second part
+
+    :type seed: int
+    :param seed: Seeds the permutation. If None, the global numpy
+        generator is used
+
+    :returns: ((large_x, large_y), (small_x, small_y))
+    """
+    from cutils.data_interface.views import split_dataset
+    large, small = split_dataset(whole, [1 - small_portion, small_portion],
+                                 shuffle, seed)
+    return large, small
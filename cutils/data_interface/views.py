@@ -0,0 +1,133 @@
+"""
+Lightweight subsets of datasets, used to split them without copying
+"""
+import numpy
+
+
+class IndexView(object):
+    """
+    The items of a parent dataset at some indices. Nothing is copied: the
+    items are read from the parent when they are accessed, and batches are
+    gathered straight from the parent storage.
+
+    The parent can be a RaggedCorpus, a numpy array or a list (eg. of
+    labels). A view of a view refers to the original parent directly.
+    """
+
+    def __init__(self, parent, indices):
+        """
+        :type parent: RaggedCorpus, numpy.ndarray or list
+        :param parent: The dataset to take items from
+
+        :type indices: numpy.ndarray
+        :param indices: The indices of the items in parent
+        """
+        indices = numpy.asarray(indices, dtype='int64').reshape((-1,))
+        if isinstance(parent, IndexView):
+            indices = parent.indices[indices]
+            parent = parent.parent
+        self.parent = parent
+        self.indices = indices
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, idx):
+        """
+        An integer returns one item of the parent. Anything else (a slice
+        or an array of indices) returns another view
+        """
+        if isinstance(idx, (int, numpy.integer)):
+            return self.parent[self.indices[idx]]
+        return IndexView(self.parent, self.indices[idx])
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.parent[i]
+
+    def take(self, idx):
+        """
+        Gathers some items into new storage of the parent's type
+
+        :type idx: numpy.ndarray
+        :param idx: Indices into the view
+        """
+        parent_idx = self.indices[numpy.asarray(idx, dtype='int64')]
+        if isinstance(self.parent, numpy.ndarray):
+            return self.parent[parent_idx]
+        if hasattr(self.parent, 'take'):
+            return self.parent.take(parent_idx)
+        return [self.parent[i] for i in parent_idx]
+
+    def materialize(self):
+        """
+        Returns a copy of the whole view in the parent's type
+        """
+        return self.take(numpy.arange(len(self)))
+
+    def lengths(self):
+        """
+        Returns the lengths of the sequences in the view as an int64 array
+        """
+        if hasattr(self.parent, 'lengths'):
+            return self.parent.lengths()[self.indices]
+        return numpy.asarray([len(self.parent[i]) for i in self.indices],
+                             dtype='int64')
+
+    def pad_and_mask(self, idx=None, labels=None, maxlen=None, buf=None):
+        """
+        Creates the padded (T x N) batch and mask for some sequences of the
+        view, gathering them straight from the parent
+
+        :returns: (x, x_mask, labels), as with `pad_and_mask`
+        """
+        parent_idx = self.indices if idx is None else \
+            self.indices[numpy.asarray(idx, dtype='int64')]
+        if hasattr(self.parent, 'pad_and_mask'):
+            return self.parent.pad_and_mask(parent_idx, labels, maxlen, buf)
+        from cutils.data_interface.utils import pad_and_mask
+        return pad_and_mask([self.parent[i] for i in parent_idx], labels,
+                            maxlen)
+
+
+def split_indices(n_samples, portions, shuffle=True, seed=None):
+    """
+    Splits range(n_samples) into consecutive parts of some sizes, after an
+    optional permutation
+
+    :type portions: list(float)
+    :param portions: The proportions of the samples in each part. They
+        should add up to 1
+
+    :type shuffle: bool
+    :param shuffle: Permute the samples before splitting
+
+    :type seed: int
+    :param seed: Seeds the permutation. If None, the global numpy
+        generator is used
+
+    :returns: A list of index arrays, one per part
+    """
+    if shuffle:
+        rng = numpy.random if seed is None else \
+            numpy.random.RandomState(seed)
+        sidx = rng.permutation(n_samples)
+    else:
+        sidx = numpy.arange(n_samples)
+    bounds = [int(numpy.round(n_samples * p))
+              for p in numpy.cumsum(portions)[:-1]]
+    return numpy.split(sidx, bounds)
+
+
+def split_dataset(whole, portions, shuffle=True, seed=None):
+    """
+    Splits a dataset into k parts made of views
+
+    :type whole: tuple
+    :param whole: Parallel sequences with one item per sample, eg. (x, y)
+
+    :returns: A list with one tuple of IndexViews (one per sequence in
+        whole) for each part
+    """
+    parts = split_indices(len(whole[0]), portions, shuffle, seed)
+    return [tuple(IndexView(data, idx) for data in whole) for idx in parts]
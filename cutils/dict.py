@@ -2,19 +2,245 @@
 Contains the dictionary class which is responible for maintaining the
 vocabulary and word embeddings
 """
-#TODO: The noise distribution gets created even for models that don't use it.
 #TODO: The lock function is not being used
 
 from __future__ import print_function
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+import itertools
+import multiprocessing
+import os
 
 import numpy
 import theano
+from six.moves import map
 
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.utils import iter_chunks
 from cutils.params.utils import init_tparams
 from cutils.numeric import numpy_floatX
 
 
+# The integer ids 0 and 1 are reserved for these
+SPECIAL_WORDS = ['<PAD>', '<UNK>']
+
+
+def iter_lines(paths):
+    """
+    Streams over the lines of several text files, one after the other
+    """
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                yield line
+
+
+def count_words(sentences, wordcount=None):
+    """
+    Counts the (whitespace separated) words in a stream of sentences
+
+    :type sentences: iterable(strings)
+    :param sentences: The sentences to count words in
+
+    :type wordcount: collections.Counter
+    :param wordcount: Existing counts to be updated
+
+    :returns: A collections.Counter
+    """
+    if wordcount is None:
+        wordcount = Counter()
+    for ss_ in sentences:
+        wordcount.update(ss_.split())
+    return wordcount
+
+
+def shard_files(paths, n_shards):
+    """
+    Splits text files into byte ranges of roughly equal size
+
+    :type paths: list(string)
+    :param paths: The text files to split
+
+    :type n_shards: int
+    :param n_shards: The approximate number of shards to create
+
+    :returns: A list of (path, start, end) tuples
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    shard_size = max(1, -(-sum(sizes) // n_shards))
+    shards = []
+    for path, size in zip(paths, sizes):
+        for start in range(0, size, shard_size):
+            shards.append((path, start, min(size, start + shard_size)))
+    return shards
+
+
+def _count_shard(shard):
+    """
+    Counts the words in a byte range of a file. A line belongs to the
+    shard in which it starts. The shard is a (path, start, end, eos)
+    tuple, see `Dict.from_files` for eos
+    """
+    path, start, end, eos = shard
+    wordcount = Counter()
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line that started in the previous shard
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not isinstance(line, str):
+                line = line.decode('utf-8')
+            wordcount.update(line.split())
+            if eos is not None:
+                wordcount[eos] += 1
+    return wordcount
+
+
+def encode_lines(worddict, lines):
+    """
+    Maps a block of (whitespace tokenized) lines to integer ids. Words
+    that are not in worddict are mapped to UNK (1)
+
+    :type worddict: dict
+    :param worddict: The word to id mapping
+
+    :type lines: list(string)
+    :param lines: The lines to encode
+
+    :returns: A (tokens, lengths) tuple of int32 and int64 arrays
+    """
+    words = []
+    lengths = numpy.zeros((len(lines),), dtype='int64')
+    for i, line in enumerate(lines):
+        line = line.split()
+        words.extend(line)
+        lengths[i] = len(line)
+    return encode_words(worddict, words), lengths
+
+
+def encode_words(worddict, words):
+    """
+    Maps a list of words to an int32 array of ids, with UNK (1) for the
+    words that are not in worddict
+    """
+    return numpy.fromiter(
+        map(worddict.get, words, itertools.repeat(1, len(words))),
+        dtype='int32', count=len(words))
+
+
+# The vocabulary used by the encode_batch worker processes. It is
+# inherited when the workers are forked, so it is not pickled per task.
+_WORKER_WORDDICT = None
+
+
+def _encode_chunk(lines):
+    return encode_lines(_WORKER_WORDDICT, lines)
+
+
+class AliasSampler(object):
+    """
+    Draws samples from a discrete distribution in O(1) per draw with the
+    alias method (Vose's variant). Each outcome i owns a column that is
+    kept with probability prob[i] and otherwise gives way to alias[i], so a
+    draw is one uniform column index and one uniform coin flip.
+    """
+
+    def __init__(self, probs, power=1.):
+        """
+        :type probs: numpy.ndarray
+        :param probs: The (unnormalized) probability of every outcome
+
+        :type power: float
+        :param power: Smooths the distribution by raising the probabilities
+            to this power before normalizing them, eg. 0.75
+        """
+        probs = numpy.asarray(probs, dtype='float64') ** power
+        self.probs = probs / probs.sum()
+        n = self.probs.shape[0]
+        # Plain lists are much faster than numpy scalars in this loop
+        scaled = (self.probs * n).tolist()
+        prob = [1.] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.]
+        large = [i for i, p in enumerate(scaled) if p >= 1.]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1. - scaled[less]
+            if scaled[more] < 1.:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1 up to rounding errors, and keeps prob 1
+        self.prob = numpy.asarray(prob, dtype='float64')
+        self.alias = numpy.asarray(alias, dtype='int64')
+
+    def sample(self, size, rng=None):
+        """
+        Draws an array of samples
+
+        :type size: int or tuple
+        :param size: The shape of the output
+
+        :type rng: numpy.random.RandomState
+        :param rng: Defaults to the global numpy generator
+
+        :returns: An int32 array of outcomes
+        """
+        rng = numpy.random if rng is None else rng
+        column = rng.randint(0, self.prob.shape[0], size=size)
+        keep = rng.random_sample(size) < self.prob[column]
+        return numpy.where(keep, column, self.alias[column]).astype('int32')
+
+    def sample_batch(self, batch_size, k, shared=False, rng=None):
+        """
+        Draws k noise samples for every example of a batch
+
+        :type shared: bool
+        :param shared: Draw a single set of k samples used by the whole
+            batch, which lets the model score them with one matrix product
+
+        :returns: A (batch_size x k) int32 matrix, or a vector of k samples
+            if shared
+        """
+        if shared:
+            return self.sample((k,), rng)
+        return self.sample((batch_size, k), rng)
+
+    def sample_candidates(self, k, targets, rng=None):
+        """
+        Draws the candidate set of a batch for sampled softmax: k samples
+        shared by the whole batch, plus the true targets of the batch
+
+        :type k: int
+        :param k: The number of samples drawn (with replacement)
+
+        :type targets: numpy.ndarray
+        :param targets: The true words of the batch, any shape
+
+        :returns: (candidates, log_q). The sorted unique candidates (int32)
+            and the log of their expected number of occurrences in the k
+            draws, which corrects the logits for the sampling (floatX)
+        """
+        samples = self.sample((k,), rng)
+        candidates = numpy.unique(numpy.concatenate(
+            [samples, numpy.asarray(targets, dtype='int32').ravel()]))
+        q = self.probs[candidates]
+        with numpy.errstate(divide='ignore'):
+            expected_count = -numpy.expm1(k * numpy.log1p(-q))
+        # Targets that can never be sampled (eg. PAD) are only in the set
+        # because they are targets, and are not corrected
+        expected_count[q == 0] = 1.
+        return candidates, numpy_floatX(numpy.log(expected_count))
+
+
 class Dict(object):
     """
     The dictionary is responsible for reading text and converting them into
@@ -30,9 +256,10 @@ class Dict(object):
         """
         Initializes a dictionary.
 
-        :type sentences: list(strings)
-        :param sentences: A list of sentences (text) to
-            initialize the vocabulary
+        :type sentences: iterable(strings)
+        :param sentences: The sentences (text) to initialize the
+            vocabulary. Any iterable works, including a generator or an open
+            file; it is only streamed over once
 
         :type n_words : int
         :param n_words : The number of words to retain in the vocab. Less
@@ -43,42 +270,162 @@ class Dict(object):
         :param emb_dim: The dimensionality for the word embeddings
         """
         self.locked = False
-        wordcount = dict()
-        for ss_ in sentences:
-            words = ss_.strip().split()
-            for word in words:
-                if word not in wordcount:
-                    wordcount[word] = 0
-                wordcount[word] += 1
-        counts = wordcount.values()
-        keys = wordcount.keys()
-        self.worddict = dict()
-        self.reverse_worddict = dict()
-        self.worddict['<UNK>'] = 1
-        self.reverse_worddict[1] = '<UNK>'
-        self.worddict['<PAD>'] = 0
-        self.reverse_worddict[0] = '<PAD>'
-        # Reverse and truncate at max_words
-        sorted_idx = numpy.argsort(counts)[::-1][:n_words]
-        dict_idx = 2
-        for ss_ in sorted_idx:
-            if keys[ss_] == '<UNK>':
-                continue
-            self.worddict[keys[ss_]] = dict_idx
-            self.reverse_worddict[dict_idx] = keys[ss_]
-            dict_idx += 1
+        self.build_vocab(count_words(sentences), n_words)
+        self.set_embedding_size(emb_dim)
+
+    @classmethod
+    def from_files(cls, paths, n_words, emb_dim, workers=1, eos=None):
+        """
+        Creates a dictionary by streaming over the lines of text files
+
+        :type paths: list(string)
+        :param paths: The text files to read, one sentence per line
+
+        :type workers: int
+        :param workers: The number of processes used to count words. With
+            more than one, the files are split into byte ranges which are
+            counted in parallel and merged. The vocabulary is identical to
+            the one built by a single process
+
+        :type eos: string
+        :param eos: A token counted once per line, for text that is read
+            with an end of sentence token after every line
+        """
+        if workers <= 1:
+            lines = iter_lines(paths)
+            if eos is not None:
+                lines = (line + ' ' + eos for line in lines)
+            return cls(lines, n_words, emb_dim)
+        pool = multiprocessing.Pool(workers)
+        try:
+            partial_counts = pool.map(
+                _count_shard, [shard + (eos,) for shard
+                               in shard_files(paths, 4 * workers)])
+        finally:
+            pool.close()
+            pool.join()
+        wordcount = Counter()
+        for counts in partial_counts:
+            wordcount.update(counts)
+        return cls.from_counts(wordcount, n_words, emb_dim)
 
+    @classmethod
+    def from_counts(cls, wordcount, n_words, emb_dim):
+        """
+        Creates a dictionary from precomputed word counts
+
+        :type wordcount: dict
+        :param wordcount: A dictionary containing frequency counts for words
+        """
+        dictionary = cls.__new__(cls)
+        dictionary.locked = False
+        dictionary.build_vocab(wordcount, n_words)
+        dictionary.set_embedding_size(emb_dim)
+        return dictionary
+
+    def build_vocab(self, wordcount, n_words):
+        """
+        Retains the n_words most frequent words as the vocabulary. Words
+        with equal counts are ordered alphabetically so the same counts
+        always produce the same vocabulary
+
+        :type wordcount: dict
+        :param wordcount: A dictionary containing frequency counts for words
+
+        :type n_words : int
+        :param n_words : The number of words to retain in the vocab
+        """
+        keys = [k for k in wordcount if k not in SPECIAL_WORDS]
+        counts = numpy.fromiter((wordcount[k] for k in keys), dtype='int64',
+                                count=len(keys))
+        total = sum(wordcount.values())
+        n_retained = min(n_words, len(keys))
+        if 0 < n_retained < len(keys):
+            # Partial sort: the words more frequent than the last retained
+            # one all make the cut. Of the words tied with it, which can be
+            # most of the vocab on Zipfian data, the first ones
+            # alphabetically are retained
+            threshold = counts[numpy.argpartition(
+                -counts, n_retained - 1)[n_retained - 1]]
+            retained = numpy.flatnonzero(counts > threshold)
+            tied = numpy.flatnonzero(counts == threshold)
+            tied_keys = numpy.array([keys[i] for i in tied])
+            tied = tied[numpy.argsort(tied_keys, kind='mergesort')
+                        [:n_retained - len(retained)]]
+        else:
+            retained = numpy.arange(n_retained)
+            tied = retained[:0]
+        ret_keys = numpy.array([keys[i] for i in retained])
+        order = numpy.lexsort((ret_keys, -counts[retained]))
+        # The tied words have the lowest count and are already sorted
+        retained = numpy.concatenate([retained[order], tied])
+        words = SPECIAL_WORDS + [keys[i] for i in retained]
+        freq = numpy.concatenate([[0, 0], counts[retained]])
+        # Everything that was not retained is mapped to UNK
+        freq[1] = total - freq.sum()
+
+        self.set_vocab(words, freq)
+
+        print("Total words read by dict = %d" % total)
+        print("Total unique words read by dict = %d" % len(wordcount))
+        print("Total words retained = %d" % len(self.worddict))
+
+    @classmethod
+    def from_vocab(cls, words, freq, emb_dim):
+        """
+        Creates a dictionary from an existing vocabulary, without reading
+        any text
+
+        :type words: list(string)
+        :param words: The words in the vocab, ordered by their integer ids.
+            The first two entries are expected to be <PAD> and <UNK>
+
+        :type freq: numpy.ndarray
+        :param freq: The frequency counts for each word in the vocab
+
+        :type emb_dim: int
+        :param emb_dim: The dimensionality for the word embeddings
+        """
+        dictionary = cls.__new__(cls)
+        dictionary.locked = False
+        dictionary.set_vocab(words, freq)
+        dictionary.set_embedding_size(emb_dim)
+        return dictionary
+
+    def set_vocab(self, words, freq):
+        """
+        Sets the vocabulary and creates the noise distribution for it
+
+        :type words: list(string)
+        :param words: The words in the vocab, ordered by their integer ids
+
+        :type freq: numpy.ndarray
+        :param freq: The frequency counts for each word in the vocab
+        """
+        self.worddict = dict(zip(words, range(len(words))))
+        self.reverse_worddict = dict(enumerate(words))
+        # Array-backed reverse vocab, converts whole batches with one
+        # fancy-index
+        self.word_array = numpy.empty((len(words),), dtype=object)
+        self.word_array[:] = words
         self.n_words = len(self.worddict)
+        self.word_freq = numpy.asarray(freq, dtype='int64')
 
-        self.noise_distribution = None
-        self.create_unigram_noise_dist(wordcount)
+        # The noise distribution and its sampler are created on demand,
+        # only models trained with NCE need them
+        self.noise_power = 1.
+        self._noise_distribution = None
+        self._noise_sampler = None
 
         self.locked = True
 
-        print("Total words read by dict = %d" % numpy.sum(counts))
-        print("Total unique words read by dict = %d" % len(keys))
-        print("Total words retained = %d" % len(self.worddict))
+    def set_embedding_size(self, emb_dim):
+        """
+        Initializes random word embeddings of the given size
 
+        :type emb_dim: int
+        :param emb_dim: The dimensionality for the word embeddings
+        """
         self.embedding_size = emb_dim
         w_emb = self.initialize_embedding()
         params = OrderedDict()
@@ -86,25 +433,130 @@ class Dict(object):
         self.params = params
         self.tparams = init_tparams(params)
 
-    def create_unigram_noise_dist(self, wordcount):
+    def vocab(self):
         """
-        Creates a Unigram noise distribution for NCE
+        Returns the words in the vocabulary, ordered by their integer ids
 
-        :type wordcount: dict
-        :param wordcount: A dictionary containing frequency counts for words
+        :returns: A list of strings
+        """
+        return self.word_array.tolist()
+
+    def save(self, path, include_embedding=True):
+        """
+        Writes the vocabulary, word frequencies (which define the noise
+        distribution) and optionally the embeddings to a .npz archive.
+        The words are stored as a single newline separated byte string,
+        so no pickling is involved
+
+        :type path: string
+        :param path: The file to write to
+
+        :type include_embedding: bool
+        :param include_embedding: Store the current word embeddings as well
+        """
+        words = '\n'.join(self.vocab())
+        if not isinstance(words, bytes):
+            words = words.encode('utf-8')
+        arrays = dict(words=numpy.frombuffer(words, dtype='uint8'),
+                      freq=self.word_freq,
+                      emb_dim=numpy.asarray(self.embedding_size))
+        if include_embedding:
+            arrays['Wemb'] = self.tparams['Wemb'].get_value()
+        with open(path, 'wb') as f:
+            numpy.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path, emb_dim=None):
+        """
+        Creates a dictionary from an archive written by `save`. The corpus
+        is not read at all
+
+        :type path: string
+        :param path: The file to read from
+
+        :type emb_dim: int
+        :param emb_dim: The dimensionality for the word embeddings. Only
+            used when the archive has no embeddings. Defaults to the stored
+            dimensionality
+
+        :returns: A Dict
         """
-        counts = numpy.sort(wordcount.values())[::-1]
-        # Don't count the UNK and PAD symbols in the second count
-        freq = [0, sum(counts[self.n_words:])] \
-            + list(counts[:(self.n_words-2)])
+        # Each member is read into memory, so the file can be closed
+        # before the dictionary is built
+        with numpy.load(path) as archive:
+            words = archive['words'].tobytes()
+            freq = archive['freq']
+            if emb_dim is None:
+                emb_dim = int(archive['emb_dim'])
+            Wemb = archive['Wemb'] if 'Wemb' in archive else None
+        if not isinstance(words, str):
+            words = words.decode('utf-8')
+        dictionary = cls.__new__(cls)
+        dictionary.locked = False
+        dictionary.set_vocab(words.split('\n'), freq)
+        if Wemb is not None:
+            dictionary.embedding_size = Wemb.shape[1]
+            dictionary.params = OrderedDict([('Wemb', Wemb)])
+            dictionary.tparams = init_tparams(dictionary.params)
+        else:
+            dictionary.set_embedding_size(emb_dim)
+        return dictionary
+
+    def create_unigram_noise_dist(self, freq):
+        """
+        Creates a Unigram noise distribution for NCE, smoothed with
+        noise_power
+
+        :type freq: numpy.ndarray
+        :param freq: The frequency counts for each word in the vocab.
+            The count for PAD is ignored
+        """
+        freq = numpy.array(freq, dtype='float64')
         assert len(freq) == self.n_words
-        sum_freq = sum(freq)
-        noise_distribution = [float(k) / sum_freq for k in freq]
-        self.noise_distribution = init_tparams(
+        # PAD is never sampled
+        freq[0] = 0
+        noise_distribution = freq ** self.noise_power
+        noise_distribution /= noise_distribution.sum()
+        self._noise_distribution = init_tparams(
             OrderedDict([('noise_d', numpy_floatX(noise_distribution)
                           .reshape(self.n_words,))])
         )['noise_d']
 
+    @property
+    def noise_distribution(self):
+        """
+        The unigram noise distribution for NCE, as a shared variable
+        """
+        if self._noise_distribution is None:
+            self.create_unigram_noise_dist(self.word_freq)
+        return self._noise_distribution
+
+    @property
+    def noise_sampler(self):
+        """
+        An AliasSampler drawing words from the noise distribution
+        """
+        if self._noise_sampler is None:
+            freq = numpy.array(self.word_freq, dtype='float64')
+            freq[0] = 0
+            self._noise_sampler = AliasSampler(freq, self.noise_power)
+        return self._noise_sampler
+
+    def set_noise_power(self, power):
+        """
+        Smooths the noise distribution (and its sampler) by raising the
+        unigram frequencies to a power, eg. 0.75. A noise distribution that
+        was already created is updated in place
+        """
+        self.noise_power = power
+        self._noise_sampler = None
+        if self._noise_distribution is not None:
+            noise_distribution = self._noise_distribution
+            self.create_unigram_noise_dist(self.word_freq)
+            noise_distribution.set_value(
+                self._noise_distribution.get_value())
+            self._noise_distribution = noise_distribution
+
     def initialize_embedding(self):
         """
         Initializes the word embeddings from a uniform distribution
@@ -125,8 +577,48 @@ class Dict(object):
 
         :returns: A list of lists. Each nested list contains an integerized sequence.
         """
-        line = line.strip().split()
-        return [self.worddict[w] if w in self.worddict else 1 for w in line]
+        get = self.worddict.get
+        return [get(w, 1) for w in line.split()]
+
+    def encode_batch(self, lines, workers=1, chunk_size=10000):
+        """
+        Converts a block of sentences (text) into integer tokens in one go.
+        Unknown words are mapped to UNK
+
+        :type lines: iterable(strings)
+        :param lines: The sentences to be read. Any iterable works,
+            including an open file; it is only streamed over once
+
+        :type workers: int
+        :param workers: The number of processes used for encoding. With
+            more than one, chunks of lines are encoded in parallel (the
+            order of the sentences is kept)
+
+        :type chunk_size: int
+        :param chunk_size: The number of lines encoded at a time
+
+        :returns: A RaggedCorpus of int32 tokens, one sequence per line
+        """
+        chunks = iter_chunks(lines, chunk_size)
+        if workers <= 1:
+            encoded = [encode_lines(self.worddict, chunk) for chunk in chunks]
+        else:
+            global _WORKER_WORDDICT
+            _WORKER_WORDDICT = self.worddict
+            pool = multiprocessing.Pool(workers)
+            try:
+                encoded = list(pool.imap(_encode_chunk, chunks))
+            finally:
+                _WORKER_WORDDICT = None
+                pool.close()
+                pool.join()
+        if not encoded:
+            return RaggedCorpus.from_sequences([])
+        lengths = numpy.concatenate([l for _, l in encoded])
+        offsets = numpy.zeros((lengths.shape[0] + 1,), dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+        return RaggedCorpus(numpy.concatenate([t for t, _ in encoded]),
+                            offsets)
 
     def num_words(self):
         """
@@ -136,20 +628,25 @@ class Dict(object):
         """
         return self.n_words
 
-    def idx_to_words(self, idx_arr):
+    def idx_to_words(self, idx_arr, stop_at=None):
         """
         Converts a matrix of integers into string tokens
 
         :type idx_array: numpy.ndarray
         :param idx_array: A T x N matrix. Each column is a sentence. Each row is a time step.
 
+        :type stop_at: list(int)
+        :param stop_at: Token ids (eg. EOS or PAD) that end a sentence. Each
+            column is cut before the first of these tokens
+
         :returns: A list of word representations (string) for the cols in the input
         """
-        results = []
-        for col in idx_arr.T:
-            sentence = []
-            for k in col:
-                sentence.append(self.reverse_worddict[k])
-            results.append(" ".join(sentence))
-
-        return results
+        idx_arr = numpy.asarray(idx_arr)
+        sentences = self.word_array[idx_arr.T]
+        if stop_at is None:
+            return [" ".join(sentence) for sentence in sentences]
+        stopped = numpy.isin(idx_arr, stop_at)
+        lengths = numpy.where(stopped.any(axis=0), stopped.argmax(axis=0),
+                              idx_arr.shape[0])
+        return [" ".join(sentence[:length])
+                for sentence, length in zip(sentences, lengths)]
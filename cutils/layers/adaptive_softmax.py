@@ -0,0 +1,198 @@
+"""
+Adaptive softmax output layer (Grave et al., 2017) for Zipfian vocabularies
+"""
+from collections import OrderedDict
+
+import numpy
+import theano
+import theano.tensor as T
+
+from cutils.layers.hierarchical_softmax import frequency_ranks
+from cutils.numeric import numpy_floatX
+from cutils.params.init import norm_init
+from cutils.params.utils import init_tparams
+
+
+def default_cutoffs(n_words, cutoffs=(2000, 10000, 50000)):
+    """
+    Returns the cluster boundaries that fall inside a vocabulary of
+    n_words, eg. [2000, 10000] for 20000 words
+    """
+    return [c for c in cutoffs if c < n_words]
+
+
+class AdaptiveSoftmax(object):
+    """
+    Softmax over a vocabulary split by frequency into a head and tail
+    clusters. The head holds the most frequent words plus one token per
+    tail cluster, and the probability of a tail word is
+    p(cluster|x) * p(w|cluster, x).
+
+    Most of the text is made of head words, which need a single softmax
+    over the head. The tail clusters are scored from projections of the
+    input whose size shrinks with the frequency of the words, so the rare
+    words, which make up most of the vocabulary, are also the cheapest.
+    """
+
+    def __init__(self, word_freq, dim_input, cutoffs=None, div_value=4,
+                 prefix='adaptive'):
+        """
+        Initializes the parameters of the layer
+
+        :type word_freq: numpy.ndarray
+        :param word_freq: The frequency counts for each word in the vocab,
+            eg. `Dict.word_freq`
+
+        :type dim_input: int
+        :param dim_input: The dimensionality of the input
+
+        :type cutoffs: list(int)
+        :param cutoffs: The increasing frequency ranks where the clusters
+            start. The first cutoff is the size of the head, eg. [2000,
+            10000] gives a head of 2000 words, a cluster with the next 8000
+            words and a last cluster with the rest. Defaults to
+            `default_cutoffs`
+
+        :type div_value: int
+        :param div_value: The projection of cluster i has
+            dim_input / div_value ** i dimensions
+
+        :type prefix: string
+        :param prefix: The prefix of the parameter names
+        """
+        n_words = len(word_freq)
+        if cutoffs is None:
+            cutoffs = default_cutoffs(n_words)
+        cutoffs = list(cutoffs)
+        if cutoffs != sorted(set(cutoffs)) or (cutoffs and (
+                cutoffs[0] <= 0 or cutoffs[-1] >= n_words)):
+            raise ValueError('The cutoffs should be increasing and between 0 '
+                             'and the vocabulary size (%d)' % n_words)
+        bounds = cutoffs + [n_words]
+        self.n_words = n_words
+        self.n_clusters = len(cutoffs)
+        self.head_size = bounds[0]
+
+        rank = frequency_ranks(word_freq)
+        # Cluster 0 is the head
+        word_cluster = numpy.searchsorted(bounds, rank, side='right')
+        starts = numpy.asarray([0] + bounds[:-1])
+        self.word_cluster = T.constant(word_cluster.astype('int32'),
+                                       name='word_cluster')
+        self.word_pos = T.constant((rank - starts[word_cluster])
+                                   .astype('int32'), name='word_pos')
+        # The words are scored in the order of their ranks
+        self.word_rank = T.constant(rank, name='word_rank')
+
+        self.param_names = []
+        # The weight matrices, without the biases (eg. for regularization)
+        self.weight_names = []
+        params = OrderedDict()
+
+        params[_p(prefix, 'W_head')] = norm_init(
+            dim_input, self.head_size + self.n_clusters, ortho=False)
+        self.param_names.append(_p(prefix, 'W_head'))
+        self.weight_names.append(_p(prefix, 'W_head'))
+
+        params[_p(prefix, 'b_head')] = numpy_floatX(
+            numpy.zeros((self.head_size + self.n_clusters,)))
+        self.param_names.append(_p(prefix, 'b_head'))
+
+        for i in range(1, self.n_clusters + 1):
+            dim_proj = max(1, dim_input // div_value ** i)
+            size = bounds[i] - bounds[i - 1]
+
+            params[_p(prefix, 'P_%d' % i)] = norm_init(dim_input, dim_proj,
+                                                       ortho=False)
+            self.param_names.append(_p(prefix, 'P_%d' % i))
+            self.weight_names.append(_p(prefix, 'P_%d' % i))
+
+            params[_p(prefix, 'W_%d' % i)] = norm_init(dim_proj, size,
+                                                       ortho=False)
+            self.param_names.append(_p(prefix, 'W_%d' % i))
+            self.weight_names.append(_p(prefix, 'W_%d' % i))
+
+            params[_p(prefix, 'b_%d' % i)] = numpy_floatX(
+                numpy.zeros((size,)))
+            self.param_names.append(_p(prefix, 'b_%d' % i))
+
+        self.prefix = prefix
+        self.params = params
+        self.tparams = init_tparams(params)
+
+    def head_log_probs(self, input):
+        """
+        Returns the (N x (head_size + n_clusters)) log-probabilities of the
+        head words and of the tail clusters
+        """
+        return T.nnet.logsoftmax(
+            T.dot(input, self.tparams[_p(self.prefix, 'W_head')])
+            + self.tparams[_p(self.prefix, 'b_head')])
+
+    def cluster_log_probs(self, input, i):
+        """
+        Returns the log-probabilities of the words of tail cluster i given
+        the cluster, for every example of the input
+        """
+        proj = T.dot(input, self.tparams[_p(self.prefix, 'P_%d' % i)])
+        return T.nnet.logsoftmax(
+            T.dot(proj, self.tparams[_p(self.prefix, 'W_%d' % i)])
+            + self.tparams[_p(self.prefix, 'b_%d' % i)])
+
+    def log_prob(self, input, y):
+        """
+        Returns log p(y|x) for the true words only. A tail cluster is only
+        scored for the examples whose target is in it
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :type y: theano.tensor.TensorType
+        :param y: The vector of the N true words
+
+        :returns: A vector of N log-probabilities
+        """
+        y_cluster = self.word_cluster[y]
+        y_pos = self.word_pos[y]
+        # The target itself for head words and its cluster token otherwise
+        head_target = T.switch(T.eq(y_cluster, 0), y_pos,
+                               self.head_size + y_cluster - 1)
+        log_p = self.head_log_probs(input)[T.arange(y.shape[0]),
+                                           head_target]
+        for i in range(1, self.n_clusters + 1):
+            idx = T.eq(y_cluster, i).nonzero()[0]
+            log_p_word = self.cluster_log_probs(input[idx], i)[
+                T.arange(idx.shape[0]), y_pos[idx]]
+            log_p = T.inc_subtensor(log_p[idx], log_p_word)
+        return log_p
+
+    def log_prob_all(self, input):
+        """
+        Returns the log-probabilities of every word in the vocabulary, for
+        perplexity evaluation and decoding
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :returns: An (N x V) matrix
+        """
+        head = self.head_log_probs(input)
+        parts = [head[:, :self.head_size]]
+        for i in range(1, self.n_clusters + 1):
+            log_p_cluster = head[:, self.head_size + i - 1]
+            parts.append(self.cluster_log_probs(input, i)
+                         + log_p_cluster.dimshuffle(0, 'x'))
+        return T.concatenate(parts, axis=1)[:, self.word_rank]
+
+    def loss(self, input, y):
+        """
+        Returns the loss (negative-log-likelihood) over the mini-batch
+
+        :type y: theano.tensor.TensorType
+        :param y: The vector of true words for the input examples
+        """
+        return -T.mean(self.log_prob(input, y), dtype=theano.config.floatX)
+
+
+def _p(pp, name):
+    return '%s_%s' % (pp, name)
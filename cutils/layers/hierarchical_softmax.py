@@ -0,0 +1,194 @@
+"""
+Class-factored (two-level) softmax output layer for large vocabularies
+"""
+from collections import OrderedDict
+
+import numpy
+import theano
+import theano.tensor as T
+
+from cutils.numeric import numpy_floatX
+from cutils.params.init import norm_init
+from cutils.params.utils import init_tparams
+
+
+# Added to the logits of the unused slots of the last class. exp() of it
+# is 0, even in float16
+PAD_LOGIT = -1e4
+
+
+def frequency_ranks(word_freq):
+    """
+    Returns the rank of every word when the vocabulary is sorted by
+    decreasing frequency, as an int64 array. Words with equal counts keep
+    their vocab order
+    """
+    rank = numpy.empty((len(word_freq),), dtype='int64')
+    rank[numpy.argsort(-numpy.asarray(word_freq), kind='mergesort')] = \
+        numpy.arange(len(word_freq))
+    return rank
+
+
+def frequency_classes(word_freq, n_classes=None):
+    """
+    Bins the words of a vocabulary into classes by frequency: the
+    class_size most frequent words make up the first class, the next
+    class_size words the second one and so on. Every class but the last
+    has exactly class_size words
+
+    :type word_freq: numpy.ndarray
+    :param word_freq: The frequency counts for each word in the vocab, eg.
+        `Dict.word_freq`
+
+    :type n_classes: int
+    :param n_classes: The number of classes. Defaults to sqrt(V), which
+        minimizes the number of scores computed per word
+
+    :returns: (word_class, word_pos, class_size). The class of every word
+        and its position in the class, as int32 arrays
+    """
+    n_words = len(word_freq)
+    if n_classes is None:
+        n_classes = int(numpy.ceil(numpy.sqrt(n_words)))
+    class_size = -(-n_words // n_classes)
+    rank = frequency_ranks(word_freq)
+    word_class = (rank // class_size).astype('int32')
+    word_pos = (rank % class_size).astype('int32')
+    return word_class, word_pos, class_size
+
+
+class ClassFactoredSoftmax(object):
+    """
+    Softmax over a vocabulary factored into classes of words,
+    p(w|x) = p(class(w)|x) * p(w|class(w), x). Each factor is a softmax over
+    about sqrt(V) entries, so the probability of one word costs O(sqrt(V))
+    instead of O(V).
+
+    The classes all have the same size, so the word weights of all classes
+    are stored as a single (n_classes x dim_input x class_size) tensor
+    """
+
+    def __init__(self, word_freq, dim_input, n_classes=None,
+                 prefix='hsoftmax'):
+        """
+        Initializes the parameters of the layer
+
+        :type word_freq: numpy.ndarray
+        :param word_freq: The frequency counts for each word in the vocab,
+            used to create the classes (see `frequency_classes`)
+
+        :type dim_input: int
+        :param dim_input: The dimensionality of the input
+
+        :type n_classes: int
+        :param n_classes: The number of classes, defaults to sqrt(V)
+
+        :type prefix: string
+        :param prefix: The prefix of the parameter names
+        """
+        word_class, word_pos, class_size = frequency_classes(word_freq,
+                                                             n_classes)
+        self.n_words = len(word_freq)
+        self.n_classes = int(word_class.max()) + 1
+        self.class_size = class_size
+        # Where the words are in a flattened (n_classes x class_size) grid
+        self.word_class = T.constant(word_class, name='word_class')
+        self.word_pos = T.constant(word_pos, name='word_pos')
+        self.word_slot = T.constant(word_class * class_size + word_pos,
+                                    name='word_slot')
+        pad = numpy.zeros((self.n_classes * class_size,))
+        pad[self.n_words:] = PAD_LOGIT
+        self.pad = T.constant(numpy_floatX(pad.reshape((self.n_classes,
+                                                        class_size))),
+                              name='pad')
+
+        self.param_names = []
+        params = OrderedDict()
+
+        params[_p(prefix, 'W_class')] = norm_init(dim_input, self.n_classes,
+                                                  ortho=False)
+        self.param_names.append(_p(prefix, 'W_class'))
+
+        params[_p(prefix, 'b_class')] = numpy_floatX(
+            numpy.zeros((self.n_classes,)))
+        self.param_names.append(_p(prefix, 'b_class'))
+
+        params[_p(prefix, 'W_word')] = numpy_floatX(
+            0.01 * numpy.random.randn(self.n_classes, dim_input, class_size))
+        self.param_names.append(_p(prefix, 'W_word'))
+
+        params[_p(prefix, 'b_word')] = numpy_floatX(
+            numpy.zeros((self.n_classes, class_size)))
+        self.param_names.append(_p(prefix, 'b_word'))
+
+        self.prefix = prefix
+        self.params = params
+        self.tparams = init_tparams(params)
+
+    def class_log_probs(self, input):
+        """
+        Returns the (N x n_classes) log-probabilities of the classes
+        """
+        return T.nnet.logsoftmax(
+            T.dot(input, self.tparams[_p(self.prefix, 'W_class')])
+            + self.tparams[_p(self.prefix, 'b_class')])
+
+    def log_prob(self, input, y):
+        """
+        Returns log p(y|x) for the true words only. Only the classes and the
+        words in the class of each target are scored, which is all training
+        needs
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :type y: theano.tensor.TensorType
+        :param y: The vector of the N true words
+
+        :returns: A vector of N log-probabilities
+        """
+        rows = T.arange(y.shape[0])
+        y_class = self.word_class[y]
+        log_p_class = self.class_log_probs(input)[rows, y_class]
+        # N x class_size, the words of the class of each target
+        W_word = self.tparams[_p(self.prefix, 'W_word')][y_class]
+        b_word = self.tparams[_p(self.prefix, 'b_word')] + self.pad
+        word_logits = T.batched_dot(input, W_word) + b_word[y_class]
+        log_p_word = T.nnet.logsoftmax(word_logits)[rows, self.word_pos[y]]
+        return log_p_class + log_p_word
+
+    def log_prob_all(self, input):
+        """
+        Returns the log-probabilities of every word in the vocabulary. The
+        words of all classes are scored with a single matrix product, for
+        perplexity evaluation and decoding
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :returns: An (N x V) matrix
+        """
+        n_samples = input.shape[0]
+        W_word = self.tparams[_p(self.prefix, 'W_word')]
+        b_word = self.tparams[_p(self.prefix, 'b_word')] + self.pad
+        # dim_input x (n_classes * class_size)
+        W_flat = W_word.dimshuffle(1, 0, 2).reshape((W_word.shape[1], -1))
+        word_logits = T.dot(input, W_flat) + b_word.flatten()
+        log_p_word = T.nnet.logsoftmax(
+            word_logits.reshape((-1, self.class_size))
+        ).reshape((n_samples, self.n_classes, self.class_size))
+        log_p = log_p_word + self.class_log_probs(input).dimshuffle(0, 1, 'x')
+        return log_p.reshape((n_samples, -1))[:, self.word_slot]
+
+    def loss(self, input, y):
+        """
+        Returns the loss (negative-log-likelihood) over the mini-batch
+
+        :type y: theano.tensor.TensorType
+        :param y: The vector of true words for the input examples
+        """
+        return -T.mean(self.log_prob(input, y), dtype=theano.config.floatX)
+
+
+def _p(pp, name):
+    return '%s_%s' % (pp, name)
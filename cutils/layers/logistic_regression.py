@@ -1,9 +1,13 @@
+from collections import OrderedDict
+
 import theano
 import theano.tensor as T
 import numpy
 
 from cutils.loss_functions import negative_log_likelihood, zero_one_loss, \
-    nce_binary_conditional_likelihood
+    nce_binary_conditional_likelihood, \
+    sparse_nce_binary_conditional_likelihood
+from cutils.numeric import numpy_floatX
 from cutils.params.init import norm_init
 from cutils.params.utils import init_tparams
 from cutils.regularization import L1, L2
@@ -13,7 +17,8 @@ class LogisticRegression(object):
     Multi-class logistic regression
     """
 
-    def __init__(self, dim_proj, dim_input, prefix='logit', ortho=True):
+    def __init__(self, dim_proj, dim_input, prefix='logit', ortho=True,
+                 batch_normalize=False):
         """
         Initializes the parameters of a Logistic regression model
 
@@ -25,6 +30,11 @@ class LogisticRegression(object):
 
         :type n_out
         :param n_out: The dimensionality of the output (label) layer
+
+        :type batch_normalize: bool
+        :param batch_normalize: Create the batch normalization params used
+            by `logit_layer`. They are left out otherwise, as they would
+            get no gradient
         """
         # Initialize weight matrix with 0s. Size is n_in X n_out
         self.param_names = []
@@ -39,13 +49,14 @@ class LogisticRegression(object):
         self.param_names.append(_p(prefix, 'b'))
 
         # batch normalization params
-        gamma = numpy_floatX(numpy.ones((n_out,)))
-        params[_p(prefix, 'gamma')] = gamma
-        self.param_names.append(_p(prefix, 'gamma'))
+        if batch_normalize:
+            gamma = numpy_floatX(numpy.ones((dim_proj,)))
+            params[_p(prefix, 'gamma')] = gamma
+            self.param_names.append(_p(prefix, 'gamma'))
 
-        beta = numpy_floatX(numpy.ones((n_out,)))
-        params[_p(prefix, 'beta')] = beta
-        self.param_names.append(_p(prefix, 'beta'))
+            beta = numpy_floatX(numpy.ones((dim_proj,)))
+            params[_p(prefix, 'beta')] = beta
+            self.param_names.append(_p(prefix, 'beta'))
 
         self.prefix = prefix
         self.params = params
@@ -67,8 +78,8 @@ class LogisticRegression(object):
             # Apply batch normalization to the linear output
             bn_output = T.nnet.batch_normalization(
                 inputs=lin_output,
-                gamma=self.gamma,
-                beta=self.beta,
+                gamma=self.tparams[_p(self.prefix, 'gamma')],
+                beta=self.tparams[_p(self.prefix, 'beta')],
                 mean=lin_output.mean((0,), keepdims=True),
                 std=T.ones_like(lin_output.var((0,), keepdims=True)),
                 mode='high_mem'
@@ -78,6 +89,34 @@ class LogisticRegression(object):
         self.lin_output = lin_output
         return lin_output
 
+    def gather_logits(self, input, idx, shared=False):
+        """
+        Computes the logits of some classes only, from their columns of W
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :type idx: theano.tensor.TensorType
+        :param idx: The int classes to score for every example: a vector of
+            N classes or an (N x k) matrix
+
+        :type shared: bool
+        :param shared: idx is a vector of k classes scored for every example
+
+        :returns: The logits, with the shape of idx, or (N x k) if shared
+        """
+        W_t = self.tparams[_p(self.prefix, 'W')].T
+        b = self.tparams[_p(self.prefix, 'b')]
+        if shared:
+            # A single product with the k columns
+            return T.dot(input, W_t[idx].T) + b[idx]
+        if idx.ndim == 1:
+            return T.sum(W_t[idx] * input, axis=1) + b[idx]
+        # N x k x dim_input
+        W_idx = W_t[idx.flatten()].reshape((idx.shape[0], idx.shape[1],
+                                            W_t.shape[1]))
+        return T.sum(W_idx * input[:, None, :], axis=2) + b[idx]
+
 
     def loss(self, y):
         """
@@ -109,6 +148,32 @@ class LogisticRegression(object):
         return nce_binary_conditional_likelihood(
             self.lin_output, y, y_flat, noise_samples, noise_dist, k)
 
+    def sparse_nce_loss(self, input, y, noise_samples, noise_dist, k):
+        """
+        Returns the binary NCE loss for examples, only scoring the true
+        words and the noise samples instead of the whole vocabulary
+
+        :type input: theano.tensor.TensorType
+        :param input: The (N x dim_input) input batch
+
+        :type y: theano.tensor.TensorType
+        :param y: The true vectors correspoding to the input examples in this
+            batch
+
+        :type noise_samples: theano.tensor.TensorType
+        :param noise_samples: The (batch x k) int indices of the noise
+            samples drawn from the vocab, or a vector of k samples shared by
+            the whole batch
+
+        :type noise_dist: theano.tensor.TensorType
+        :param noise_dist: The noise distribution for NCE
+        """
+        return sparse_nce_binary_conditional_likelihood(
+            self.gather_logits(input, y),
+            self.gather_logits(input, noise_samples,
+                               shared=noise_samples.ndim == 1),
+            y, noise_samples, noise_dist, k)
+
     def errors(self, y):
         """
         Returns the 0-1 loss over the size of the mini-batch
@@ -41,9 +41,10 @@ class LSTM(object):
         params[_p(prefix, 'b')] = b.astype(theano.config.floatX)
         self.param_names.append(_p(prefix, 'b'))
 
-        # Memory of the last final hidden states
-        # TODO:Not archived
-        self.h_final = None
+        # The hidden state and LSTM context carried over from one batch to
+        # the next by stateful recurrences. Not archived
+        self.h_state = None
+        self.c_state = None
 
         self.dim_proj = dim_proj
 
@@ -55,6 +56,35 @@ class LSTM(object):
         for p in self.param_names:
             self.tparams[p] = tparams[p]
 
+    def reset_state(self, n_samples):
+        """
+        Zeroes the carried state of a stateful recurrence, for batches of
+        n_samples sequences
+        """
+        zeros = numpy.zeros((n_samples, self.dim_proj),
+                            dtype=theano.config.floatX)
+        if self.h_state is None:
+            self.h_state = theano.shared(zeros, name=_p(self.prefix,
+                                                        'h_state'))
+            self.c_state = theano.shared(zeros.copy(),
+                                         name=_p(self.prefix, 'c_state'))
+        else:
+            self.h_state.set_value(zeros)
+            self.c_state.set_value(zeros.copy())
+
+    def get_state(self):
+        """
+        Returns a copy of the carried (h, c) state
+        """
+        return self.h_state.get_value(), self.c_state.get_value()
+
+    def set_state(self, state):
+        """
+        Restores a state returned by `get_state`
+        """
+        self.h_state.set_value(state[0])
+        self.c_state.set_value(state[1])
+
     def lstm_layer(self, state_below, mask=None,
                    n_steps=None, output_to_input_func=None,
                    restore_final_to_initial_hidden=False):
@@ -71,14 +101,14 @@ class LSTM(object):
                   applied to the previous output and is then used as input
         output_to_input_func : The function to be applied to generate input
                                when partial input is available
-        restore_final_to_initial_hidden : Use the final hidden state as the initial
-                                  hidden state for the next batch
-                                  WARNING : Assumes that batches are of the
-                                  same size since the size of the initial
-                                  state is fixed to Nxd
-                                  TODO: Possibly think about averaging
-                                  final states to make this number of sample
-                                  independent
+        restore_final_to_initial_hidden : Use the final hidden state and
+                                  context as the initial ones for the next
+                                  batch. They are kept in shared variables
+                                  updated by every compiled function that
+                                  does not pass no_default_updates=True
+                                  WARNING : Assumes that the batches continue
+                                  each other and are of the size given to
+                                  `reset_state` (the number of streams)
         """
         # Make sure that we've initialized the tparams
         assert len(self.tparams) > 0
@@ -118,14 +148,20 @@ class LSTM(object):
             else:
                 mask = T.alloc(numpy_floatX(1.), n_samples)
 
-        # Initialize initial hidden state if not specified
-        # Restore final hidden state to new initial hidden state
-        if restore_final_to_initial_hidden and self.h_final is not None:
-            h0 = self.h_final
+        # Start from the final state of the previous batch when stateful,
+        # from zeros otherwise
+        if restore_final_to_initial_hidden:
+            if self.h_state is None:
+                self.reset_state(1)
+            h0 = self.h_state
+            c0 = self.c_state
         else:
             h0 = T.alloc(numpy_floatX(0.),
                          n_samples,
                          self.dim_proj)
+            c0 = T.alloc(numpy_floatX(0.),
+                         n_samples,
+                         self.dim_proj)
 
         def _slice(_x, n, dim):
             if _x.ndim == 3:
@@ -153,7 +189,7 @@ class LSTM(object):
             # Similar slices are used for the rest of the gates
             i = T.nnet.sigmoid(_slice(preact, 0, self.dim_proj))
             f = T.nnet.sigmoid(_slice(preact, 1, self.dim_proj))
-            o = T.nnet.sigmoid(_slice(preact, 2, self.im_proj))
+            o = T.nnet.sigmoid(_slice(preact, 2, self.dim_proj))
             c = T.tanh(_slice(preact, 3, self.dim_proj))
             c = f * c_ + i * c
             h = o * T.tanh(c)
@@ -180,16 +216,14 @@ class LSTM(object):
                        self.tparams[_p(self.prefix, 'b')])
         rval, updates = theano.scan(_step,
                                     sequences=[T.arange(nsteps)],
-                                    outputs_info=[h0,
-                                                  T.alloc(numpy_floatX(0.),
-                                                          n_samples,
-                                                          self.dim_proj)],
+                                    outputs_info=[h0, c0],
                                     non_sequences=[mask, state_below, state_below_raw],
                                     name=_p(self.prefix, '_layers'),
                                     n_steps=nsteps)
-        # Save the final state to be used as the next initial hidden state
+        # Save the final state to be used as the next initial state
         if restore_final_to_initial_hidden:
-            self.h_final = rval[0][-1]
+            self.h_state.default_update = rval[0][-1]
+            self.c_state.default_update = rval[1][-1]
 
         # Returns a list of the hidden states (t elements of N x dim_proj)
         return rval[0]
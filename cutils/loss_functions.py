@@ -87,3 +87,38 @@ def nce_binary_conditional_likelihood(p_unnormalized, y, y_flat,
                            / (p_unnormalized_exp + k * noise_dist))
     E_p_class_0 = T.sum(E_p_class_0 * noise_samples, axis=1)
     return -T.mean(p_class1 + E_p_class_0, dtype=theano.config.floatX)
+
+
+def sparse_nce_binary_conditional_likelihood(target_scores, noise_scores, y,
+                                             noise_samples, noise_dist, k):
+    """
+    The objective of `nce_binary_conditional_likelihood`, computed from the
+    scores of the targets and of the noise samples only. Nothing of size
+    batch x V is created, so the cost scales with k instead of V
+
+    :type target_scores: theano.tensor.TensorType
+    :param target_scores: The (unnormalized, log) scores of the true
+        words, a vector with one entry per example
+
+    :type noise_scores: theano.tensor.TensorType
+    :param noise_scores: The scores of the noise samples, (batch x k)
+
+    :type y: theano.tensor.TensorType
+    :param y: The indices of the true words
+
+    :type noise_samples: theano.tensor.TensorType
+    :param noise_samples: The (batch x k) int indices of the noise samples,
+        or a vector of k samples shared by the batch. A word drawn twice
+        counts twice, in the dense version it is only counted once
+
+    :type noise_dist: theano.tensor.TensorType
+    :param noise_dist: The noise distribution q over the vocabulary
+    """
+    unnorm_y = T.exp(target_scores)
+    p_class1 = safe_log(unnorm_y / (unnorm_y + k * noise_dist[y]))
+
+    # Shape is bs x k
+    k_noise_q = k * noise_dist[noise_samples]
+    E_p_class_0 = safe_log(k_noise_q / (T.exp(noise_scores) + k_noise_q))
+    E_p_class_0 = T.sum(E_p_class_0, axis=1)
+    return -T.mean(p_class1 + E_p_class_0, dtype=theano.config.floatX)
@@ -0,0 +1,517 @@
+"""
+Minibatch iterators used by the training loops
+"""
+from __future__ import division
+
+import collections
+import multiprocessing
+import signal
+import sys
+import threading
+
+import numpy
+import six
+from six.moves import queue
+
+from cutils.data_interface.utils import pad_and_mask, sequence_lengths
+from cutils.data_interface.parallel import ParallelCorpus
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.views import IndexView
+
+
+class ResumableIterator(object):
+    """
+    Keeps track of where an iterator is in its epochs, so that a training
+    run can be checkpointed and resumed mid-epoch.
+
+    Subclasses shuffle with self.rng, create the batches of an epoch in
+    `get_batches` and serve them through `epoch_batches`. As the batches
+    only depend on the state of the random number generator at the start
+    of the epoch, that state, the epoch and the position in the epoch are
+    all it takes to carry on without replaying or skipping data.
+    """
+
+    def init_state(self):
+        # The epoch being served and the state of rng at its start
+        self.epoch = 0
+        self.epoch_rng_state = None
+        # The number of batches of the epoch served so far
+        self.position = 0
+        self.resuming = False
+
+    def get_batches(self):
+        raise NotImplementedError
+
+    def epoch_batches(self):
+        """
+        Yields the index arrays of the minibatches for one epoch, starting
+        mid-epoch after `load_state_dict`
+        """
+        if self.resuming:
+            self.rng.set_state(self.epoch_rng_state)
+            self.resuming = False
+        else:
+            if self.epoch_rng_state is not None:
+                self.epoch += 1
+            self.epoch_rng_state = self.rng.get_state()
+            self.position = 0
+        batches = self.get_batches()
+        while self.position < len(batches):
+            self.position += 1
+            yield batches[self.position - 1]
+
+    def start_position(self):
+        """
+        Returns the position at which the next epoch starts: where the
+        checkpoint left off after `load_state_dict`, 0 otherwise
+        """
+        return self.position if self.resuming else 0
+
+    def state_dict(self, position=None):
+        """
+        Returns the state of the iterator as arrays, eg. to be stored with
+        numpy.savez. The keys start with 'iterator_'
+
+        :type position: int
+        :param position: The number of batches of the current epoch that
+            were used. Defaults to the number served, which is ahead of
+            the training loop when batches are prefetched
+        """
+        rng_state = self.epoch_rng_state
+        if rng_state is None:
+            rng_state = self.rng.get_state()
+        return {
+            'iterator_epoch': numpy.asarray(self.epoch),
+            'iterator_position': numpy.asarray(
+                self.position if position is None else position),
+            'iterator_rng_keys': rng_state[1],
+            'iterator_rng_pos': numpy.asarray(rng_state[2]),
+            'iterator_rng_gauss': numpy.asarray(rng_state[3:5],
+                                                dtype='float64'),
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restores a state returned by `state_dict`. The next epoch served is
+        the saved one, from the saved position
+
+        :type state: dict
+        :param state: The state, or a mapping containing it such as the
+            archive loaded from a checkpoint
+        """
+        gauss = state['iterator_rng_gauss']
+        self.epoch = int(state['iterator_epoch'])
+        self.position = int(state['iterator_position'])
+        self.epoch_rng_state = ('MT19937',
+                                numpy.asarray(state['iterator_rng_keys'],
+                                              dtype='uint32'),
+                                int(state['iterator_rng_pos']),
+                                int(gauss[0]), float(gauss[1]))
+        self.resuming = True
+
+
+class BucketIterator(ResumableIterator):
+    """
+    Groups sequences of similar length into the same minibatch so that
+    very little of every padded batch is spent on <PAD> tokens.
+
+    Sequences are assigned to buckets using their lengths. Every epoch,
+    the contents of each bucket are shuffled and cut into batches and the
+    order of the batches (across all buckets) is shuffled again.
+
+    Iterating over this object yields ready-padded (x, mask, y) triples
+    in the same format as `pad_and_mask`.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, seqs, batch_size, labels=None, bucket_boundaries=None,
+                 n_buckets=10, maxlen=None, shuffle=True, use_remaining=True,
+                 rng=None):
+        """
+        :type seqs: list(list(int)), RaggedCorpus or IndexView
+        :param seqs: The (integerized) sequences to be batched
+
+        :type batch_size: int
+        :param batch_size: The maximum number of sequences in a batch
+
+        :type labels: list
+        :param labels: Optional labels, one per sequence
+
+        :type bucket_boundaries: list(int)
+        :param bucket_boundaries: Increasing upper bounds (inclusive) on the
+            length of the sequences in each bucket. Sequences longer than the
+            last boundary go into a final overflow bucket. If this is None,
+            boundaries are picked from the quantiles of the sequence lengths
+
+        :type n_buckets: int
+        :param n_buckets: The number of buckets to use when the boundaries
+            are inferred from the data
+
+        :type maxlen: int
+        :param maxlen: Truncate sequences to this length (truncated backprop)
+
+        :type shuffle: bool
+        :param shuffle: Shuffle the sequences within buckets and the batches
+            across buckets at every epoch
+
+        :type use_remaining: bool
+        :param use_remaining: Emit the incomplete batch at the end of each
+            bucket
+
+        :type rng: numpy.random.RandomState
+        :param rng: The random number generator used for shuffling. Defaults
+            to the global numpy generator
+        """
+        self.seqs = seqs
+        self.labels = labels
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.shuffle = shuffle
+        self.use_remaining = use_remaining
+        self.rng = numpy.random if rng is None else rng
+
+        if isinstance(seqs, (RaggedCorpus, IndexView)):
+            self.lengths = seqs.lengths()
+        else:
+            self.lengths = numpy.asarray([len(s) for s in seqs],
+                                         dtype='int64')
+        if maxlen is not None:
+            self.lengths = numpy.minimum(self.lengths, maxlen)
+
+        if bucket_boundaries is None:
+            bucket_boundaries = numpy.percentile(
+                self.lengths, numpy.linspace(0, 100, n_buckets + 1)[1:])
+        self.bucket_boundaries = numpy.unique(
+            numpy.asarray(bucket_boundaries, dtype='int64'))
+        bucket_ids = numpy.searchsorted(self.bucket_boundaries, self.lengths)
+        self.buckets = [numpy.flatnonzero(bucket_ids == b)
+                        for b in range(len(self.bucket_boundaries) + 1)]
+        self.buckets = [b for b in self.buckets if len(b) > 0]
+
+        # Token counts for the batches served in the current epoch
+        self.n_real_tokens = 0
+        self.n_padded_tokens = 0
+        self.init_state()
+
+    def get_batches(self):
+        """
+        Creates the minibatches for one epoch
+
+        :returns: A list of index arrays, one per minibatch
+        """
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = self.rng.permutation(bucket)
+            n_full = len(bucket) // self.batch_size
+            for i in range(n_full):
+                batches.append(bucket[i * self.batch_size:
+                                      (i + 1) * self.batch_size])
+            if self.use_remaining and n_full * self.batch_size < len(bucket):
+                batches.append(bucket[n_full * self.batch_size:])
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+    def padding_efficiency(self, batches=None):
+        """
+        The ratio of real tokens to padded tokens (real + <PAD>).
+        A value of 1 means that no computation is wasted on padding.
+
+        :type batches: list(numpy.ndarray)
+        :param batches: The batches to be evaluated. If None, the batches
+            served so far in the current epoch are used instead
+
+        :returns: A float in (0, 1]
+        """
+        if batches is None:
+            n_real, n_padded = self.n_real_tokens, self.n_padded_tokens
+        else:
+            n_real, n_padded = 0, 0
+            for batch in batches:
+                n_real += self.lengths[batch].sum()
+                n_padded += self.lengths[batch].max() * len(batch)
+        if n_padded == 0:
+            return 1.
+        return n_real / n_padded
+
+    def __len__(self):
+        if self.use_remaining:
+            return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+        return sum(len(b) // self.batch_size for b in self.buckets)
+
+    def batch_indices(self):
+        """
+        Yields the index arrays of the minibatches for one epoch and keeps
+        track of the padding efficiency
+        """
+        self.n_real_tokens = 0
+        self.n_padded_tokens = 0
+        for batch in self.epoch_batches():
+            batch_lengths = self.lengths[batch]
+            self.n_real_tokens += batch_lengths.sum()
+            self.n_padded_tokens += batch_lengths.max() * len(batch)
+            yield batch
+
+    def make_batch(self, batch):
+        """
+        Creates the padded (x, mask, y) triple for an index array
+        """
+        labels = None
+        if self.labels is not None:
+            labels = [self.labels[t] for t in batch]
+        if isinstance(self.seqs, (RaggedCorpus, IndexView)):
+            return self.seqs.pad_and_mask(batch, labels, maxlen=self.maxlen)
+        return pad_and_mask([self.seqs[t] for t in batch], labels,
+                            maxlen=self.maxlen)
+
+    def __iter__(self):
+        for batch in self.batch_indices():
+            yield self.make_batch(batch)
+
+
+class TokenBudgetIterator(ResumableIterator):
+    """
+    Packs sequences (or source/target pairs) into minibatches holding
+    roughly the same number of padded tokens, so that every step costs
+    about the same time and memory whatever the sentence lengths.
+
+    The samples are sorted by length and cut into consecutive batches,
+    each as large as possible while its padded size stays under the
+    budget: (max_src_len + max_tgt_len) * batch_size tokens for pairs,
+    max_len * batch_size for single sequences. Every epoch, samples with
+    equal lengths are shuffled and the order of the batches is shuffled.
+
+    Iterating over this object yields the padded batches, as returned by
+    the `pad_and_mask` method of the data.
+    """
+
+    def __init__(self, data, max_tokens, maxlen=None, shuffle=True,
+                 rng=None):
+        """
+        :type data: ParallelCorpus, RaggedCorpus, IndexView or list
+        :param data: The sentence pairs or the sequences to be batched
+
+        :type max_tokens: int
+        :param max_tokens: The budget of padded tokens per batch. A sample
+            that is over the budget on its own gets a batch to itself
+
+        :type maxlen: int
+        :param maxlen: Truncate sequences to this length (truncated backprop)
+
+        :type shuffle: bool
+        :param shuffle: Shuffle samples of equal lengths and the batches at
+            every epoch
+
+        :type rng: numpy.random.RandomState
+        :param rng: The random number generator used for shuffling. Defaults
+            to the global numpy generator
+        """
+        self.data = data
+        self.max_tokens = max_tokens
+        self.maxlen = maxlen
+        self.shuffle = shuffle
+        self.rng = numpy.random if rng is None else rng
+
+        if isinstance(data, ParallelCorpus):
+            sides = [data.source, data.target]
+        else:
+            sides = [data]
+        self.lengths = [sequence_lengths(side) for side in sides]
+        if maxlen is not None:
+            self.lengths = [numpy.minimum(l, maxlen) for l in self.lengths]
+        # lexsort sorts on the last key first
+        self.keys = numpy.vstack(self.lengths[::-1])
+        self.order = numpy.lexsort(self.keys)
+        self.bounds = self.plan(self.keys[:, self.order])
+        self.init_state()
+
+    def plan(self, sorted_keys):
+        """
+        Finds where the batches start in the sorted samples. The cost of a
+        batch only depends on the lengths, so samples with equal lengths
+        can be swapped without changing the plan
+
+        :type sorted_keys: numpy.ndarray
+        :param sorted_keys: The (n_sides x N) lengths of the sorted samples
+
+        :returns: The start index of every batch but the first
+        """
+        bounds = []
+        widest = [0] * sorted_keys.shape[0]
+        size = 0
+        for i, key in enumerate(zip(*sorted_keys.tolist())):
+            grown = [max(w, k) for w, k in zip(widest, key)]
+            if size > 0 and sum(grown) * (size + 1) > self.max_tokens:
+                bounds.append(i)
+                widest = list(key)
+                size = 1
+            else:
+                widest = grown
+                size += 1
+        return bounds
+
+    def __len__(self):
+        if len(self.order) == 0:
+            return 0
+        return len(self.bounds) + 1
+
+    def get_batches(self):
+        """
+        Creates the minibatches for one epoch
+
+        :returns: A list of index arrays, one per minibatch
+        """
+        order = self.order
+        if self.shuffle:
+            # Shuffling first makes the (stable) sort order ties randomly
+            perm = self.rng.permutation(len(order))
+            order = perm[numpy.lexsort(self.keys[:, perm])]
+        batches = numpy.split(order, self.bounds) if len(order) else []
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+    def make_batch(self, batch):
+        """
+        Creates the padded batch for an index array
+        """
+        if hasattr(self.data, 'pad_and_mask'):
+            return self.data.pad_and_mask(batch, maxlen=self.maxlen)
+        return pad_and_mask([self.data[t] for t in batch],
+                            maxlen=self.maxlen)
+
+    def __iter__(self):
+        for batch in self.epoch_batches():
+            yield self.make_batch(batch)
+
+
+# The transform run by the Prefetcher worker processes. It is inherited
+# when the workers are forked, so it does not need to be picklable.
+_WORKER_TRANSFORM = None
+
+
+def _init_worker():
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_worker_transform(item):
+    return _WORKER_TRANSFORM(item)
+
+
+def _get_result(result):
+    # A timeout keeps the wait interruptible by Ctrl-C
+    while not result.ready():
+        result.wait(0.1)
+    return result.get()
+
+
+class Prefetcher(object):
+    """
+    Prepares the next few minibatches in the background while the
+    compiled Theano function runs on the current one.
+
+    Batches are always produced in the same order as the wrapped iterable,
+    so a run is just as deterministic with or without prefetching.
+    """
+
+    def __init__(self, iterable, n_prefetch=2, transform=None,
+                 use_process=False, n_workers=1):
+        """
+        :type iterable: iterable
+        :param iterable: The batches (or batch descriptions) to prefetch.
+            Iterated once per epoch, in the calling process
+
+        :type n_prefetch: int
+        :param n_prefetch: The maximum number of batches prepared ahead of
+            the consumer
+
+        :type transform: function
+        :param transform: Applied to every item of iterable in the
+            background, eg. to pad a batch of indices
+
+        :type use_process: bool
+        :param use_process: Run transform in worker processes instead of
+            a worker thread. This sidesteps the GIL but the results have to
+            be pickled on their way back. Requires a transform and a
+            platform where worker processes are forked
+
+        :type n_workers: int
+        :param n_workers: The number of worker processes
+        """
+        if use_process and transform is None:
+            raise ValueError('Prefetching with processes requires a '
+                             'transform')
+        self.iterable = iterable
+        self.n_prefetch = n_prefetch
+        self.transform = transform
+        self.use_process = use_process
+        self.n_workers = n_workers
+
+    def __iter__(self):
+        if self.use_process:
+            return self._process_iter()
+        return self._thread_iter()
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+
+        def put(entry):
+            # Check for shutdown while waiting on a full queue
+            while not stop.is_set():
+                try:
+                    batches.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in self.iterable:
+                    if self.transform is not None:
+                        item = self.transform(item)
+                    if not put((True, item)):
+                        return
+                put((False, None))
+            except Exception:  # pylint: disable=broad-except
+                put((False, sys.exc_info()))
+
+        worker = threading.Thread(target=produce, name='prefetcher')
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                # A timeout keeps the wait interruptible by Ctrl-C
+                try:
+                    has_item, item = batches.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if not has_item:
+                    if item is not None:
+                        six.reraise(*item)
+                    break
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+    def _process_iter(self):
+        global _WORKER_TRANSFORM
+        _WORKER_TRANSFORM = self.transform
+        pool = multiprocessing.Pool(self.n_workers, _init_worker)
+        pending = collections.deque()
+        try:
+            for item in self.iterable:
+                pending.append(pool.apply_async(_run_worker_transform,
+                                                (item,)))
+                if len(pending) > self.n_prefetch:
+                    yield _get_result(pending.popleft())
+            while pending:
+                yield _get_result(pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
@@ -3,6 +3,8 @@ Various training algorithms
 """
 from __future__ import print_function
 
+from collections import OrderedDict
+
 import theano
 import theano.tensor as T
 from theano.compile.nanguardmode import NanGuardMode
@@ -194,6 +196,54 @@ def rmsprop(lr, tparams, grads, cost, *args):
     return f_grad_shared, f_update
 
 
+def _optimizer_variables(tparams, functions):
+    """
+    Yields the shared variables updated by the functions of an optimizer,
+    other than the parameters and the variables with a default update (eg.
+    the carried states of stateful recurrences)
+    """
+    params = set(tparams.values())
+    seen = set()
+    for f in functions:
+        for inp in f.maker.inputs:
+            var = inp.variable
+            if (inp.update is None or var in params or var in seen
+                    or getattr(var, 'default_update', None) is not None):
+                continue
+            seen.add(var)
+            yield var
+
+
+def optimizer_state(tparams, *functions):
+    """
+    Returns the state of an optimizer (eg. the running averages of
+    `adadelta`), to be stored in a checkpoint next to the parameters. The
+    keys start with 'optimizer_'
+
+    :type tparams: OrderedDict
+    :param tparams: The parameters given to the optimizer
+
+    :param functions: The functions returned by the optimizer, eg.
+        f_grad_shared and f_update
+    """
+    return OrderedDict(('optimizer_' + var.name, var.get_value())
+                       for var in _optimizer_variables(tparams, functions))
+
+
+def load_optimizer_state(state, tparams, *functions):
+    """
+    Restores a state returned by `optimizer_state`
+
+    :type state: dict
+    :param state: The state, or a mapping containing it such as the
+        archive loaded from a checkpoint
+    """
+    for var in _optimizer_variables(tparams, functions):
+        if 'optimizer_' + var.name not in state:
+            raise Warning('%s is not in the archive' % var.name)
+        var.set_value(state['optimizer_' + var.name])
+
+
 def conjugate_gradient_descent(train_fn, train_fn_grad,
                                callback, x0, n_epochs):
     """
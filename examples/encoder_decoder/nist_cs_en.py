@@ -4,19 +4,27 @@ Data interface for the NIST CS-EN dataset
 
 from __future__ import print_function
 
+from collections import Counter
+
 from cutils.data_interface.interface import DataInterface
 import cutils.data_interface.utils as du
+from cutils.data_interface import binarize
+from cutils.data_interface.parallel import iter_pairs, read_parallel
 from cutils.dict import Dict
 
 
 class NIST_CS_EN(DataInterface):
     def __init__(self, dataset_path, origin=None,
                  src_n_words=100000, tgt_n_words=100000,
-                 src_emb_dim=100, tgt_emb_dim=100):
+                 src_emb_dim=100, tgt_emb_dim=100, use_cache=True):
         if dataset_path is None:
             raise Exception('The dataset path was not specified')
         self.dataset_path = dataset_path
         self.origin = origin
+        # Binarized copies of the dataset are kept next to it
+        self.use_cache = use_cache
+        self.src_vocab_digest = None
+        self.tgt_vocab_digest = None
         # Create dictionary
         self.src_embedding_dimension = src_emb_dim
         self.tgt_embedding_dimension = tgt_emb_dim
@@ -27,71 +35,100 @@ class NIST_CS_EN(DataInterface):
         print("... Done building dictionary")
 
     def load_data(self, maxlen=None, sort_by_len=True):
-        train_x = self.grab_data(('%s/dev2.cs' % self.dataset_path))
-        valid_x = self.grab_data(('%s/dev1.cs' % self.dataset_path))
-        test_x = self.grab_data(('%s/test.cs' % self.dataset_path))
-        train_y = self.grab_data(('%s/dev2.en' % self.dataset_path))
-        valid_y = self.grab_data(('%s/dev1.en' % self.dataset_path))
-        test_y = self.grab_data(('%s/test.en' % self.dataset_path))
-        assert len(train_x) == len(train_y)
-        assert len(valid_x) == len(valid_y)
-        assert len(test_x) == len(test_y)
-
-        if maxlen is not None:
-            new_train_x = []
-            new_train_y = []
-            for x, y in zip(train_x, train_y):
-                if len(x) < maxlen and len(y) < maxlen:
-                    new_train_x.append(x)
-                    new_train_y.append(y)
-            train_x = new_train_x
-            train_y = new_train_y
+        train = self.load_split('dev2', maxlen)
+        valid = self.load_split('dev1')
+        test = self.load_split('test')
 
         if sort_by_len:
-            sorted_index = du.len_argsort(train_x)
-            train_x = [train_x[i] for i in sorted_index]
-            train_y = [train_y[i] for i in sorted_index]
-            sorted_index = du.len_argsort(valid_x)
-            valid_x = [valid_x[i] for i in sorted_index]
-            valid_y = [valid_y[i] for i in sorted_index]
-            sorted_index = du.len_argsort(test_x)
-            test_x = [test_x[i] for i in sorted_index]
-            test_y = [test_y[i] for i in sorted_index]
-
-        train = (train_x, train_y)
-        valid = (valid_x, valid_y)
-        test = (test_x, test_y)
+            # Pairs with equal source lengths are ordered by target length,
+            # which keeps the target padding low as well
+            train = train.take(du.len_argsort(train.source, train.target))
+            valid = valid.take(du.len_argsort(valid.source, valid.target))
+            test = test.take(du.len_argsort(test.source, test.target))
 
         return train, valid, test
 
-    def grab_data(self, input_file, dictionary):
+    def load_split(self, name, maxlen=None):
+        """
+        Returns the integerized sentence pairs of one split of the dataset
+        (eg. dev2 for dev2.cs and dev2.en) as a ParallelCorpus,
+        memory-mapped from the cache when possible
+        """
+        src_file = '%s/%s.cs' % (self.dataset_path, name)
+        tgt_file = '%s/%s.en' % (self.dataset_path, name)
+        if not self.use_cache:
+            return self.grab_data(src_file, tgt_file, maxlen)
+        digest = binarize.source_digest([src_file, tgt_file],
+                                        src_vocab=self.src_vocab_digest,
+                                        tgt_vocab=self.tgt_vocab_digest,
+                                        maxlen=maxlen)
+        return binarize.cached_parallel_corpus(
+            binarize.cache_prefix(self.dataset_path, name, digest),
+            lambda: self.grab_data(src_file, tgt_file, maxlen))
+
+    def grab_data(self, src_file, tgt_file, maxlen=None):
         """
-        Returns a list of sequences (integerized) corresponding
-        to the sentences in a dataset
+        Returns a ParallelCorpus of the integerized sentence pairs in a
+        source and a target file, read in lockstep. Pairs with more than
+        maxlen words on either side are skipped before being encoded
         """
-        sentences = []
-        with open(input_file, 'r') as tt:
-            for line in tt:
-                sentences.append(line.split('|||')[1].strip())
-        seqs = [None] * len(sentences)
-        for idx, ss in enumerate(sentences):
-            seqs[idx] = dictionary.read_sentence(ss)
-        return seqs
+        with open(src_file, 'r') as src, open(tgt_file, 'r') as tgt:
+            return read_parallel(self.read_sentences(src),
+                                 self.read_sentences(tgt),
+                                 self.src_dictionary, self.tgt_dictionary,
+                                 maxlen)
+
+    @staticmethod
+    def read_sentences(lines):
+        """
+        Extracts the sentences from the 'id ||| sentence' lines of a file
+        """
+        return (line.split('|||')[1] for line in lines)
 
     def build_dict(self, src_n_words, tgt_n_words):
-        source_sentences = []
-        train_text = ('%s/dev2.cs' % self.dataset_path)
-        with open(train_text, 'r') as tt:
-            for line in tt:
-                source_sentences.append(line.split('|||')[1].strip())
-        self.src_dictionary = Dict(source_sentences, src_n_words, self.src_embedding_dimension)
+        src_text = ('%s/dev2.cs' % self.dataset_path)
+        tgt_text = ('%s/dev2.en' % self.dataset_path)
+        if not self.use_cache:
+            self.src_dictionary, self.tgt_dictionary = self.read_dicts(
+                src_text, tgt_text, src_n_words, tgt_n_words)
+            return
 
-        target_sentences = []
-        train_text = ('%s/dev2.en' % self.dataset_path)
-        with open(train_text, 'r') as tt:
-            for line in tt:
-                target_sentences.append(line.split('|||')[1].strip())
-        self.tgt_dictionary = Dict(target_sentences, tgt_n_words, self.tgt_embedding_dimension)
+        self.src_vocab_digest = binarize.source_digest([src_text],
+                                                       n_words=src_n_words)
+        self.tgt_vocab_digest = binarize.source_digest([tgt_text],
+                                                       n_words=tgt_n_words)
+        src_prefix = binarize.cache_prefix(self.dataset_path, 'dev2.cs.vocab',
+                                           self.src_vocab_digest)
+        tgt_prefix = binarize.cache_prefix(self.dataset_path, 'dev2.en.vocab',
+                                           self.tgt_vocab_digest)
+        self.src_dictionary = binarize.load_vocab(
+            src_prefix, self.src_embedding_dimension)
+        self.tgt_dictionary = binarize.load_vocab(
+            tgt_prefix, self.tgt_embedding_dimension)
+        if self.src_dictionary is None or self.tgt_dictionary is None:
+            self.src_dictionary, self.tgt_dictionary = self.read_dicts(
+                src_text, tgt_text, src_n_words, tgt_n_words)
+            binarize.save_vocab(src_prefix, self.src_dictionary)
+            binarize.save_vocab(tgt_prefix, self.tgt_dictionary)
+        else:
+            print('... Loaded the vocabularies from the cache')
+
+    def read_dicts(self, src_text, tgt_text, src_n_words, tgt_n_words):
+        """
+        Creates the source and target dictionaries in a single pass over
+        the (lockstep) source and target files
+        """
+        src_counts = Counter()
+        tgt_counts = Counter()
+        with open(src_text, 'r') as src, open(tgt_text, 'r') as tgt:
+            for src_line, tgt_line in iter_pairs(self.read_sentences(src),
+                                                 self.read_sentences(tgt)):
+                src_counts.update(src_line.split())
+                tgt_counts.update(tgt_line.split())
+        return (Dict.from_counts(src_counts, src_n_words,
+                                 self.src_embedding_dimension),
+                Dict.from_counts(tgt_counts, tgt_n_words,
+                                 self.tgt_embedding_dimension))
 
     def get_dataset_file(self):
         """Download file if it does not exist"""
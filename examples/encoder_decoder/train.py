@@ -13,6 +13,7 @@ import theano
 import theano.tensor as T
 
 from cutils.training.utils import get_minibatches_idx, weight_decay
+from cutils.training.iterators import TokenBudgetIterator, Prefetcher
 from cutils.params.utils import zipp, unzip, load_params
 from cutils.data_interface.utils import pad_and_mask
 from cutils.training.trainer import adadelta
@@ -44,6 +45,7 @@ def train_lstm(
     save_freq=1110,
     maxlen=35,
     batch_size=20,
+    max_tokens=None,
     valid_batch_size=64,
     dataset='../../data/simple-examples/data',
     noise_std=0.,
@@ -97,6 +99,11 @@ def train_lstm(
 
     kf_valid = get_minibatches_idx(len(valid), valid_batch_size)
     kf_test = get_minibatches_idx(len(test), valid_batch_size)
+    # Batches of about max_tokens padded tokens, so that every update
+    # takes about as long. Truncated backprop
+    if max_tokens is None:
+        max_tokens = batch_size * maxlen
+    train_batches = TokenBudgetIterator(train, max_tokens, maxlen=maxlen)
 
     print('%d train examples' % len(train))
     print('%d valid examples' % len(valid))
@@ -107,9 +114,9 @@ def train_lstm(
     bad_count = 0
 
     if valid_freq == -1:
-        valid_freq = len(train) // batch_size
+        valid_freq = len(train_batches)
     if save_freq == -1:
-        save_freq = len(train) // batch_size
+        save_freq = len(train_batches)
 
     uidx = 0  # The number of updates done
     estop = False  # Early stop
@@ -117,18 +124,11 @@ def train_lstm(
     try:
         for eidx in range(max_epochs):
             n_samples = 0
-            # Get shuffled index for the training set
-            kf = get_minibatches_idx(len(train), batch_size, shuffle=True)
-            for _, train_index in kf:
+            # Batches come padded, with shape (minibatch maxlen, n samples),
+            # in a new order every epoch
+            for x, mask, _ in Prefetcher(train_batches):
                 uidx += 1
                 use_noise.set_value(1.)
-
-                # Select the random examples in this minibatch
-                x = [train[t] for t in train_index]
-
-                # Convert to shape (minibatch maxlen, n samples)
-                # Truncated backprop
-                x, mask, _ = pad_and_mask(x, maxlen=maxlen)
                 n_samples += x.shape[1]
 
                 cost = f_grad_shared(x, mask)
@@ -13,7 +13,6 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from cutils.numeric import numpy_floatX
 from cutils.layers.utils import dropout_layer
 from cutils.layers.lstm import LSTM
-from cutils.data_interface.utils import pad_and_mask
 from cutils.params.utils import init_tparams
 
 
@@ -59,7 +58,7 @@ class LSTM_CF(object):
 
     def build_model(self, encoder='lstm', use_dropout=True):
         use_noise = theano.shared(numpy_floatX(0.))
-        x = T.matrix('x', dtype='int64')
+        x = T.matrix('x', dtype='int32')
         mask = T.matrix('mask', dtype=theano.config.floatX)
         y = T.vector('y', dtype='int64')
 
@@ -105,9 +104,9 @@ class LSTM_CF(object):
         n_done = 0
 
         for _, valid_index in iterator:
-            x, mask, y = pad_and_mask([data[0][t] for t in valid_index],
-                                      numpy.array(data[1])[valid_index],
-                                      maxlen=None)
+            x, mask, y = data[0].pad_and_mask(valid_index,
+                                              numpy.array(data[1])[valid_index],
+                                              maxlen=None)
             pred_probs = self.f_pred_prob(x, mask)
             probs[valid_index, :] = pred_probs
 
@@ -124,9 +123,9 @@ class LSTM_CF(object):
         """
         valid_err = 0
         for _, valid_index in iterator:
-            x, mask, y = pad_and_mask([data[0][t] for t in valid_index],
-                                      numpy.array(data[1])[valid_index],
-                                      maxlen=None)
+            x, mask, y = data[0].pad_and_mask(valid_index,
+                                              numpy.array(data[1])[valid_index],
+                                              maxlen=None)
             preds = self.f_pred(x, mask)
             targets = numpy.array(data[1])[valid_index]
             valid_err += (preds == targets).sum()
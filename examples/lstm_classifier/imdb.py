@@ -1,16 +1,30 @@
 from __future__ import print_function
 import os
-import glob
+import numpy
 
 from cutils.data_interface.interface import DataInterface
 import cutils.data_interface.utils as du
+from cutils.data_interface import binarize
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.token_cache import TokenizationCache, \
+    TOKENIZER_VERSION
+from cutils.data_interface.views import IndexView
 from cutils.dict import Dict
 
 
+def read_review(path):
+    with open(path, 'r') as f:
+        return f.readline().strip()
+
+
 class IMDB(DataInterface):
-    def __init__(self, dataset_path, origin=None, n_words=100000, emb_dim=100):
+    def __init__(self, dataset_path, origin=None, n_words=100000, emb_dim=100,
+                 use_cache=True):
         self.dataset_path = dataset_path
         self.origin = origin
+        # Binarized copies of the dataset are kept next to it
+        self.use_cache = use_cache
+        self.vocab_digest = None
         # Download the dataset if it does not exist
         if os.path.isdir(os.getcwd() + "/" + dataset_path):
             self.dataset_path = os.getcwd() + "/" + dataset_path
@@ -20,6 +34,15 @@ class IMDB(DataInterface):
             else:
                 raise Exception('Dataset not found and the origin \
                     was not specified')
+        # The tokenized reviews are reused by build_dict and load_data.
+        # Without the cache, they are still shared within a run. Hashing
+        # the contents of thousands of reviews costs about as much as
+        # reading them, so the caches are keyed on file sizes and times
+        cache_dir = None
+        if use_cache:
+            cache_dir = os.path.join(self.dataset_path, 'tokenized')
+        self.token_cache = TokenizationCache(cache_dir, lowercase=True,
+                                             stat_keys=True)
         # Create dictionary
         self.embedding_dimension = emb_dim
         self.dictionary = None
@@ -34,48 +57,32 @@ class IMDB(DataInterface):
                   maxlen=None, sort_by_len=True):
         train_x_pos = self.grab_data(self.dataset_path + "/train/pos")
         train_x_neg = self.grab_data(self.dataset_path + "/train/neg")
-        train_x = train_x_pos + train_x_neg
+        train_x = RaggedCorpus.concatenate([train_x_pos, train_x_neg])
         train_y = [1] * len(train_x_pos) + [0] * len(train_x_neg)
         train_set = (train_x, train_y)
 
         test_x_pos = self.grab_data(self.dataset_path + "/test/pos")
         test_x_neg = self.grab_data(self.dataset_path + "/test/neg")
-        test_x = test_x_pos + test_x_neg
+        test_x = RaggedCorpus.concatenate([test_x_pos, test_x_neg])
         test_y = [1] * len(test_x_pos) + [0] * len(test_x_neg)
         test_set = (test_x, test_y)
 
         if maxlen:
-            new_train_set_x = []
-            new_train_set_y = []
-            for x, y in zip(train_set[0], train_set[1]):
-                if len(x) < maxlen:
-                    new_train_set_x.append(x)
-                    new_train_set_y.append(y)
-            train_set = (new_train_set_x, new_train_set_y)
-
-        valid_set = ([], [])
+            keep = numpy.flatnonzero(train_x.lengths() < maxlen)
+            train_set = (IndexView(train_x, keep), IndexView(train_y, keep))
+
+        valid_set = (RaggedCorpus.from_sequences([]), [])
         if valid_portion > 0.:
             train_set, valid_set = du.create_subset(train_set, valid_portion)
 
-        train_set_x, train_set_y = train_set
-        valid_set_x, valid_set_y = valid_set
-        test_set_x, test_set_y = test_set
         if sort_by_len:
-            sorted_index = du.len_argsort(test_set_x)
-            test_set_x = [test_set_x[i] for i in sorted_index]
-            test_set_y = [test_set_y[i] for i in sorted_index]
-
-            sorted_index = du.len_argsort(valid_set_x)
-            valid_set_x = [valid_set_x[i] for i in sorted_index]
-            valid_set_y = [valid_set_y[i] for i in sorted_index]
-
-            sorted_index = du.len_argsort(train_set_x)
-            train_set_x = [train_set[0][i] for i in sorted_index]
-            train_set_y = [train_set[1][i] for i in sorted_index]
+            test_set = du.sort_by_len(test_set)
+            valid_set = du.sort_by_len(valid_set)
+            train_set = du.sort_by_len(train_set)
 
-        train = (train_set_x, train_set_y)
-        valid = (valid_set_x, valid_set_y)
-        test = (test_set_x, test_set_y)
+        train = train_set
+        valid = valid_set
+        test = test_set
 
         self.train = train
         self.valid = valid
@@ -84,35 +91,53 @@ class IMDB(DataInterface):
         return train, valid, test
 
     def grab_data(self, dirpath):
-        sentences = []
-        currdir = os.getcwd()
-        os.chdir(dirpath)
-        for ff in glob.glob("*.txt"):
-            with open(ff, 'r') as f:
-                sentences.append(f.readline().strip())
-        os.chdir(currdir)
-        sentences = du.tokenize(sentences)
-        sentences = du.lowercase(sentences)
-        seqs = [None] * len(sentences)
-        for idx, ss in enumerate(sentences):
-                seqs[idx] = self.dictionary.read_sentence(ss)
-        return seqs
+        """
+        Returns the integerized reviews in a directory, memory-mapped
+        from the cache when possible
+        """
+        if not self.use_cache:
+            return self.read_data(dirpath)
+        digest = binarize.stat_digest(self.list_files(dirpath),
+                                      vocab=self.vocab_digest,
+                                      tokenizer=TOKENIZER_VERSION)
+        name = 'imdb.' + os.path.relpath(dirpath, self.dataset_path) \
+            .replace(os.sep, '_')
+        return binarize.cached_corpus(
+            binarize.cache_prefix(self.dataset_path, name, digest),
+            lambda: self.read_data(dirpath))
+
+    def read_data(self, dirpath):
+        return self.dictionary.encode_batch(self.read_reviews(dirpath))
+
+    def read_reviews(self, dirpath):
+        """
+        Returns the tokenized and lowercased reviews in a directory
+        """
+        paths = self.list_files(dirpath)
+        return self.token_cache.tokenize(
+            paths, lambda: list(du.read_files(paths, read_review)))
+
+    def list_files(self, dirpath):
+        return du.list_directory(dirpath, "*.txt")
 
     def build_dict(self, n_words):
-        sentences = []
-        currdir = os.getcwd()
-        os.chdir('%s/train/pos' % self.dataset_path)
-        for ff in glob.glob("*.txt"):
-            with open(ff, 'r') as f:
-                sentences.append(f.readline().strip())
-        os.chdir('%s/train/neg' % self.dataset_path)
-        for ff in glob.glob("*.txt"):
-            with open(ff, 'r') as f:
-                sentences.append(f.readline().strip())
-        os.chdir(currdir)
-        sentences = du.tokenize(sentences)
-        sentences = du.lowercase(sentences)
-        self.dictionary = Dict(sentences, n_words, self.embedding_dimension)
+        if not self.use_cache:
+            self.dictionary = self.read_dict(n_words)
+            return
+        self.vocab_digest = binarize.stat_digest(
+            self.list_files('%s/train/pos' % self.dataset_path)
+            + self.list_files('%s/train/neg' % self.dataset_path),
+            n_words=n_words, tokenizer=TOKENIZER_VERSION)
+        self.dictionary = binarize.cached_vocab(
+            binarize.cache_prefix(self.dataset_path, 'imdb.vocab',
+                                  self.vocab_digest),
+            lambda: self.read_dict(n_words), self.embedding_dimension)
+
+    def read_dict(self, n_words):
+        sentences = (
+            self.read_reviews('%s/train/pos' % self.dataset_path)
+            + self.read_reviews('%s/train/neg' % self.dataset_path))
+        return Dict(sentences, n_words, self.embedding_dimension)
 
     def get_dataset_file(self):
         """Download file if it does not exist"""
@@ -8,14 +8,16 @@ import os
 import sys
 import time
 import pickle
+from collections import OrderedDict
 import numpy
 import theano
 import theano.tensor as T
 
 from cutils.training.utils import get_minibatches_idx, weight_decay
+from cutils.training.iterators import BucketIterator, Prefetcher
 from cutils.params.utils import zipp, unzip, load_params
-from cutils.data_interface.utils import pad_and_mask
-from cutils.training.trainer import adadelta
+from cutils.training.trainer import adadelta, optimizer_state, \
+    load_optimizer_state
 
 # Include current path in the pythonpath
 script_path = os.path.dirname(os.path.realpath(__file__))
@@ -39,6 +41,7 @@ def train_lstm(
     optimizer=adadelta,
     encoder='lstm',
     save_to='lstm_model.npz',
+    load_from=None,
     valid_freq=370,
     save_freq=1110,
     maxlen=100,
@@ -52,6 +55,9 @@ def train_lstm(
 ):
     model_options = locals().copy()
     print("model options", model_options)
+    # Resume from our own checkpoint unless told otherwise
+    if load_from is None:
+        load_from = save_to
 
     imdb_data = imdb.IMDB(dataset, n_words=n_words,
                           emb_dim=model_options['dim_proj'])
@@ -62,7 +68,7 @@ def train_lstm(
         idx = numpy.arange(len(test[0]))
         numpy.random.shuffle(idx)
         idx = idx[:test_size]
-        test = ([test[0][n] for n in idx], [test[1][n] for n in idx])
+        test = (test[0].take(idx), [test[1][n] for n in idx])
 
     ydim = numpy.max(train[1]) + 1
     model_options['ydim'] = ydim
@@ -73,7 +79,8 @@ def train_lstm(
                       imdb_data.dictionary, SEED)
 
     if reload_model:
-        load_params('lstm_model.npz', lstm_cf.params)
+        print('Reloading params from %s' % load_from)
+        load_params(load_from, lstm_cf.params)
         # Update the tparams with the new values
         zipp(lstm_cf.params, lstm_cf.tparams)
 
@@ -92,8 +99,11 @@ def train_lstm(
 
     print('Optimization')
 
+    kf_train = get_minibatches_idx(len(train[0]), valid_batch_size)
     kf_valid = get_minibatches_idx(len(valid[0]), valid_batch_size)
     kf_test = get_minibatches_idx(len(test[0]), valid_batch_size)
+    # Batches of similar length sequences, reshuffled at every epoch
+    train_batches = BucketIterator(train[0], batch_size, labels=train[1])
 
     print('%d train examples' % len(train[0]))
     print('%d valid examples' % len(valid[0]))
@@ -101,7 +111,7 @@ def train_lstm(
 
     history_errs = []
     best_p = None
-    bad_count = 0
+    bad_counter = 0
 
     if valid_freq == -1:
         valid_freq = len(train[0]) // batch_size
@@ -109,23 +119,38 @@ def train_lstm(
         save_freq = len(train[0]) // batch_size
 
     uidx = 0  # The number of updates done
+    first_epoch = 0
+    if reload_model:
+        checkpoint = numpy.load(load_from)
+        if 'iterator_epoch' in checkpoint:
+            # Carry on mid-epoch, from the batch after the checkpoint. The
+            # params loaded above are the weights at that batch
+            train_batches.load_state_dict(checkpoint)
+            first_epoch = train_batches.epoch
+            load_optimizer_state(checkpoint, lstm_cf.tparams, f_grad_shared,
+                                 f_update)
+            best_keys = ['best_' + kk for kk in lstm_cf.params]
+            if all(kk in checkpoint for kk in best_keys):
+                best_p = OrderedDict((kk, checkpoint['best_' + kk])
+                                     for kk in lstm_cf.params)
+            uidx = int(checkpoint['uidx'])
+            bad_counter = int(checkpoint['bad_counter'])
+            history_errs = checkpoint['history_errs'].tolist()
+            print('Resuming from epoch %d, update %d' % (first_epoch, uidx))
     estop = False  # Early stop
     start_time = time.time()
     try:
-        for eidx in range(max_epochs):
+        for eidx in range(first_epoch, max_epochs):
             n_samples = 0
-            # Get shuffled index for the training set
-            kf = get_minibatches_idx(len(train[0]), batch_size, shuffle=True)
-            for _, train_index in kf:
+            # The number of batches of the epoch used so far. Prefetching
+            # runs ahead of it
+            n_batches = train_batches.start_position()
+            # Batches come padded, with shape (minibatch maxlen, n samples)
+            # The next few are prepared in the background
+            for x, mask, y in Prefetcher(train_batches):
                 uidx += 1
+                n_batches += 1
                 use_noise.set_value(1.)
-
-                # Select the random examples in this minibatch
-                y = [train[1][t] for t in train_index]
-                x = [train[0][t] for t in train_index]
-
-                # Convert to shape (minibatch maxlen, n samples)
-                x, mask, y = pad_and_mask(x, y)
                 n_samples += x.shape[1]
 
                 cost = f_grad_shared(x, mask, y)
@@ -138,20 +163,9 @@ def train_lstm(
                 if numpy.mod(uidx, disp_freq) == 0:
                     print('Epoch ', eidx, 'Update ', uidx, 'Cost ', cost)
 
-                if save_to and numpy.mod(uidx, save_freq) == 0:
-                    print('Saving...')
-                    if best_p is not None:
-                        lstm_cf.params = best_p
-                    else:
-                        lstm_cf.params = unzip(lstm_cf.tparams)
-                    numpy.savez(save_to, history_errs=history_errs, **lstm_cf.params)
-                    pickle.dump(model_options, open('%s.pkl' % save_to, 'wb'),
-                                -1)
-                    print('Done')
-
                 if numpy.mod(uidx, valid_freq) == 0:
                     use_noise.set_value(0.)
-                    train_err = lstm_cf.pred_error(train, kf)
+                    train_err = lstm_cf.pred_error(train, kf_train)
                     valid_err = lstm_cf.pred_error(valid, kf_valid)
                     test_err = lstm_cf.pred_error(test, kf_test)
                     history_errs.append([valid_err, test_err])
@@ -172,7 +186,29 @@ def train_lstm(
                             estop = True
                             break
 
+                # After validating, so that the checkpoint includes the
+                # validation of this update
+                if save_to and numpy.mod(uidx, save_freq) == 0:
+                    print('Saving...')
+                    # The current weights, with the optimizer and batch
+                    # states, to resume from. The best weights so far are
+                    # kept under 'best_' keys
+                    checkpoint = unzip(lstm_cf.tparams)
+                    checkpoint.update(optimizer_state(
+                        lstm_cf.tparams, f_grad_shared, f_update))
+                    if best_p is not None:
+                        checkpoint.update(('best_' + kk, vv)
+                                          for kk, vv in best_p.items())
+                    checkpoint.update(train_batches.state_dict(n_batches))
+                    numpy.savez(save_to, history_errs=history_errs, uidx=uidx,
+                                bad_counter=bad_counter, **checkpoint)
+                    pickle.dump(model_options, open('%s.pkl' % save_to, 'wb'),
+                                -1)
+                    print('Done')
+
             print('Seen %d samples' % n_samples)
+            print('Padding efficiency %.3f' %
+                  train_batches.padding_efficiency())
 
             if estop:
                 break
@@ -8,10 +8,12 @@ from __future__ import print_function
 import os
 import sys
 import time
+import pickle
 import numpy
 
 from cutils.params.utils import zipp, load_params
 from cutils.data_interface.utils import pad_and_mask
+from cutils.dict import Dict
 
 # Include current path in the pythonpath
 script_path = os.path.dirname(os.path.realpath(__file__))
@@ -26,14 +28,18 @@ numpy.random.seed(SEED)
 def decode_lstm(
     load_from='lstm_model.npz'
 ):
-    npz_archive = numpy.load(load_from)
-    model_options = npz_archive['model_options']
-    ptb_data = npz_archive['ptb_data']
+    with open('%s.pkl' % load_from, 'rb') as f:
+        model_options = pickle.load(f)
+    # The vocab is saved next to the model by train.py
+    dictionary = Dict.load('%s.dict.npz' % load_from)
 
-    lstm_lm = LSTM_LM(model_options['dim_proj'], model_options['y_dim'],
-                      ptb_data.dictionary, SEED)
+    lstm_lm = LSTM_LM(model_options['dim_proj'], model_options['ydim'],
+                      dictionary, SEED,
+                      output=model_options.get('output', 'softmax'),
+                      n_classes=model_options.get('n_classes'),
+                      cutoffs=model_options.get('cutoffs'))
 
-    print('Reloading params from %s' % save_to)
+    print('Reloading params from %s' % load_from)
     load_params(load_from, lstm_lm.params)
     # Update the tparams with the new values
     zipp(lstm_lm.params, lstm_lm.tparams)
@@ -43,14 +49,17 @@ def decode_lstm(
     # Create the shared variables for the model
     lstm_lm.build_decode()
     test_sentences = ['with the', 'the cat', 'when the']
-    test_sentences = [ptb_data.dictionary.read_sentence(s) for s in test_sentences]
-    test_sentences, test_mask = pad_and_mask(test_sentences)
+    test_sentences = [dictionary.read_sentence(s) for s in test_sentences]
+    test_sentences, test_mask, _ = pad_and_mask(test_sentences)
 
     start_time = time.time()
     output = lstm_lm.f_decode(test_sentences, test_mask, model_options['maxlen'])
     end_time = time.time()
 
     print('Decoding took %.1fs' % (end_time - start_time))
+    # Stop each decoded sentence at the first padding token
+    for sentence in dictionary.idx_to_words(output, stop_at=[0]):
+        print(sentence)
 
 if __name__ == '__main__':
     decode_lstm()
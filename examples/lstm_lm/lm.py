@@ -9,12 +9,14 @@ import theano
 import theano.tensor as T
 from collections import OrderedDict
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from theano.tensor.extra_ops import searchsorted
 
 from cutils.numeric import numpy_floatX
 from cutils.layers.utils import dropout_layer
 from cutils.layers.lstm import LSTM
 from cutils.layers.logistic_regression import LogisticRegression
-from cutils.data_interface.utils import pad_and_mask
+from cutils.layers.hierarchical_softmax import ClassFactoredSoftmax
+from cutils.layers.adaptive_softmax import AdaptiveSoftmax
 from cutils.params.utils import init_tparams
 
 
@@ -23,9 +25,19 @@ class LSTM_LM(object):
         return '%s_%s' % (pp, name)
 
 
-    def __init__(self, dim_proj, ydim, word_dict, random_seed, use_dropout=True):
+    def __init__(self, dim_proj, ydim, word_dict, random_seed, use_dropout=True,
+                 output='softmax', n_classes=None, cutoffs=None):
         """
         Embedding and classifier params
+
+        output : The output layer. 'softmax' for a full softmax over the
+                 vocabulary, 'hsoftmax' for a class-factored softmax
+                 (see cutils.layers.hierarchical_softmax) or 'adaptive'
+                 for an adaptive softmax (see cutils.layers.adaptive_softmax)
+        n_classes : The number of word classes of the 'hsoftmax' output.
+                    Defaults to sqrt(ydim)
+        cutoffs : The frequency ranks where the clusters of the 'adaptive'
+                  output start
         """
         self.layers = {}
         self.random_seed = random_seed
@@ -35,8 +47,11 @@ class LSTM_LM(object):
         self.params = OrderedDict()
         self.tparams = OrderedDict()
         self.f_cost = None
+        self.f_stream_cost = None
         self.f_decode = None
+        self.sample_inputs = []
         self.use_dropout = use_dropout
+        self.output = output
 
         def unpack(source, target):
             for kk, vv in source.items():
@@ -63,7 +78,18 @@ class LSTM_LM(object):
         unpack(self.layers['logit_prev_word'].params, self.params)
         unpack(self.layers['logit_prev_word'].tparams, self.tparams)
         # Logit : Softmax
-        self.layers['logit'] = LogisticRegression(ydim, dim_proj, prefix='logit', ortho=False)
+        if output == 'softmax':
+            self.layers['logit'] = LogisticRegression(ydim, dim_proj, prefix='logit', ortho=False)
+        elif output == 'hsoftmax':
+            # Classes of words binned by their frequency in the dictionary
+            self.layers['logit'] = ClassFactoredSoftmax(word_dict.word_freq[:ydim], dim_proj,
+                                                        n_classes=n_classes, prefix='logit')
+        elif output == 'adaptive':
+            # A head of frequent words and clusters of rarer ones
+            self.layers['logit'] = AdaptiveSoftmax(word_dict.word_freq[:ydim], dim_proj,
+                                                   cutoffs=cutoffs, prefix='logit')
+        else:
+            raise ValueError('Unknown output layer %s' % output)
         unpack(self.layers['logit'].params, self.params)
         unpack(self.layers['logit'].tparams, self.tparams)
         ## Initialize other params
@@ -76,10 +102,25 @@ class LSTM_LM(object):
         #unpack(other_tparams, self.tparams)
 
 
-    def build_model(self):
+    def build_model(self, stateful=False, sampled=False):
+        """
+        Builds the training cost
+
+        stateful : Carry the LSTM states over from one batch to the next,
+                   for batches of consecutive windows of parallel streams
+                   (see cutils.data_interface.streams). Call `reset_state`
+                   with the number of streams before the first window
+        sampled : Train with a sampled softmax, which only scores a set of
+                  candidate words shared by the batch (softmax output
+                  only). The cost then takes the extra inputs in
+                  `sample_inputs`, see `AliasSampler.sample_candidates`.
+                  f_cost still computes the exact cost
+        """
+        if sampled and self.output != 'softmax':
+            raise ValueError('Sampled softmax needs the softmax output')
         trng = RandomStreams(self.random_seed)
         use_noise = theano.shared(numpy_floatX(0.))
-        x = T.matrix('x', dtype='int64')
+        x = T.matrix('x', dtype='int32')
         # Since we are simply predicting the next word, the
         # following statement shifts the content of the x by 1
         # in the time dimension for prediction (axis 0, assuming TxN)
@@ -102,40 +143,114 @@ class LSTM_LM(object):
         # Note that these contain hidden states for elements which were
         # padded in input. The cost for these time steps are removed
         # before the calculation of the cost.
-        proj_1 = self.layers['lstm_1'].lstm_layer(emb, mask=mask, restore_final_to_initial_hidden=True)
+        proj_1 = self.layers['lstm_1'].lstm_layer(emb, mask=mask, restore_final_to_initial_hidden=stateful)
         # Use dropout on non-recurrent connections (Zaremba et al.)
         if self.use_dropout:
             proj_1 = dropout_layer(proj_1, use_noise, trng)
-        proj = self.layers['lstm_2'].lstm_layer(proj_1, mask=mask, restore_final_to_initial_hidden=True)
+        proj = self.layers['lstm_2'].lstm_layer(proj_1, mask=mask, restore_final_to_initial_hidden=stateful)
         if self.use_dropout:
             proj = dropout_layer(proj, use_noise, trng)
 
         pre_s_lstm = self.layers['logit_lstm'].logit_layer(proj)
         pre_s_input = self.layers['logit_prev_word'].logit_layer(emb)
-        pre_s = self.layers['logit'].logit_layer(T.tanh(pre_s_lstm + pre_s_input))
-        # Softmax works for 2-tensors (matrices) only. We have a 3-tensor
-        # TxNxV. So we reshape it to (T*N)xV, apply softmax and reshape again
-        # -1 is a proxy for infer dim based on input (numpy style)
-        pre_s_r = T.reshape(pre_s, (pre_s.shape[0] * pre_s.shape[1], -1))
-        pred_r = T.nnet.softmax(pre_s_r)
-
-        off = 1e-8
-        if pred_r.dtype == 'float16':
-            off = 1e-6
-
-        # Note the use of flatten here. We can't directly index a 3-tensor
-        # and hence we use the (T*N)xV view which is indexed by the flattened
-        # label matrix, dim = (T*N)x1
-        # Also, the cost (before calculating the mean) is multiplied (element-wise)
+        hid = T.tanh(pre_s_lstm + pre_s_input)
+        if self.output == 'softmax':
+            pre_s = self.layers['logit'].logit_layer(hid)
+            # Softmax works for 2-tensors (matrices) only. We have a 3-tensor
+            # TxNxV. So we reshape it to (T*N)xV, apply softmax and reshape again
+            # -1 is a proxy for infer dim based on input (numpy style)
+            pre_s_r = T.reshape(pre_s, (pre_s.shape[0] * pre_s.shape[1], -1))
+            pred_r = T.nnet.softmax(pre_s_r)
+
+            off = 1e-8
+            if pred_r.dtype == 'float16':
+                off = 1e-6
+
+            # Note the use of flatten here. We can't directly index a 3-tensor
+            # and hence we use the (T*N)xV view which is indexed by the flattened
+            # label matrix, dim = (T*N)x1
+            log_p = T.log(pred_r[T.arange(pred_r.shape[0]), y.flatten()] + off)
+        else:
+            # Only the probabilities of the targets are computed
+            hid_r = T.reshape(hid, (n_timesteps * n_samples, self.dim_proj))
+            log_p = self.layers['logit'].log_prob(hid_r, y.flatten())
+
+        # The cost (before calculating the mean) is multiplied (element-wise)
         # with the mask to eliminate the cost of elements that do not really exist.
         # i.e. Do not include the cost for elements which are padded
-        cost = -T.sum(T.log(pred_r[T.arange(pred_r.shape[0]), y.flatten()] + off) * mask.flatten()) / T.sum(mask)
-
-        self.f_cost = theano.function([x, mask], cost, name='f_cost')
+        cost = -T.sum(log_p * mask.flatten()) / T.sum(mask)
+
+        # f_cost leaves the carried states alone, f_stream_cost advances them
+        self.f_cost = theano.function([x, mask], cost, name='f_cost',
+                                      no_default_updates=True)
+        if stateful:
+            self.f_stream_cost = theano.function([x, mask], cost,
+                                                 name='f_stream_cost')
+
+        if sampled:
+            # The candidates (sorted) and the log of their expected counts
+            # in the samples, which corrects the logits for the sampling
+            candidates = T.ivector('candidates')
+            log_q = T.vector('log_q', dtype=theano.config.floatX)
+            hid_r = T.reshape(hid, (n_timesteps * n_samples, self.dim_proj))
+            # (T*N) x n_candidates
+            logits = self.layers['logit'].gather_logits(hid_r, candidates,
+                                                        shared=True) - log_q
+            # The position of each target in the candidates. Only the
+            # targets that are masked out can be missing
+            y_idx = T.minimum(searchsorted(candidates, y.flatten()),
+                              candidates.shape[0] - 1)
+            log_p = T.nnet.logsoftmax(logits)[T.arange(logits.shape[0]), y_idx]
+            cost = -T.sum(log_p * mask.flatten()) / T.sum(mask)
+            self.sample_inputs = [candidates, log_q]
 
         return use_noise, x, mask, cost
 
 
+    def output_scores(self, hid):
+        """
+        Scores every word of the vocabulary, the most likely word has the
+        highest score. Logits for the softmax output and log-probabilities
+        for the others
+
+        hid : The (N x dim_proj) input of the output layer
+        """
+        if self.output == 'softmax':
+            return self.layers['logit'].logit_layer(hid)
+        return self.layers['logit'].log_prob_all(hid)
+
+
+    def reset_state(self, n_streams):
+        """
+        Zeroes the LSTM states carried between the windows of n_streams
+        parallel streams
+        """
+        self.layers['lstm_1'].reset_state(n_streams)
+        self.layers['lstm_2'].reset_state(n_streams)
+
+
+    def state_dict(self):
+        """
+        Returns a copy of the carried LSTM states, eg. to checkpoint
+        stateful training. The keys start with 'stream_'
+        """
+        state = {}
+        for name in ('lstm_1', 'lstm_2'):
+            h, c = self.layers[name].get_state()
+            state['stream_%s_h' % name] = h
+            state['stream_%s_c' % name] = c
+        return state
+
+
+    def load_state_dict(self, state):
+        """
+        Restores the LSTM states returned by `state_dict`
+        """
+        for name in ('lstm_1', 'lstm_2'):
+            self.layers[name].set_state((state['stream_%s_h' % name],
+                                         state['stream_%s_c' % name]))
+
+
     def build_decode(self):
         # Input to start the recurrence with
         trng = RandomStreams(self.random_seed)
@@ -165,8 +280,7 @@ class LSTM_LM(object):
             # N X V
             pre_soft_lstm = self.layers['logit_lstm'].logit_layer(output)
             pre_soft_input = self.layers['logit_prev_word'].logit_layer(emb)
-            pre_soft = self.layers['logit'].logit_layer(T.tanh(pre_s_lstm + pre_s_input))
-            pred = T.nnet.softmax(pre_soft)
+            pred = self.output_scores(T.tanh(pre_soft_lstm + pre_soft_input))
             # N x 1
             pred_argmax = pred.argmax(axis=1)
             # N x d (flatten is probably redundant)
@@ -184,16 +298,13 @@ class LSTM_LM(object):
 
         pre_s_lstm = self.layers['logit_lstm'].logit_layer(proj)
         pre_s_input = self.layers['logit_prev_word'].logit_layer(emb)
-        pre_s = self.layers['logit'].logit_layer(T.tanh(pre_s_lstm + pre_s_input))
-        # Softmax works for 2-tensors (matrices) only. We have a 3-tensor
-        # TxNxV. So we reshape it to (T*N)xV, apply softmax and reshape again
-        # -1 is a proxy for infer dim based on input (numpy style)
-        pre_s_r = T.reshape(pre_s, (pre_s.shape[0] * pre_s.shape[1], -1))
-        # Softmax will receive all-0s for previously padded entries
+        hid = T.tanh(pre_s_lstm + pre_s_input)
+        # The output layers work on matrices only. We have a 3-tensor
+        # TxNxd. So we reshape it to (T*N)xd and reshape the scores again
         # (T*N) x V
-        pred_r = T.nnet.softmax(pre_s_r)
+        pred_r = self.output_scores(T.reshape(hid, (hid.shape[0] * hid.shape[1], -1)))
         # T x N
-        pred = (T.reshape(pred_r, pre_s.shape)[:,:,2:]).argmax(axis=2) + 2
+        pred = (T.reshape(pred_r, (hid.shape[0], hid.shape[1], -1))[:,:,2:]).argmax(axis=2) + 2
         self.f_decode = theano.function([x, mask, n_timesteps], pred, name='f_decode')
 
         return use_noise, x, mask, n_timesteps
@@ -203,7 +314,7 @@ class LSTM_LM(object):
         """
         Probabilities for new examples from a trained model
 
-        data : The complete dataset. A list of lists. Each nested list is a sample
+        data : The complete dataset. A RaggedCorpus, one sequence per sample
         iterator : A list of lists. Each nested list is a batch with idxs to the sample in data
         """
         # Total samples
@@ -215,7 +326,7 @@ class LSTM_LM(object):
 
         # valid_index is a list containing the IDXs of samples for a batch
         for _, valid_index in iterator:
-            x, mask, _ = pad_and_mask([data[t] for t in valid_index])
+            x, mask, _ = data.pad_and_mask(valid_index)
             # Accumulate running cost
             samples_seen.append(len(valid_index))
             running_cost.append(self.f_cost(x, mask))
@@ -224,3 +335,24 @@ class LSTM_LM(object):
                 print("%d/%d samples classified" % (n_done, n_samples))
 
         return sum([samples_seen[i] * running_cost[i] for i in range(len(samples_seen))]) / sum(samples_seen)
+
+
+    def pred_cost_stream(self, streams):
+        """
+        The per-token cost over the windows of some parallel streams, with
+        the states carried from window to window. Requires a stateful model.
+        The training states are restored afterwards
+
+        streams : A cutils.data_interface.streams.TokenStreams
+        """
+        saved = [self.layers[name].get_state() for name in ('lstm_1', 'lstm_2')]
+        self.reset_state(streams.n_streams)
+        total_cost = 0.
+        n_targets = 0.
+        for x, mask, _ in streams:
+            # The cost is the mean over the targets of a window
+            total_cost += self.f_stream_cost(x, mask) * mask.sum()
+            n_targets += mask.sum()
+        self.layers['lstm_1'].set_state(saved[0])
+        self.layers['lstm_2'].set_state(saved[1])
+        return total_cost / n_targets
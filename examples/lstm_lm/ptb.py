@@ -6,58 +6,117 @@ from __future__ import print_function
 
 from cutils.data_interface.interface import DataInterface
 import cutils.data_interface.utils as du
+from cutils.data_interface import binarize
+from cutils.data_interface.streams import TokenStreams
 from cutils.dict import Dict
 
 
+# Ends every sentence when the corpus is read as a stream
+EOS = '<EOS>'
+
+
 class PTB(DataInterface):
-    def __init__(self, dataset_path, origin=None, n_words=100000, emb_dim=100):
+    def __init__(self, dataset_path, origin=None, n_words=100000, emb_dim=100,
+                 use_cache=True, dictionary=None, stream=False):
         if dataset_path is None:
             raise Exception('The dataset path was not specified')
         self.dataset_path = dataset_path
         self.origin = origin
-        # Create dictionary
+        # Binarized copies of the dataset are kept next to it
+        self.use_cache = use_cache
+        self.vocab_digest = None
+        # Create dictionary, unless a saved one was given
         self.embedding_dimension = emb_dim
-        self.dictionary = None
+        self.dictionary = dictionary
+        if dictionary is not None:
+            self.vocab_digest = binarize.vocab_digest(dictionary)
+            return
         print("... Building dictionary")
-        self.build_dict(n_words)
+        self.build_dict(n_words, stream)
         print("... Done building dictionary")
 
     def load_data(self, sort_by_len=True):
-        train = self.grab_data(('%s/ptb.train.txt' % self.dataset_path))
-        valid = self.grab_data(('%s/ptb.valid.txt' % self.dataset_path))
-        test = self.grab_data(('%s/ptb.test.txt' % self.dataset_path))
-
-        if sort_by_len:
-            sorted_index = du.len_argsort(train)
-            train = [train[i] for i in sorted_index]
-            sorted_index = du.len_argsort(valid)
-            valid = [valid[i] for i in sorted_index]
-            sorted_index = du.len_argsort(test)
-            test = [test[i] for i in sorted_index]
+        train = self.load_split('train', sort_by_len)
+        valid = self.load_split('valid', sort_by_len)
+        test = self.load_split('test', sort_by_len)
 
         return train, valid, test
 
-    def grab_data(self, input_file):
+    def load_streams(self, n_streams, n_valid_streams, maxlen):
+        """
+        Returns the splits of the dataset as parallel streams of
+        sentences (each followed by EOS), served in windows of maxlen
+        steps for stateful training
+
+        :returns: train, valid and test TokenStreams
+        """
+        train = TokenStreams.from_corpus(
+            self.load_split('train', sort_by_len=False, eos=True),
+            n_streams, maxlen)
+        valid = TokenStreams.from_corpus(
+            self.load_split('valid', sort_by_len=False, eos=True),
+            n_valid_streams, maxlen)
+        test = TokenStreams.from_corpus(
+            self.load_split('test', sort_by_len=False, eos=True),
+            n_valid_streams, maxlen)
+
+        return train, valid, test
+
+    def load_split(self, split, sort_by_len=True, eos=False):
+        """
+        Returns the integerized sentences of one split of the dataset,
+        memory-mapped from the cache when possible
+        """
+        input_file = '%s/ptb.%s.txt' % (self.dataset_path, split)
+
+        def build():
+            seqs = self.grab_data(input_file, eos)
+            if sort_by_len:
+                seqs = seqs.take(du.len_argsort(seqs))
+            return seqs
+
+        if not self.use_cache:
+            return build()
+        digest = binarize.source_digest([input_file],
+                                        vocab=self.vocab_digest,
+                                        sort_by_len=sort_by_len, eos=eos)
+        return binarize.cached_corpus(
+            binarize.cache_prefix(self.dataset_path, 'ptb.' + split, digest),
+            build)
+
+    def grab_data(self, input_file, eos=False):
         """
-        Returns a list of sequences (integerized) corresponding
-        to the sentences in a dataset
+        Returns a RaggedCorpus of sequences (integerized) corresponding
+        to the sentences in a dataset, optionally followed by EOS
         """
-        sentences = []
         with open(input_file, 'r') as tt:
-            for line in tt:
-                sentences.append(line.strip())
-        seqs = [None] * len(sentences)
-        for idx, ss in enumerate(sentences):
-            seqs[idx] = self.dictionary.read_sentence(ss)
-        return seqs
-
-    def build_dict(self, n_words):
-        sentences = []
+            if eos:
+                return self.dictionary.encode_batch(line + ' ' + EOS
+                                                    for line in tt)
+            return self.dictionary.encode_batch(tt)
+
+    def build_dict(self, n_words, stream=False):
+        """
+        Builds the vocabulary of the training split. For streams, EOS is
+        counted once per sentence, as it is read
+        """
         train_text = ('%s/ptb.train.txt' % self.dataset_path)
-        with open(train_text, 'r') as tt:
-            for line in tt:
-                sentences.append(line.strip())
-        self.dictionary = Dict(sentences, n_words, self.embedding_dimension)
+
+        def build():
+            return Dict.from_files([train_text], n_words,
+                                   self.embedding_dimension,
+                                   eos=EOS if stream else None)
+
+        if not self.use_cache:
+            self.dictionary = build()
+            return
+        self.vocab_digest = binarize.source_digest([train_text],
+                                                   n_words=n_words,
+                                                   stream=stream)
+        self.dictionary = binarize.cached_vocab(
+            binarize.cache_prefix(self.dataset_path, 'ptb.vocab',
+                                  self.vocab_digest),
+            build, self.embedding_dimension)
 
     def get_dataset_file(self):
         """Download file if it does not exist"""
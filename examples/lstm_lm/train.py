@@ -11,14 +11,18 @@ import sys
 import time
 import pickle
 import argparse
+from collections import OrderedDict
 import numpy
 import theano
 import theano.tensor as T
 
 from cutils.training.utils import get_minibatches_idx, weight_decay
+from cutils.training.iterators import BucketIterator, Prefetcher
 from cutils.params.utils import zipp, unzip, load_params
 from cutils.data_interface.utils import pad_and_mask
-from cutils.training.trainer import adadelta, sgd
+from cutils.training.trainer import adadelta, sgd, optimizer_state, \
+    load_optimizer_state
+from cutils.dict import Dict
 
 # Include current path in the pythonpath
 script_path = os.path.dirname(os.path.realpath(__file__))
@@ -52,15 +56,35 @@ def train_lstm(
     use_dropout=True,
     reload_model=False,
     decay_lr_after_ep=None,
-    decay_lr_factor=1.
+    decay_lr_factor=1.,
+    stream=False,
+    output='softmax',
+    n_classes=None,
+    cutoffs=None,
+    sampled_k=0
 ):
     model_options = locals().copy()
     print("model options", model_options)
 
     print("... Loading data")
+    dictionary = None
+    if reload_model and os.path.isfile('%s.dict.npz' % load_from):
+        # Resumed runs don't have to rebuild the vocab from the corpus
+        print('Reloading dictionary from %s.dict.npz' % load_from)
+        dictionary = Dict.load('%s.dict.npz' % load_from)
     ptb_data = ptb.PTB(dataset, n_words=n_words,
-                       emb_dim=model_options['dim_proj'])
-    train, valid, test = ptb_data.load_data()
+                       emb_dim=model_options['dim_proj'],
+                       dictionary=dictionary, stream=stream)
+    if save_to:
+        ptb_data.dictionary.save('%s.dict.npz' % save_to,
+                                 include_embedding=False)
+    if stream:
+        # The corpus is read as batch_size parallel streams of sentences,
+        # served in consecutive windows without shuffling or padding
+        train, valid, test = ptb_data.load_streams(batch_size,
+                                                   valid_batch_size, maxlen)
+    else:
+        train, valid, test = ptb_data.load_data()
     print("... Done loading data")
 
     ydim = ptb_data.dictionary.n_words
@@ -69,7 +93,8 @@ def train_lstm(
     print('Building model')
     # Create the initial parameters for the model
     lstm_lm = LSTM_LM(model_options['dim_proj'], ydim,
-                      ptb_data.dictionary, SEED)
+                      ptb_data.dictionary, SEED, output=output,
+                      n_classes=n_classes, cutoffs=cutoffs)
 
     if reload_model:
         print('Reloading params from %s' % load_from)
@@ -78,17 +103,25 @@ def train_lstm(
         zipp(lstm_lm.params, lstm_lm.tparams)
 
     # Create the shared variables for the model
-    (use_noise, x, mask, cost) = lstm_lm.build_model()
+    (use_noise, x, mask, cost) = lstm_lm.build_model(stateful=stream,
+                                                     sampled=sampled_k > 0)
+    # The sampled softmax also takes the candidate words of the batch
+    inputs = [x, mask] + lstm_lm.sample_inputs
+    if sampled_k > 0:
+        sampler = ptb_data.dictionary.noise_sampler
 
     if decay_c > 0.:
         cost += weight_decay(cost, lstm_lm.tparams['U'], decay_c)
 
-    f_cost = theano.function([x, mask], cost, name='f_cost')
+    # Only the training updates advance the carried LSTM states
+    f_cost = theano.function(inputs, cost, name='f_cost',
+                             no_default_updates=True)
     grads = theano.grad(cost, wrt=list(lstm_lm.tparams.values()))
-    f_grad = theano.function([x, mask], grads, name='f_grad')
+    f_grad = theano.function(inputs, grads, name='f_grad',
+                             no_default_updates=True)
 
     lr = T.scalar('lr')
-    f_grad_shared, f_update = optimizer(lr, lstm_lm.tparams, grads, cost, x, mask)
+    f_grad_shared, f_update = optimizer(lr, lstm_lm.tparams, grads, cost, *inputs)
 
     # Keep a few sentences to decode, to see how training is performing
     decode_use_noise, _, _, _ = lstm_lm.build_decode()
@@ -101,6 +134,19 @@ def train_lstm(
 
     kf_valid = get_minibatches_idx(len(valid), valid_batch_size)
     kf_test = get_minibatches_idx(len(test), valid_batch_size)
+    if stream:
+        train_batches = train
+    else:
+        # Batches of similar length sentences, reshuffled at every epoch
+        # Truncated backprop. The smaller last batch of every bucket is
+        # kept, so that no sentence is left out of an epoch
+        train_batches = BucketIterator(train, batch_size, maxlen=maxlen,
+                                       use_remaining=True)
+
+    def evaluate(data, iterator):
+        if stream:
+            return lstm_lm.pred_cost_stream(data)
+        return lstm_lm.pred_cost(data, iterator)
 
     print('%d train examples' % len(train))
     print('%d valid examples' % len(valid))
@@ -108,35 +154,76 @@ def train_lstm(
 
     history_errs = []
     best_p = None
-    bad_count = 0
+    bad_counter = 0
 
+    # TokenStreams have one item per batch, so len(train) is an epoch
+    epoch_updates = len(train) if stream else len(train) // batch_size
     if valid_freq == -1:
-        valid_freq = len(train) // batch_size
+        valid_freq = epoch_updates
     if save_freq == -1:
-        save_freq = len(train) // batch_size
+        save_freq = epoch_updates
 
     uidx = 0  # The number of updates done
+    first_epoch = 0
+    # The window of the streams where the first epoch starts
+    stream_start = 0
+    if reload_model:
+        checkpoint = numpy.load(load_from)
+        if ('stream_epoch' if stream else 'iterator_epoch') in checkpoint:
+            # Carry on mid-epoch, from the batch after the checkpoint. The
+            # params loaded above are the weights at that batch
+            if stream:
+                first_epoch = int(checkpoint['stream_epoch'])
+                stream_start = int(checkpoint['stream_position'])
+                lstm_lm.load_state_dict(checkpoint)
+            else:
+                train_batches.load_state_dict(checkpoint)
+                first_epoch = train_batches.epoch
+            load_optimizer_state(checkpoint, lstm_lm.tparams, f_grad_shared,
+                                 f_update)
+            best_keys = ['best_' + kk for kk in lstm_lm.params]
+            if all(kk in checkpoint for kk in best_keys):
+                best_p = OrderedDict((kk, checkpoint['best_' + kk])
+                                     for kk in lstm_lm.params)
+            uidx = int(checkpoint['uidx'])
+            lrate = float(checkpoint['lrate'])
+            bad_counter = int(checkpoint['bad_counter'])
+            history_errs = checkpoint['history_errs'].tolist()
+            print('Resuming from epoch %d, update %d' % (first_epoch, uidx))
     estop = False  # Early stop
     start_time = time.time()
     try:
-        for eidx in range(max_epochs):
+        for eidx in range(first_epoch, max_epochs):
             n_samples = 0
-            # Get shuffled index for the training set
-            kf = get_minibatches_idx(len(train), batch_size,
-                                     shuffle=True, use_remaining=False)
-            for _, train_index in kf:
+            # The number of batches of the epoch used so far. Prefetching
+            # runs ahead of it
+            if stream:
+                # A resumed epoch starts with the states of the checkpoint
+                if stream_start == 0:
+                    lstm_lm.reset_state(batch_size)
+                n_batches = stream_start
+                epoch_batches = (train[i] for i in
+                                 range(stream_start, len(train)))
+                stream_start = 0
+            else:
+                n_batches = train_batches.start_position()
+                epoch_batches = train_batches
+            # Batches come padded, with shape (minibatch maxlen, n samples)
+            # The next few are prepared in the background
+            for x, mask, _ in Prefetcher(epoch_batches):
                 uidx += 1
+                n_batches += 1
                 use_noise.set_value(1.)
-
-                # Select the random examples in this minibatch
-                x = [train[t] for t in train_index]
-
-                # Convert to shape (minibatch maxlen, n samples)
-                # Truncated backprop
-                x, mask, _ = pad_and_mask(x, maxlen=maxlen)
                 n_samples += x.shape[1]
 
-                cost = f_grad_shared(x, mask)
+                if sampled_k > 0:
+                    # sampled_k words from the unigram distribution and the
+                    # targets of the batch
+                    candidates, log_q = sampler.sample_candidates(
+                        sampled_k, numpy.roll(x, -1, 0)[mask > 0])
+                    cost = f_grad_shared(x, mask, candidates, log_q)
+                else:
+                    cost = f_grad_shared(x, mask)
                 f_update(lrate)
 
                 if numpy.isnan(cost) or numpy.isinf(cost):
@@ -146,21 +233,10 @@ def train_lstm(
                 if numpy.mod(uidx, disp_freq) == 0:
                     print('Epoch ', eidx, 'Update ', uidx, 'Cost ', cost)
 
-                if save_to and numpy.mod(uidx, save_freq) == 0:
-                    print('Saving...')
-                    if best_p is not None:
-                        lstm_lm.params = best_p
-                    else:
-                        lstm_lm.params = unzip(lstm_lm.tparams)
-                    numpy.savez(save_to, history_errs=history_errs, **lstm_lm.params)
-                    pickle.dump(model_options, open('%s.pkl' % save_to, 'wb'),
-                                -1)
-                    print('Done')
-
                 if numpy.mod(uidx, valid_freq) == 0:
                     use_noise.set_value(0.)
-                    valid_cost = lstm_lm.pred_cost(valid, kf_valid)
-                    test_cost = lstm_lm.pred_cost(test, kf_test)
+                    valid_cost = evaluate(valid, kf_valid)
+                    test_cost = evaluate(test, kf_test)
                     history_errs.append([valid_cost, test_cost])
 
                     if (best_p is None or valid_cost <=
@@ -182,7 +258,36 @@ def train_lstm(
                             estop = True
                             break
 
+                # After validating, so that the checkpoint includes the
+                # validation of this update
+                if save_to and numpy.mod(uidx, save_freq) == 0:
+                    print('Saving...')
+                    # The current weights, with the optimizer and batch
+                    # states, to resume from. The best weights so far are
+                    # kept under 'best_' keys
+                    checkpoint = unzip(lstm_lm.tparams)
+                    checkpoint.update(optimizer_state(
+                        lstm_lm.tparams, f_grad_shared, f_update))
+                    if best_p is not None:
+                        checkpoint.update(('best_' + kk, vv)
+                                          for kk, vv in best_p.items())
+                    if stream:
+                        checkpoint.update(lstm_lm.state_dict())
+                        checkpoint.update(stream_epoch=eidx,
+                                          stream_position=n_batches)
+                    else:
+                        checkpoint.update(train_batches.state_dict(n_batches))
+                    numpy.savez(save_to, history_errs=history_errs, uidx=uidx,
+                                lrate=lrate, bad_counter=bad_counter,
+                                **checkpoint)
+                    pickle.dump(model_options, open('%s.pkl' % save_to, 'wb'),
+                                -1)
+                    print('Done')
+
             print('Seen %d samples' % n_samples)
+            if not stream:
+                print('Padding efficiency %.3f' %
+                      train_batches.padding_efficiency())
             # Decay learning rate
             if (eidx + 1) >= decay_lr_after_ep:
                 lrate = lrate / decay_lr_factor
@@ -204,9 +309,9 @@ def train_lstm(
     # Note that the training dataset is sorted by length.
     # This is for faster decoding, since padding will create smaller batch matrices
     kf_train_sorted = get_minibatches_idx(len(train), batch_size)
-    train_cost = lstm_lm.pred_cost(train, kf_train_sorted)
-    valid_cost = lstm_lm.pred_cost(valid, kf_valid)
-    test_cost = lstm_lm.pred_cost(test, kf_test)
+    train_cost = evaluate(train, kf_train_sorted)
+    valid_cost = evaluate(valid, kf_valid)
+    test_cost = evaluate(test, kf_test)
 
     print('Train ', train_cost, 'Valid ', valid_cost, 'Test ', test_cost)
 
@@ -256,6 +361,18 @@ if __name__ == '__main__':
         start decaying the learning rate? Useful for SGD only', default=10000)
     parser.add_argument('--decay-lr-factor', type=float, help='How much should we decay the learning \
         rate by? Useful for SGD only.', default=1.2)
+    parser.add_argument('--stream', action='store_true', help='Train on batch-size parallel streams \
+        of the corpus, carrying the LSTM states from one window of maxlen words to the next')
+    parser.add_argument('--output', type=str, choices=['softmax', 'hsoftmax', 'adaptive'], help='The \
+        output layer: a full softmax, a softmax factored into classes of words or an adaptive \
+        softmax', default='softmax')
+    parser.add_argument('--n-classes', type=int, help='The number of word classes of the hsoftmax \
+        output. Defaults to the square root of the vocabulary size', default=None)
+    parser.add_argument('--cutoffs', type=int, nargs='+', help='The frequency ranks where the \
+        clusters of the adaptive output start, eg. 2000 10000', default=None)
+    parser.add_argument('--sampled-k', type=int, help='Train with a sampled softmax over this many \
+        words drawn from the unigram distribution, plus the targets of the batch. The valid and test \
+        costs use the full softmax. 0 trains with the full softmax', default=0)
 
     args = parser.parse_args()
 
@@ -288,5 +405,10 @@ if __name__ == '__main__':
         use_dropout=args.use_dropout,
         reload_model=args.reload_model,
         decay_lr_after_ep=args.decay_lr_after_ep,
-        decay_lr_factor=args.decay_lr_factor
+        decay_lr_factor=args.decay_lr_factor,
+        stream=args.stream,
+        output=args.output,
+        n_classes=args.n_classes,
+        cutoffs=args.cutoffs,
+        sampled_k=args.sampled_k
     )
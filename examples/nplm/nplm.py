@@ -1,10 +1,13 @@
 import os
+from functools import partial
+
 import theano
 import theano.tensor as T
 
 import cutils.regularization as reg
 from cutils.layers.dense_layer import DenseLayer
 from cutils.layers.logistic_regression import LogisticRegression
+from cutils.layers.adaptive_softmax import AdaptiveSoftmax
 from cutils.layers.utils import dropout_layer
 from cutils.numeric import numpy_floatX
 
@@ -27,7 +30,8 @@ class NPLM(object):
     def __init__(self, rng, input, n_in, n_h1, n_h2, n_out,
                  use_dropout=False, trng=None, dropout_p=0.5,
                  use_noise=theano.shared(numpy_floatX(0.)),
-                 use_nce=False):
+                 use_nce=False, output='softmax', word_freq=None,
+                 cutoffs=None):
         """Initialize the parameters for the multilayer perceptron
 
         :type rng: numpy.random.RandomState
@@ -48,6 +52,18 @@ class NPLM(object):
         :param n_out: number of output units, the dimension of the space in
         which the labels lie
 
+        :type output: string
+        :param output: The output layer, 'softmax' or 'adaptive' for an
+        adaptive softmax (see cutils.layers.adaptive_softmax)
+
+        :type word_freq: numpy.ndarray
+        :param word_freq: The frequency counts of the n_out words, used to
+        create the clusters of the adaptive softmax
+
+        :type cutoffs: list(int)
+        :param cutoffs: The frequency ranks where the clusters of the
+        adaptive softmax start
+
         """
 
         # This first hidden layer
@@ -83,24 +99,39 @@ class NPLM(object):
             log_reg_input = dropout_layer(self.h2.output, use_noise,
                                           trng, dropout_p)
 
-        # The logistic regression layer
-        self.log_regression_layer = LogisticRegression(
-            input=log_reg_input,
-            n_in=n_h2,
-            n_out=n_out
-        )
-
-        # Use L2 regularization, for the log-regression layer only
-        self.L2 = reg.L2([self.log_regression_layer.W])
-        # Get the NLL loss function from the logistic regression layer
-        if use_nce:
-            self.loss = self.log_regression_layer.nce_loss
+        if output == 'adaptive':
+            if use_nce:
+                raise ValueError('NCE needs the softmax output')
+            # Frequent words get a full softmax, rarer ones are clustered
+            self.log_regression_layer = AdaptiveSoftmax(
+                word_freq[:n_out], n_h2, cutoffs=cutoffs, prefix='logit')
+            output_params = list(self.log_regression_layer.tparams.values())
+            # Use L2 regularization, for the weights of the output layer only
+            self.L2 = reg.L2([self.log_regression_layer.tparams[name] for name
+                              in self.log_regression_layer.weight_names])
+            self.loss = partial(self.log_regression_layer.loss,
+                                log_reg_input)
         else:
-            self.loss = self.log_regression_layer.loss
+            # The logistic regression layer
+            self.log_regression_layer = LogisticRegression(n_out, n_h2,
+                                                           ortho=False)
+            self.log_regression_layer.logit_layer(log_reg_input)
+            W = self.log_regression_layer.tparams['logit_W']
+            b = self.log_regression_layer.tparams['logit_b']
+            output_params = [W, b]
+
+            # Use L2 regularization, for the log-regression layer only
+            self.L2 = reg.L2([W])
+            # Get the NLL loss function from the logistic regression layer
+            if use_nce:
+                # Only scores the targets and the noise samples
+                self.loss = partial(self.log_regression_layer.sparse_nce_loss,
+                                    log_reg_input)
+            else:
+                self.loss = self.log_regression_layer.loss
 
         # Bundle params (to be used for computing gradients)
-        self.params = self.h1.params + self.h2.params + \
-            self.log_regression_layer.params
+        self.params = self.h1.params + self.h2.params + output_params
 
         # Keeo track of the input (For debugging only)
         self.input = input
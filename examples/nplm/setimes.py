@@ -4,14 +4,23 @@ import theano
 import theano.tensor as T
 
 from cutils.data_interface.interface import DataInterface
-from cutils.data_interface.utils import create_subset
+from cutils.data_interface import binarize
+from cutils.data_interface.ngram import NgramWindows
 from cutils.dict import Dict
 from cutils.numeric import numpy_floatX
 
 
+BOS = '<BOS>'
+EOS = '<EOS>'
+
+
 class SeTimes(DataInterface):
-    def __init__(self, dataset_path, n_words=100000, emb_dim=100):
+    def __init__(self, dataset_path, n_words=100000, emb_dim=100,
+                 use_cache=True):
         self.dataset_path = dataset_path
+        # Binarized copies of the dataset are kept next to it
+        self.use_cache = use_cache
+        self.vocab_digest = None
         if os.path.isfile(os.getcwd() + "/" + dataset_path):
             self.dataset_path = os.getcwd() + "/" + dataset_path
         if not os.path.isfile(dataset_path):
@@ -26,34 +35,58 @@ class SeTimes(DataInterface):
         raise NotImplementedError
 
     def load_data(self, context_size=4, valid_portion=0.1):
-        sentences = []
-        prefix = ' '.join(['<BOS>'] * context_size) + ' '
-        suffix = ' <EOS>'
-        with open(self.dataset_path) as f:
-            for l in f:
-                sentences.append(prefix + l.strip() + suffix)
-        train_x = []
-        train_y = []
-        for ss in sentences:
-            ss_d = self.dictionary.read_sentence(ss)
-            windows = [(ss_d[i:i+context_size], ss_d[i+context_size])
-                       for i in range(len(ss_d) - context_size)]
-            for w in windows:
-                train_x.append(w[0])
-                train_y.append(w[1])
-        train_set = (train_x, train_y)
-
-        valid_set = ([], [])
-        if valid_portion > 0.:
-            train_set, valid_set = create_subset(train_set, valid_portion)
-
-        return train_set, valid_set
+        """
+        Returns the (context, target) windows over the whole corpus, split
+        into a train range and a valid range (the last valid_portion of the
+        windows). Both are NgramWindows views of the same token stream
+        """
+        windows = NgramWindows.from_corpus(self.grab_data(), context_size,
+                                           self.dictionary.worddict[BOS])
+        return windows.split(valid_portion)
+
+    def grab_data(self):
+        """
+        Returns the integerized sentences, each followed by an EOS marker,
+        memory-mapped from the cache when possible
+        """
+        def build():
+            with open(self.dataset_path) as f:
+                return self.dictionary.encode_batch(
+                    l.strip() + ' ' + EOS for l in f)
+
+        if not self.use_cache:
+            return build()
+        digest = binarize.source_digest([self.dataset_path],
+                                        vocab=self.vocab_digest, eos=EOS)
+        return binarize.cached_corpus(
+            binarize.cache_prefix(os.path.dirname(self.dataset_path),
+                                  os.path.basename(self.dataset_path),
+                                  digest),
+            build)
 
     def build_dict(self, n_words):
-        sentences = []
-        prefix = "$BOS$ $BOS$ $BOS$ $BOS$ "
-        suffix = " $EOS$"
-        with open(self.dataset_path) as f:
-            for l in f:
-                sentences.append(prefix + l.strip() + suffix)
-        self.dictionary = Dict(sentences, n_words, self.embedding_dimension)
+        def build():
+            # BOS is counted once per sentence, so that it is always
+            # retained in the vocab
+            with open(self.dataset_path) as f:
+                dictionary = Dict(('%s %s %s' % (BOS, l.strip(), EOS)
+                                   for l in f),
+                                  n_words, self.embedding_dimension)
+            # It only pads the first contexts and is never a target, so it
+            # gets no share of the NCE noise distribution
+            dictionary.word_freq[dictionary.worddict[BOS]] = 0
+            return dictionary
+
+        if not self.use_cache:
+            self.dictionary = build()
+            return
+        self.vocab_digest = binarize.source_digest([self.dataset_path],
+                                                   n_words=n_words,
+                                                   bos=BOS, eos=EOS,
+                                                   bos_freq=0)
+        self.dictionary = binarize.cached_vocab(
+            binarize.cache_prefix(os.path.dirname(self.dataset_path),
+                                  os.path.basename(self.dataset_path)
+                                  + '.vocab',
+                                  self.vocab_digest),
+            build, self.embedding_dimension)
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 import theano
@@ -9,6 +10,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from cutils.training.trainer import sgd
 from cutils.training.utils import get_minibatches_idx
+from cutils.training.iterators import Prefetcher
 from cutils.numeric import numpy_floatX
 
 # Include current path in the pythonpath
@@ -23,7 +25,9 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
                               n_epochs=1000, dataset='../../data/settimes',
                               batch_size=1000, n_in=150, n_h1=750, n_h2=150,
                               context_size=4, use_nce=False, nce_k=100,
-                              use_dropout=False, dropout_p=0.5):
+                              nce_power=1., nce_shared=False,
+                              use_dropout=False, dropout_p=0.5,
+                              output='softmax', cutoffs=None):
     SEED = 1234
 
     st_data = SeTimes(dataset, emb_dim=n_in)
@@ -35,7 +39,6 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
     # Symbolic variables for input and output for a batch
     x = T.imatrix('x')
     y = T.ivector('y')
-    y_flat = T.ivector('y_flat')
     lr = T.scalar(name='lr')
     k = T.scalar(name='k')
 
@@ -46,8 +49,16 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
     trng = RandomStreams(SEED)
     use_noise = theano.shared(numpy_floatX(0.))
 
-    nce_q = st_data.dictionary.noise_distribution
-    nce_samples = T.matrix('noise_s')
+    if use_nce:
+        st_data.dictionary.set_noise_power(nce_power)
+        nce_q = st_data.dictionary.noise_distribution
+        nce_sampler = st_data.dictionary.noise_sampler
+    # The (batch x k) indices of the noise samples, or k indices shared by
+    # the whole batch
+    if nce_shared:
+        nce_samples = T.ivector('noise_s')
+    else:
+        nce_samples = T.imatrix('noise_s')
 
     model = NPLM(
         rng=rng,
@@ -56,18 +67,20 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
         n_h1=n_h1,
         n_h2=n_h2,
         n_out=st_data.dictionary.num_words(),
-        use_nce=use_nce
+        use_nce=use_nce,
+        output=output,
+        word_freq=st_data.dictionary.word_freq,
+        cutoffs=cutoffs
     )
 
     tparams = OrderedDict()
     for i, nplm_m in enumerate(model.params):
         tparams['nplm_' + str(i)] = nplm_m
-    tparams['Wemb'] = st_data.dictionary.Wemb
+    tparams['Wemb'] = st_data.dictionary.tparams['Wemb']
 
     # Cost to minimize
     if use_nce:
-        #cost = model.loss(y, nce_samples, nce_q)
-        cost = model.loss(y, y_flat, nce_samples, nce_q, k)
+        cost = model.loss(y, nce_samples, nce_q, k)
     else:
         # MLE via softmax
         cost = model.loss(y)
@@ -77,64 +90,55 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
     grads = T.grad(cost, wrt=list(tparams.values()))
 
     if use_nce:
-        f_cost = theano.function([x, y, y_flat, nce_samples, k],
+        f_cost = theano.function([x, y, nce_samples, k],
                                  cost, name='f_cost')
         f_grad_shared, f_update = sgd(lr, tparams, grads,
-                                      cost, x, y, y_flat, nce_samples, k)
+                                      cost, x, y, nce_samples, k)
     else:
         f_cost = theano.function([x, y], cost, name='f_cost')
-        f_grad_shared, f_update = gd(lr, tparams, grads,
-                                     cost, x, y)
+        f_grad_shared, f_update = sgd(lr, tparams, grads,
+                                      cost, x, y)
 
     print("... Optimization")
-    kf_valid = get_minibatches_idx(len(valid[0]), batch_size)
-    print("%d training examples" % len(train[0]))
-    print("%d valid examples" % len(valid[0]))
+    kf_valid = get_minibatches_idx(len(valid), batch_size)
+    print("%d training examples" % len(train))
+    print("%d valid examples" % len(valid))
 
     disp_freq = 10
-    valid_freq = len(train[0]) // batch_size
-    save_freq = len(train[0]) // batch_size
+    valid_freq = len(train) // batch_size
+    save_freq = len(train) // batch_size
 
     uidx = 0
     estop = False
     start_time = time.time()
-    total_output_words = st_data.dictionary.num_words()
+
+    def make_batch(train_index):
+        # The contexts are gathered straight from the token stream
+        x_batch, y_batch = train.get_batch(train_index)
+
+        local_batch_size = x_batch.shape[0]
+        if not use_nce:
+            return x_batch, y_batch, None
+        # Create noise samples to be passed as well, drawn from the same
+        # distribution as nce_q
+        # Expected size is (bs, k), as word indices
+        noisy_samples = nce_sampler.sample_batch(local_batch_size, nce_k,
+                                                 shared=nce_shared)
+        return x_batch, y_batch, noisy_samples
+
     for eidx in range(n_epochs):
         n_samples = 0
         # Shuffle and get training stuff
-        kf = get_minibatches_idx(len(train[0]), batch_size, shuffle=True)
-        for _, train_index in kf:
+        kf = get_minibatches_idx(len(train), batch_size, shuffle=True)
+        # The next few batches are prepared in the background
+        batches = Prefetcher((train_index for _, train_index in kf),
+                             transform=make_batch)
+        for x_batch, y_batch, noisy_samples in batches:
             uidx += 1
             use_noise.set_value(1.)
 
-            x_batch = [train[0][t] for t in train_index]
-            y_batch = [train[1][t] for t in train_index]
-            y_f_batch = [train[1][t] + i * st_data.dictionary.num_words()
-                         for i, t in enumerate(train_index)]
-            # Convert x and y into numpy objects
-            x_batch = numpy.asarray(x_batch, dtype='int32')
-            y_batch = numpy.asarray(y_batch, dtype='int32')
-            y_f_batch = numpy.asarray(y_f_batch, dtype='int32')
-
-            local_batch_size = x_batch.shape[0]
             if use_nce:
-                # Create noise samples to be passed as well
-                # Expected size is (bs, k)
-                # Don't sample UNK and PAD
-                noisy_samples = numpy.zeros((local_batch_size,
-                                             st_data.dictionary.num_words()),
-                                            dtype='float32')
-                # The following will mask approximately (repeats permitted) 100
-                # values with the value 1. This represents the noise samples in
-                # the vocab
-                noisy_samples[
-                    numpy.arange(local_batch_size).reshape(local_batch_size,
-                                                           1),
-                    numpy.random.randint(2, total_output_words,
-                                         size=(local_batch_size, nce_k))
-                ] = 1.
-                loss = f_grad_shared(x_batch, y_batch, y_f_batch,
-                                     noisy_samples, nce_k)
+                loss = f_grad_shared(x_batch, y_batch, noisy_samples, nce_k)
             else:
                 loss = f_grad_shared(x_batch, y_batch)
             f_update(learning_rate)
@@ -149,8 +153,23 @@ def sgd_optimization_nplm_mlp(learning_rate=1., L1_reg=0.0, L2_reg=0.0001,
 
     end_time = time.time()
     print('Training took %.1fs' % (end_time - start_time))
-    f_grad_shared.profile.print_summary()
+    if f_grad_shared.profile is not None:
+        f_grad_shared.profile.summary()
 
 
 if __name__ == '__main__':
-    sgd_optimization_nplm_mlp(dataset=sys.argv[1], use_nce=True)
+    parser = argparse.ArgumentParser(description='Neural probabilistic language model')
+    parser.add_argument('dataset', type=str, help='Location of the dataset')
+    parser.add_argument('--output', type=str, choices=['softmax', 'adaptive'], help='The output \
+        layer: a softmax (trained with NCE unless --no-nce is set) or an adaptive softmax', \
+        default='softmax')
+    parser.add_argument('--cutoffs', type=int, nargs='+', help='The frequency ranks where the \
+        clusters of the adaptive output start, eg. 2000 10000', default=None)
+    parser.add_argument('--no-nce', action='store_true', help='Train the softmax output with the \
+        full likelihood instead of NCE')
+
+    args = parser.parse_args()
+
+    sgd_optimization_nplm_mlp(dataset=args.dataset,
+                              use_nce=args.output == 'softmax' and not args.no_nce,
+                              output=args.output, cutoffs=args.cutoffs)
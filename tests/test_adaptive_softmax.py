@@ -0,0 +1,38 @@
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+import theano.tensor as T
+
+from cutils.layers.adaptive_softmax import AdaptiveSoftmax
+
+WORD_FREQ = numpy.random.RandomState(0).zipf(1.5, 30)
+
+
+@pytest.mark.parametrize('cutoffs', [[], [8], [5, 12, 20]])
+def test_log_prob_matches_log_prob_all(cutoffs):
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1234)
+    layer = AdaptiveSoftmax(WORD_FREQ, 16, cutoffs=cutoffs, div_value=2)
+    for param in layer.tparams.values():
+        param.set_value(rng.randn(*param.get_value().shape).astype(floatX))
+    x = T.matrix('x')
+    y = T.ivector('y')
+    f = theano.function([x, y], [layer.log_prob(x, y),
+                                 layer.log_prob_all(x)])
+
+    n_words = len(WORD_FREQ)
+    x_val = rng.randn(2 * n_words, 16).astype(floatX)
+    y_val = numpy.tile(rng.permutation(n_words), 2).astype('int32')
+    log_p, log_p_all = f(x_val, y_val)
+    assert log_p_all.shape == (2 * n_words, n_words)
+    numpy.testing.assert_allclose(numpy.exp(log_p_all).sum(axis=1), 1.,
+                                  rtol=1e-5)
+    numpy.testing.assert_allclose(
+        log_p, log_p_all[numpy.arange(len(y_val)), y_val], rtol=1e-5)
+
+
+@pytest.mark.parametrize('cutoffs', [[0, 5], [12, 5], [5, 5], [5, 30]])
+def test_invalid_cutoffs(cutoffs):
+    with pytest.raises(ValueError):
+        AdaptiveSoftmax(WORD_FREQ, 16, cutoffs=cutoffs)
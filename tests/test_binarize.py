@@ -0,0 +1,124 @@
+import os
+
+import numpy
+
+from cutils.data_interface import binarize
+from cutils.data_interface.parallel import ParallelCorpus
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.token_cache import TokenizationCache
+
+SEQS = [[3, 1, 4], [1], [5, 9, 2, 6], [], [5, 3]]
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def test_corpus_round_trip(tmpdir):
+    prefix = str(tmpdir.join('corpus'))
+    assert binarize.load_corpus(prefix) is None
+    binarize.save_corpus(prefix, RaggedCorpus.from_sequences(SEQS))
+    corpus = binarize.load_corpus(prefix)
+    assert isinstance(corpus.tokens, numpy.memmap)
+    assert corpus.to_list() == SEQS
+
+
+def test_parallel_corpus_round_trip(tmpdir):
+    prefix = str(tmpdir.join('pairs'))
+    pairs = ParallelCorpus(RaggedCorpus.from_sequences(SEQS),
+                           RaggedCorpus.from_sequences(SEQS[::-1]))
+    binarize.save_parallel_corpus(prefix, pairs)
+    loaded = binarize.load_parallel_corpus(prefix)
+    assert loaded.source.to_list() == SEQS
+    assert loaded.target.to_list() == SEQS[::-1]
+
+
+def test_cached_corpus_builds_once(tmpdir):
+    prefix = str(tmpdir.join('corpus'))
+    calls = []
+
+    def build():
+        calls.append(1)
+        return RaggedCorpus.from_sequences(SEQS)
+
+    for _ in range(2):
+        assert binarize.cached_corpus(prefix, build).to_list() == SEQS
+    assert len(calls) == 1
+
+
+def test_source_digest(tmpdir):
+    a = write(str(tmpdir.join('a.txt')), 'ab')
+    b = write(str(tmpdir.join('b.txt')), 'c')
+    digest = binarize.source_digest([a, b], n_words=10)
+    assert digest == binarize.source_digest([a, b], n_words=10)
+    assert digest != binarize.source_digest([b, a], n_words=10)
+    assert digest != binarize.source_digest([a, b], n_words=11)
+    # The boundaries between files are part of the digest
+    write(a, 'a')
+    write(b, 'bc')
+    assert digest != binarize.source_digest([a, b], n_words=10)
+
+
+def test_stat_digest(tmpdir):
+    a = write(str(tmpdir.join('a.txt')), 'ab')
+    digest = binarize.stat_digest([a], n_words=10)
+    assert digest == binarize.stat_digest([a], n_words=10)
+    assert digest != binarize.stat_digest([a], n_words=11)
+    os.utime(a, (0, 1000))
+    assert digest != binarize.stat_digest([a], n_words=10)
+
+
+def make_files(tmpdir):
+    return [write(str(tmpdir.join('%d.txt' % i)), text)
+            for i, text in enumerate(['Hello, World!', 'It costs $5.'])]
+
+
+def read_lines(paths):
+    lines = []
+    for path in paths:
+        with open(path) as f:
+            lines.extend(f.read().splitlines())
+    return lines
+
+
+def test_token_cache(tmpdir):
+    paths = make_files(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    expected = ['hello , world !', 'it costs $ 5 .']
+    cache = TokenizationCache(cache_dir, lowercase=True)
+    assert cache.tokenize(paths, lambda: read_lines(paths)) == expected
+
+    # Another run reads the entry from disk
+    def fail():
+        raise AssertionError('The text was tokenized again')
+
+    cache = TokenizationCache(cache_dir, lowercase=True)
+    assert cache.tokenize(paths, fail) == expected
+    # Different options make a different entry
+    cache = TokenizationCache(cache_dir)
+    assert cache.tokenize(paths, lambda: read_lines(paths)) == \
+        ['Hello , World !', 'It costs $ 5 .']
+
+
+def test_token_cache_stat_keys(tmpdir):
+    paths = make_files(tmpdir)
+    cache = TokenizationCache(str(tmpdir.join('cache')), stat_keys=True)
+    cache.tokenize(paths, lambda: read_lines(paths))
+    write(paths[0], 'Bye.')
+    assert cache.tokenize(paths, lambda: read_lines(paths)) == \
+        ['Bye .', 'It costs $ 5 .']
+
+
+def test_token_cache_eviction(tmpdir):
+    paths = make_files(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    cache = TokenizationCache(cache_dir, max_bytes=1)
+    cache.tokenize(paths[:1], lambda: read_lines(paths[:1]))
+    cache.tokenize(paths[1:], lambda: read_lines(paths[1:]))
+    # Only the newest entry is left
+    newest = [digest for digest, lines in cache.memo.items()
+              if lines == ['It costs $ 5 .']]
+    assert os.listdir(cache_dir) == \
+        [os.path.basename(cache.entry_path(newest[0]))]
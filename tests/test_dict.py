@@ -0,0 +1,144 @@
+from collections import Counter
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from cutils.dict import AliasSampler, Dict
+
+
+def make_dict():
+    return Dict(['the cat sat', 'the dog sat on the mat'], 100, 4)
+
+
+def test_idx_to_words():
+    dictionary = make_dict()
+    sentences = [dictionary.read_sentence('the cat sat'),
+                 dictionary.read_sentence('the dog sat')]
+    idx = numpy.asarray(sentences, dtype='int32').T
+    assert dictionary.idx_to_words(idx) == ['the cat sat', 'the dog sat']
+
+
+def test_idx_to_words_stop_at():
+    dictionary = make_dict()
+    the, cat, sat = dictionary.read_sentence('the cat sat')
+    # T x N, the second column is padded and the third has no stop token
+    idx = numpy.asarray([[the, the, cat],
+                         [cat, sat, cat],
+                         [0, 0, sat],
+                         [sat, 0, the]], dtype='int32')
+    assert dictionary.idx_to_words(idx, stop_at=[0]) == \
+        ['the cat', 'the sat', 'cat cat sat the']
+    assert dictionary.idx_to_words(idx, stop_at=[0, sat]) == \
+        ['the cat', 'the', 'cat cat']
+
+
+def write_corpus(path, n_lines=500, seed=0):
+    rng = numpy.random.RandomState(seed)
+    lines = [' '.join('w%d' % w for w in rng.zipf(1.5, rng.randint(1, 20)))
+             for _ in range(n_lines)]
+    with open(path, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+    return lines
+
+
+def test_save_load_round_trip(tmpdir):
+    dictionary = make_dict()
+    path = str(tmpdir.join('dict.npz'))
+    dictionary.save(path)
+    loaded = Dict.load(path)
+    assert loaded.vocab() == dictionary.vocab()
+    assert loaded.worddict == dictionary.worddict
+    numpy.testing.assert_array_equal(loaded.word_freq, dictionary.word_freq)
+    numpy.testing.assert_array_equal(
+        loaded.tparams['Wemb'].get_value(),
+        dictionary.tparams['Wemb'].get_value())
+
+    dictionary.save(path, include_embedding=False)
+    assert Dict.load(path).embedding_size == 4
+    assert Dict.load(path, 7).tparams['Wemb'].get_value().shape == \
+        (dictionary.n_words, 7)
+
+
+def test_from_files_parallel_counts(tmpdir):
+    path = str(tmpdir.join('corpus.txt'))
+    lines = write_corpus(path)
+    counts = Counter(' '.join(lines).split())
+    for eos in (None, '<eos>'):
+        single = Dict.from_files([path, path], 30, 4, eos=eos)
+        # Many shards, with boundaries in the middle of lines
+        parallel = Dict.from_files([path, path], 30, 4, workers=3, eos=eos)
+        assert parallel.vocab() == single.vocab()
+        numpy.testing.assert_array_equal(parallel.word_freq,
+                                         single.word_freq)
+        assert parallel.word_freq.sum() == \
+            2 * (sum(counts.values()) + (eos is not None) * len(lines))
+    for word, idx in single.worddict.items():
+        expected = 2 * len(lines) if word == '<eos>' else 2 * counts[word]
+        if idx > 1:
+            assert single.word_freq[idx] == expected
+
+
+def test_alias_sampler_distribution():
+    probs = numpy.asarray([0., 5., 1., 3., 0., 1.])
+    rng = numpy.random.RandomState(1234)
+    for power in (1., 0.5):
+        sampler = AliasSampler(probs, power)
+        expected = probs ** power / (probs ** power).sum()
+        numpy.testing.assert_allclose(sampler.probs, expected)
+        samples = sampler.sample((200000,), rng)
+        assert samples.dtype == numpy.int32
+        freq = numpy.bincount(samples, minlength=len(probs)) / 200000.
+        numpy.testing.assert_allclose(freq, expected, atol=5e-3)
+        # Impossible outcomes are never drawn
+        assert freq[0] == 0 and freq[4] == 0
+
+
+def test_alias_sampler_batch_shapes():
+    sampler = AliasSampler(numpy.ones((10,)))
+    assert sampler.sample_batch(4, 3).shape == (4, 3)
+    assert sampler.sample_batch(4, 3, shared=True).shape == (3,)
+
+
+def test_encode_batch():
+    dictionary = make_dict()
+    lines = ['the cat sat', 'a dog', '', 'on the mat the end'] * 5
+    corpus = dictionary.encode_batch(lines, chunk_size=3)
+    assert corpus.to_list() == [dictionary.read_sentence(l) for l in lines]
+    assert corpus.tokens.dtype == numpy.int32
+    parallel = dictionary.encode_batch(iter(lines), workers=2, chunk_size=3)
+    assert parallel.to_list() == corpus.to_list()
+    assert len(dictionary.encode_batch([])) == 0
+
+
+def test_sample_candidates():
+    probs = numpy.asarray([0., 5., 1., 3., 0., 1., 2., 0.5])
+    sampler = AliasSampler(probs)
+    targets = numpy.asarray([[0, 3], [4, 3]])
+    candidates, log_q = sampler.sample_candidates(
+        5, targets, numpy.random.RandomState(1))
+    assert candidates.dtype == numpy.int32
+    assert log_q.dtype == theano.config.floatX
+    # Sorted, unique and containing every target
+    assert candidates.tolist() == sorted(set(candidates.tolist()))
+    assert set(targets.ravel()) <= set(candidates.tolist())
+    q = sampler.probs[candidates]
+    expected = numpy.log(1 - (1 - q) ** 5)
+    # Targets that are never sampled are not corrected
+    expected[q == 0] = 0.
+    numpy.testing.assert_allclose(log_q, expected, rtol=1e-5)
+
+
+def test_sample_candidates_expected_counts():
+    # log_q is the log of the probability of a word being in the k samples
+    sampler = AliasSampler([8., 4., 2., 1., 1.])
+    rng = numpy.random.RandomState(2)
+    k, n_draws = 3, 20000
+    seen = numpy.zeros((5,))
+    for _ in range(n_draws):
+        candidates, _ = sampler.sample_candidates(k, [], rng)
+        seen[candidates] += 1
+    candidates, log_q = sampler.sample_candidates(k, numpy.arange(5), rng)
+    numpy.testing.assert_allclose(seen / n_draws, numpy.exp(log_q),
+                                  atol=1e-2)
@@ -0,0 +1,58 @@
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+import theano.tensor as T
+
+from cutils.layers.hierarchical_softmax import ClassFactoredSoftmax, \
+    frequency_classes, frequency_ranks
+
+# 11 words, not a multiple of the class size
+WORD_FREQ = numpy.asarray([0, 7, 3, 9, 3, 1, 12, 2, 5, 3, 4])
+
+
+def test_frequency_ranks():
+    # Ties keep their vocab order
+    assert frequency_ranks(WORD_FREQ).tolist() == \
+        [10, 2, 5, 1, 6, 9, 0, 8, 3, 7, 4]
+
+
+def test_frequency_classes():
+    word_class, word_pos, class_size = frequency_classes(WORD_FREQ)
+    assert class_size == 3
+    assert word_class.dtype == numpy.int32 and word_pos.dtype == numpy.int32
+    # The most frequent words are in the first classes
+    assert word_class[numpy.argsort(-WORD_FREQ, kind='mergesort')].tolist() \
+        == [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3]
+    # Every word has its own slot in its class
+    slots = set(zip(word_class.tolist(), word_pos.tolist()))
+    assert len(slots) == len(WORD_FREQ)
+    assert word_pos.max() < class_size
+
+
+def test_frequency_classes_n_classes():
+    word_class, _, class_size = frequency_classes(WORD_FREQ, 2)
+    assert class_size == 6
+    assert numpy.bincount(word_class).tolist() == [6, 5]
+
+
+def test_log_prob_matches_log_prob_all():
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1234)
+    layer = ClassFactoredSoftmax(WORD_FREQ, 5)
+    for param in layer.tparams.values():
+        param.set_value(rng.randn(*param.get_value().shape).astype(floatX))
+    x = T.matrix('x')
+    y = T.ivector('y')
+    f = theano.function([x, y], [layer.log_prob(x, y),
+                                 layer.log_prob_all(x)])
+
+    x_val = rng.randn(len(WORD_FREQ), 5).astype(floatX)
+    y_val = rng.permutation(len(WORD_FREQ)).astype('int32')
+    log_p, log_p_all = f(x_val, y_val)
+    assert log_p_all.shape == (len(WORD_FREQ), len(WORD_FREQ))
+    # A distribution over the vocabulary, the padding slots get nothing
+    numpy.testing.assert_allclose(numpy.exp(log_p_all).sum(axis=1), 1.,
+                                  rtol=1e-5)
+    numpy.testing.assert_allclose(
+        log_p, log_p_all[numpy.arange(len(y_val)), y_val], rtol=1e-5)
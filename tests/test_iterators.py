@@ -0,0 +1,132 @@
+import numpy
+import pytest
+
+from cutils.data_interface.parallel import ParallelCorpus
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.training.iterators import BucketIterator, Prefetcher, \
+    TokenBudgetIterator
+
+
+def random_corpus(n_seqs, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return RaggedCorpus.from_sequences(
+        [rng.randint(1, 50, rng.randint(1, 30)) for _ in range(n_seqs)])
+
+
+def flatten(batches):
+    return sorted(numpy.concatenate(batches).tolist())
+
+
+def test_bucket_iterator_covers_every_sequence():
+    corpus = random_corpus(103)
+    it = BucketIterator(corpus, 8, n_buckets=4,
+                        rng=numpy.random.RandomState(1))
+    batches = list(it.batch_indices())
+    assert len(batches) == len(it)
+    assert flatten(batches) == list(range(len(corpus)))
+    assert all(len(batch) <= 8 for batch in batches)
+    # Sequences from one bucket only in every batch
+    bucket_ids = numpy.searchsorted(it.bucket_boundaries, it.lengths)
+    assert all(len(set(bucket_ids[batch])) == 1 for batch in batches)
+    assert it.padding_efficiency() == it.padding_efficiency(batches)
+
+
+def test_bucket_iterator_without_remaining():
+    corpus = random_corpus(103)
+    it = BucketIterator(corpus, 8, n_buckets=4, use_remaining=False,
+                        rng=numpy.random.RandomState(1))
+    batches = list(it.batch_indices())
+    assert len(batches) == len(it)
+    assert all(len(batch) == 8 for batch in batches)
+
+
+def test_bucket_iterator_batches():
+    corpus = random_corpus(20)
+    labels = list(range(20))
+    it = BucketIterator(corpus, 4, labels=labels, maxlen=10,
+                        rng=numpy.random.RandomState(1))
+    for x, mask, y in it:
+        assert x.shape == mask.shape
+        assert x.shape[0] <= 10
+        for column, label in enumerate(y):
+            n = int(mask[:, column].sum())
+            assert x[:n, column].tolist() == corpus[label][:n].tolist()
+
+
+def test_token_budget_iterator():
+    corpus = random_corpus(200)
+    it = TokenBudgetIterator(corpus, 100, rng=numpy.random.RandomState(1))
+    lengths = corpus.lengths()
+    batches = list(it.epoch_batches())
+    assert len(batches) == len(it)
+    assert flatten(batches) == list(range(len(corpus)))
+    for batch in batches:
+        assert len(batch) == 1 or lengths[batch].max() * len(batch) <= 100
+
+
+def test_token_budget_iterator_pairs():
+    pairs = ParallelCorpus(random_corpus(150, seed=0),
+                           random_corpus(150, seed=1))
+    it = TokenBudgetIterator(pairs, 120, rng=numpy.random.RandomState(1))
+    src, tgt = pairs.source.lengths(), pairs.target.lengths()
+    batches = list(it.epoch_batches())
+    assert flatten(batches) == list(range(len(pairs)))
+    for batch in batches:
+        cost = (src[batch].max() + tgt[batch].max()) * len(batch)
+        assert len(batch) == 1 or cost <= 120
+
+
+@pytest.mark.parametrize('make_iterator', [
+    lambda rng: BucketIterator(random_corpus(103), 8, n_buckets=4, rng=rng),
+    lambda rng: TokenBudgetIterator(random_corpus(103), 60, rng=rng),
+])
+def test_resume_mid_epoch(make_iterator):
+    full = make_iterator(numpy.random.RandomState(1))
+    epochs = [list(full.epoch_batches()) for _ in range(3)]
+
+    it = make_iterator(numpy.random.RandomState(1))
+    list(it.epoch_batches())
+    second = it.epoch_batches()
+    for _ in range(5):
+        next(second)
+    state = it.state_dict()
+
+    resumed = make_iterator(numpy.random.RandomState(2))
+    resumed.load_state_dict(state)
+    assert resumed.start_position() == 5
+    rest = list(resumed.epoch_batches())
+    third = list(resumed.epoch_batches())
+    assert resumed.epoch == 2
+    assert [b.tolist() for b in rest] == [b.tolist() for b in epochs[1][5:]]
+    assert [b.tolist() for b in third] == [b.tolist() for b in epochs[2]]
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize('use_process', [False, True])
+def test_prefetcher_keeps_order(use_process):
+    prefetcher = Prefetcher(range(50), n_prefetch=3, transform=square,
+                            use_process=use_process, n_workers=2)
+    assert list(prefetcher) == [square(i) for i in range(50)]
+    # The iterable is read again for every epoch
+    assert list(prefetcher) == [square(i) for i in range(50)]
+
+
+def test_prefetcher_reraises():
+    def items():
+        yield 1
+        raise KeyError('boom')
+
+    prefetched = iter(Prefetcher(items()))
+    assert next(prefetched) == 1
+    with pytest.raises(KeyError):
+        next(prefetched)
+
+
+def test_prefetcher_stops_early():
+    # Leaving the loop early shuts the worker thread down
+    for i, _ in enumerate(Prefetcher(range(1000), n_prefetch=1)):
+        if i == 3:
+            break
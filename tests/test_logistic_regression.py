@@ -0,0 +1,47 @@
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+import theano.tensor as T
+
+from cutils.layers.logistic_regression import LogisticRegression
+
+
+def test_sparse_nce_matches_dense():
+    rng = numpy.random.RandomState(1234)
+    n_words, dim, batch_size, k = 20, 5, 4, 6
+    floatX = theano.config.floatX
+    layer = LogisticRegression(n_words, dim, ortho=False)
+    layer.tparams['logit_W'].set_value(
+        rng.randn(dim, n_words).astype(floatX))
+    layer.tparams['logit_b'].set_value(rng.randn(n_words).astype(floatX))
+
+    x = T.matrix('x')
+    y = T.ivector('y')
+    y_flat = T.ivector('y_flat')
+    samples = T.imatrix('samples')
+    indicators = T.matrix('indicators')
+    noise_dist = T.vector('noise_dist')
+    layer.logit_layer(x)
+    dense = theano.function(
+        [x, y, y_flat, indicators, noise_dist],
+        layer.nce_loss(y, y_flat, indicators, noise_dist, k))
+    sparse = theano.function(
+        [x, y, samples, noise_dist],
+        layer.sparse_nce_loss(x, y, samples, noise_dist, k))
+
+    x_val = rng.randn(batch_size, dim).astype(floatX)
+    y_val = rng.randint(0, n_words, batch_size).astype('int32')
+    q = rng.rand(n_words)
+    q_val = (q / q.sum()).astype(floatX)
+    # Distinct samples, the dense version counts a word only once
+    samples_val = numpy.asarray([rng.choice(n_words, k, replace=False)
+                                 for _ in range(batch_size)], dtype='int32')
+    indicators_val = numpy.zeros((batch_size, n_words), dtype=floatX)
+    indicators_val[numpy.arange(batch_size)[:, None], samples_val] = 1.
+    y_flat_val = (numpy.arange(batch_size) * n_words
+                  + y_val).astype('int32')
+
+    numpy.testing.assert_allclose(
+        sparse(x_val, y_val, samples_val, q_val),
+        dense(x_val, y_val, y_flat_val, indicators_val, q_val), rtol=1e-5)
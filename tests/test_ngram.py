@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+from cutils.data_interface.ngram import NgramWindows
+from cutils.data_interface.ragged import RaggedCorpus
+
+BOS = 1
+
+
+def make_windows():
+    corpus = RaggedCorpus.from_sequences([[5, 6, 2], [7, 2]])
+    return NgramWindows.from_corpus(corpus, 3, BOS)
+
+
+def test_windows():
+    windows = make_windows()
+    assert len(windows) == 5
+    assert windows.contexts().tolist() == [[1, 1, 1], [1, 1, 5], [1, 5, 6],
+                                           [5, 6, 2], [6, 2, 7]]
+    assert windows.targets().tolist() == [5, 6, 2, 7, 2]
+    # The contexts are a view of the stream
+    assert numpy.shares_memory(windows.contexts(), windows.stream)
+    with pytest.raises(ValueError):
+        windows.contexts()[0, 0] = 0
+
+
+def test_get_batch():
+    x, y = make_windows().get_batch([4, 0])
+    assert x.tolist() == [[6, 2, 7], [1, 1, 1]]
+    assert y.tolist() == [2, 5]
+
+
+def test_split():
+    windows = make_windows()
+    train, valid = windows.split(0.4)
+    assert (len(train), len(valid)) == (3, 2)
+    assert train.stream is windows.stream and valid.stream is windows.stream
+    assert valid.contexts().tolist() == windows.contexts()[3:].tolist()
+    assert valid.targets().tolist() == [7, 2]
+    x, y = valid.get_batch([1])
+    assert x.tolist() == [[6, 2, 7]] and y.tolist() == [2]
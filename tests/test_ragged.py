@@ -0,0 +1,84 @@
+import numpy
+
+from cutils.data_interface.ragged import RaggedCorpus
+from cutils.data_interface.utils import pad_and_mask
+from cutils.data_interface.views import IndexView, split_dataset
+
+SEQS = [[3, 1, 4], [1], [5, 9, 2, 6], [], [5, 3]]
+
+
+def test_from_sequences():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    assert len(corpus) == len(SEQS)
+    assert corpus.to_list() == SEQS
+    assert corpus.lengths().tolist() == [3, 1, 4, 0, 2]
+    assert corpus.num_tokens() == 10
+    assert corpus[-1].tolist() == [5, 3]
+
+
+def test_slices_and_take():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    # A contiguous slice shares the token storage
+    part = corpus[1:3]
+    assert part.tokens is corpus.tokens
+    assert part.to_list() == SEQS[1:3]
+    assert part.num_tokens() == 5
+    assert corpus[::2].to_list() == SEQS[::2]
+    assert corpus.take([4, 0, 4]).to_list() == [SEQS[4], SEQS[0], SEQS[4]]
+    assert corpus[numpy.asarray([2, 3])].to_list() == SEQS[2:4]
+
+
+def test_concatenate_slices():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    joined = RaggedCorpus.concatenate([corpus[3:], corpus[:2]])
+    assert joined.to_list() == SEQS[3:] + SEQS[:2]
+
+
+def test_pad_and_mask_matches_lists():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    idx = [2, 0, 1]
+    labels = [1, 0, 1]
+    for maxlen in (None, 2):
+        x, mask, y = corpus.pad_and_mask(idx, labels, maxlen=maxlen)
+        x_ref, mask_ref, y_ref = pad_and_mask([SEQS[i] for i in idx],
+                                              labels, maxlen=maxlen)
+        numpy.testing.assert_array_equal(x, x_ref)
+        numpy.testing.assert_array_equal(mask, mask_ref)
+        assert list(y) == list(y_ref)
+
+
+def test_index_view():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    view = IndexView(corpus, [4, 2, 0])
+    assert len(view) == 3
+    assert [s.tolist() for s in view] == [SEQS[4], SEQS[2], SEQS[0]]
+    assert view.lengths().tolist() == [2, 4, 3]
+    assert view.materialize().to_list() == [SEQS[4], SEQS[2], SEQS[0]]
+    # A view of a view refers to the original corpus
+    nested = view[1:]
+    assert nested.parent is corpus
+    assert nested.indices.tolist() == [2, 0]
+    x, mask, _ = view.pad_and_mask([1, 2])
+    x_ref, mask_ref, _ = pad_and_mask([SEQS[2], SEQS[0]])
+    numpy.testing.assert_array_equal(x, x_ref)
+    numpy.testing.assert_array_equal(mask, mask_ref)
+
+
+def test_index_view_of_lists():
+    labels = ['a', 'b', 'c', 'd']
+    view = IndexView(labels, [3, 1])
+    assert list(view) == ['d', 'b']
+    assert view.take([1]) == ['b']
+    assert view.lengths().tolist() == [1, 1]
+
+
+def test_split_dataset():
+    corpus = RaggedCorpus.from_sequences(SEQS)
+    labels = list(range(len(SEQS)))
+    (x_a, y_a), (x_b, y_b) = split_dataset((corpus, labels), [0.6, 0.4],
+                                           seed=1)
+    assert len(x_a) == 3 and len(x_b) == 2
+    # Every sample lands in exactly one part, with its own label
+    assert sorted(list(y_a) + list(y_b)) == labels
+    for x, y in ((x_a, y_a), (x_b, y_b)):
+        assert [s.tolist() for s in x] == [SEQS[i] for i in y]
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from cutils.dict import Dict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'examples', 'lstm_lm'))
+from lm import LSTM_LM
+
+N_WORDS = 12
+
+
+def make_lm():
+    words = ['<PAD>', '<UNK>'] + ['w%d' % i for i in range(N_WORDS - 2)]
+    dictionary = Dict.from_vocab(words, numpy.arange(N_WORDS) + 1, 6)
+    lm = LSTM_LM(6, N_WORDS, dictionary, 1234, use_dropout=False)
+    _, x, mask, cost = lm.build_model(sampled=True)
+    f_sampled = theano.function([x, mask] + lm.sample_inputs, cost)
+    return lm, f_sampled
+
+
+def test_log_q_correction():
+    """
+    Subtracting log_q from the candidate logits is the same as shifting
+    the output biases by -log_q, and leaving out the other words the
+    same as giving them a very low bias
+    """
+    floatX = theano.config.floatX
+    rng = numpy.random.RandomState(1)
+    lm, f_sampled = make_lm()
+    x = rng.randint(2, N_WORDS, (5, 3)).astype('int32')
+    mask = numpy.ones((5, 3), dtype=floatX)
+    mask[3:, 2] = 0.
+    b = lm.tparams['logit_b'].get_value()
+
+    for candidates in (numpy.arange(N_WORDS),
+                       numpy.union1d(x.ravel(), [1])):
+        candidates = candidates.astype('int32')
+        log_q = rng.uniform(-3., 0., len(candidates)).astype(floatX)
+        cost = f_sampled(x, mask, candidates, log_q)
+
+        shifted = numpy.full_like(b, -1e4)
+        shifted[candidates] = b[candidates] - log_q
+        lm.tparams['logit_b'].set_value(shifted)
+        numpy.testing.assert_allclose(cost, lm.f_cost(x, mask), rtol=1e-4)
+        lm.tparams['logit_b'].set_value(b)
+
+
+def test_uncorrected_full_candidates_match_exact_cost():
+    lm, f_sampled = make_lm()
+    x = numpy.random.RandomState(2).randint(0, N_WORDS, (4, 2)) \
+        .astype('int32')
+    mask = numpy.ones((4, 2), dtype=theano.config.floatX)
+    candidates = numpy.arange(N_WORDS, dtype='int32')
+    log_q = numpy.zeros((N_WORDS,), dtype=theano.config.floatX)
+    numpy.testing.assert_allclose(f_sampled(x, mask, candidates, log_q),
+                                  lm.f_cost(x, mask), rtol=1e-4)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from cutils.data_interface.tokenizer import MosesTokenizer, tokenize_lines
+
+
+# Reference outputs of the Moses `tokenizer.perl -l en -q`
+MOSES_CASES = [
+    (u'He paid 5,', u'He paid 5 ,'),
+    (u'He paid 5, then left.', u'He paid 5 , then left .'),
+    (u'It costs 5,300 dollars.', u'It costs 5,300 dollars .'),
+    (u'Sales rose to 1,000,', u'Sales rose to 1,000 ,'),
+    (u"The 1990's, he said, weren't bad.",
+     u'The 1990 &apos;s , he said , weren &apos;t bad .'),
+    (u'Mr. Smith paid $5.50 ... ok?', u'Mr. Smith paid $ 5.50 ... ok ?'),
+    (u'A,B,C,D,E', u'A , B , C , D , E'),
+    (u'Dimensions: 3x4, 10,', u'Dimensions : 3x4 , 10 ,'),
+    (u'"Quoted" text & <tags> [brackets] |pipe|',
+     u'&quot; Quoted &quot; text &amp; &lt; tags &gt; &#91; brackets &#93; '
+     u'&#124; pipe &#124;'),
+    (u'No. 5 is here. Wait...', u'No. 5 is here . Wait ...'),
+]
+
+
+@pytest.mark.parametrize('line,expected', MOSES_CASES)
+def test_tokenize_matches_moses(line, expected):
+    assert MosesTokenizer().tokenize(line) == expected
+
+
+def test_tokenize_bytes():
+    assert MosesTokenizer().tokenize(b'He paid 5,\n') == b'He paid 5 ,'
+
+
+def test_tokenize_lines_with_workers():
+    lines = [line for line, _ in MOSES_CASES] * 7
+    expected = [MosesTokenizer().tokenize(line) for line in lines]
+    assert list(tokenize_lines(lines, workers=2, chunk_size=4)) == expected